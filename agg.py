@@ -2,8 +2,11 @@
 from __future__ import print_function
 import sqlalchemy
 from sqlalchemy import func
-from initdb import tables, table_cols, session, engine
+from initdb import tables, table_cols, session, engine, read_engine, conf, \
+    Base_geo
 from sqlalchemy.exc import DataError, SQLAlchemyError
+from geoalchemy2 import Geography
+import collections
 import datetime
 import logging
 import math
@@ -14,29 +17,236 @@ import requests
 import pdb
 import datetime
 import numpy
+import arima
+import cache
+import changepoint
+import columnar
+import dictionary
+import estimators
+import metrics
+import rollup
+import serialize
+import sketches
+from util.load import make_linkage_table, primary_key
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logging.basicConfig()
 
+@cache.cached()
 def get_groups(table, group_col):
+    if dictionary.available(table, group_col):
+        d = dictionary.current(table, group_col)
+        return session.query(d.c.value).order_by(d.c.value).all()
     t = tables[table]
     col = getattr(t, group_col)
     q = session.query(func.distinct(col)).filter(col != None)
 
     return q.all()
 
+def find_groups(table, group_col, prefix=None, contains=None, sort='value',
+                limit=None, offset=None):
+    '''
+    Returns the groups of a groupable column with their row counts and
+    first and last timestamps, searched and paged.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    group_col : str
+        Groupable column.
+    prefix : str, optional
+        Only groups starting with `prefix`, ignoring case.
+    contains : str, optional
+        Only groups containing `contains`, ignoring case.
+    sort : {'value', 'count'}, optional
+        Order by group, or by descending row count (for the top groups).
+    limit : int, optional
+        Return at most `limit` groups (the default is every group).
+    offset : int, optional
+        Skip the first `offset` groups.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Columnar result: `value`, `n`, `first_seen` and `last_seen`.
+
+    Notes
+    -----
+    Reads the dictionary of the column (see `tempus.py dictionary`) and
+    the rows added since it was refreshed; until it is built, every call
+    groups the raw table.
+
+    '''
+    if group_col not in table_cols[table]['groupable']:
+        raise ValueError('Column {} not in table {} groupable'.format(
+            group_col, table))
+    if limit is not None and limit < 0 or offset is not None and offset < 0:
+        raise ValueError('limit and offset cannot be negative')
+    q = dictionary.search_query(dictionary.source(table, group_col),
+                                prefix=prefix, contains=contains, sort=sort,
+                                limit=limit, offset=offset)
+
+    result = collections.OrderedDict(
+        (c, []) for c in ('value', 'n', 'first_seen', 'last_seen'))
+    for row in read_engine.execute(q):
+        result['value'].append(row['value'])
+        result['n'].append(row['n'])
+        for c in ('first_seen', 'last_seen'):
+            result[c].append(None if row[c] is None else str(row[c]))
+    return result
+
+BUCKETS = ('hour', 'day', 'week', 'month')
+
 def get(table, response_col, target_col=None, target=None, start=None,
-        end=None, sort=False):
+        end=None, sort=False, bucket=None, how='avg'):
+    '''
+    Returns (timestamp, value) rows of a response variable.
 
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    response_col : str
+        Response variable.
+    target_col : str, optional
+        Groupable column to filter on.
+    target : str, optional
+        Only include rows where `target_col` equals `target`.
+    start : datetime.datetime, optional
+        Only include entries at or after `start`.
+    end : datetime.datetime, optional
+        Only include entries before `end`.
+    sort : bool, optional
+        Order rows by timestamp.
+    bucket : {'hour', 'day', 'week', 'month'}, optional
+        Aggregate the response per time bucket instead of returning raw rows
+        (the default is raw rows).
+    how : str, optional
+        Aggregate applied per bucket: 'avg' (the default), 'count', 'sum',
+        'min', 'max', 'median', or 'p<N>' for the Nth percentile (e.g. 'p95').
 
+    Returns
+    -------
+    list
+        List of (timestamp, value) tuples; with `bucket`, the timestamp is
+        the start of the bucket.
+
+    '''
+    store = _get_store(table, response_col, target_col, target, start, bucket,
+                       how)
+    if store is not None:
+        return store.get(response_col, target_col, target, start, end,
+                         bucket, how)
+
+    q = _get_query(table, response_col, target_col, target, start, end, sort,
+                   bucket, how)
+    res = q.all()
+
+    return res
+
+def get_arrays(table, response_col, target_col=None, target=None, start=None,
+               end=None, sort=False, bucket=None, how='avg'):
+    '''
+    Same as `get`, but returns the series as NumPy arrays.
+
+    Returns
+    -------
+    t : numpy.ndarray
+        Timestamps as int64 epoch milliseconds.
+    v : numpy.ndarray
+        Values as float64, NaN where NULL.
+
+    '''
+    store = _get_store(table, response_col, target_col, target, start, bucket,
+                       how)
+    if store is not None:
+        us, v = store.get_arrays(response_col, target_col, target, start, end,
+                                 bucket, how)
+        return us // 1000, np.asarray(v, dtype=float)
+
+    q = _get_query(table, response_col, target_col, target, start, end, sort,
+                   bucket, how)
+    return serialize.row_arrays(q.all())
+
+def iter_get(table, response_col, target_col=None, target=None, start=None,
+             end=None, sort=False, bucket=None, how='avg', chunk_size=10000):
+    '''
+    Same as `get`, but yields rows from a server-side cursor, fetching
+    `chunk_size` rows at a time instead of materializing the result.
+    '''
+    store = _get_store(table, response_col, target_col, target, start, bucket,
+                       how)
+    if store is not None:
+        return iter(store.get(response_col, target_col, target, start, end,
+                              bucket, how))
+
+    q = _get_query(table, response_col, target_col, target, start, end, sort,
+                   bucket, how)
+    return q.execution_options(stream_results=True).yield_per(chunk_size)
+
+def _columnar_store(table, columns, tstart=None):
+    ''' Returns the in-memory store of `table` if it holds `columns` '''
+    store = columnar.get_store(table)
+    if store is not None and store.covers(columns, tstart):
+        return store
+    return None
+
+def _get_store(table, response_col, target_col, target, start, bucket, how):
+    ''' Returns the in-memory store if it can answer a `get` '''
+    if bucket is not None and bucket not in BUCKETS:
+        raise ValueError('Unknown bucket {}'.format(bucket))
+    if bucket and not columnar.supported(how):
+        return None
+    columns = [response_col, target_col] if target_col and target \
+        else [response_col]
+    return _columnar_store(table, columns, start)
+
+def bucket_aggregate(col, how):
+    ''' Returns the SQL aggregate of `col` named by `how` (see `get`) '''
+    how = how.lower()
+    if how in ('avg', 'count', 'sum', 'min', 'max'):
+        return getattr(func, how)(col)
+
+    quantile = None
+    if how == 'median':
+        quantile = 0.5
+    elif how.startswith('p'):
+        try:
+            quantile = float(how[1:]) / 100
+        except ValueError:
+            quantile = None
+    if quantile is None or not 0 <= quantile <= 1:
+        raise ValueError('Unknown aggregate {}'.format(how))
+
+    # Ordered-set aggregates are not expressible in this SQLAlchemy version
+    return sqlalchemy.literal_column(
+        'percentile_cont({!r}) WITHIN GROUP (ORDER BY {})'.format(quantile,
+                                                                  col))
+
+def _get_query(table, response_col, target_col=None, target=None, start=None,
+               end=None, sort=False, bucket=None, how='avg'):
+    if bucket is not None and bucket not in BUCKETS:
+        raise ValueError('Unknown bucket {}'.format(bucket))
+
+    if bucket in BUCKETS[1:]:
+        q = _get_rollup_query(table, response_col, target_col, target, start,
+                              end, sort, bucket, how)
+        if q is not None:
+            return q
 
     t = tables[table]
     ts = getattr(t, table_cols[table]['timestamp'])
     col = getattr(t, response_col)
-    q = session.query(ts, col)
+    if bucket:
+        ts_bucket = func.date_trunc(bucket, ts)
+        q = session.query(ts_bucket, bucket_aggregate(col, how))\
+                .group_by(ts_bucket)
+    else:
+        q = session.query(ts, col)
     if start:
-        q = q.filter(ts > start)
+        q = q.filter(ts >= start)
 
     if end:
         q = q.filter(ts < end)
@@ -46,18 +256,392 @@ def get(table, response_col, target_col=None, target=None, start=None,
         q = q.filter(tc == target)
 
     if sort:
-        q = q.order_by(ts)
+        q = q.order_by(ts_bucket if bucket else ts)
 
-    res = q.all()
+    return q
 
-    return res
+def _get_rollup_query(table, response_col, target_col, target, start, end,
+                      sort, bucket, how):
+    '''
+    Returns a bucketed `get` query against the daily rollups, or None if
+    the rollups cannot answer it.
+    '''
+    if not rollup.covers(table, [response_col], start, end):
+        return None
+    r = rollup.find(table, target_col if target else None)
+    value = rollup.aggregate(r, response_col, how) if r is not None else None
+    if value is None:
+        return None
+
+    ts_bucket = func.date_trunc(bucket, r.c.day)
+    q = session.query(ts_bucket, value).group_by(ts_bucket)
+    for cond in rollup.day_filters(r, start, end):
+        q = q.filter(cond)
+    if target:
+        q = q.filter(r.c[target_col] == target)
+    if sort:
+        q = q.order_by(ts_bucket)
+    return q
+
+# pandas frequency of each bucket, aligned like Postgres' date_trunc
+BUCKET_FREQ = {'hour': 'H', 'day': 'D', 'week': 'W-MON', 'month': 'MS'}
+
+def get_series_matrix(table, response_col, group_col, groups=None,
+                      bucket='day', how='avg', start=None, end=None):
+    '''
+    Returns bucketed series of many groups as a dense bucket x group matrix.
+
+    This is the grouped form of `get` with a `bucket`: one query returns
+    every group's series.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    response_col : str
+        Response variable.
+    group_col : str
+        Groupable column.
+    groups : iterable of str, optional
+        Groups to include (the default is every group).
+    bucket : {'hour', 'day', 'week', 'month'}, optional
+        Time bucket (the default is 'day').
+    how : str, optional
+        Aggregate per bucket, see `get` (the default is 'avg').
+    start : datetime.datetime, optional
+        Only include entries at or after `start`.
+    end : datetime.datetime, optional
+        Only include entries before `end`.
+
+    Returns
+    -------
+    times : pandas.DatetimeIndex
+        Every bucket between the first and last observation.
+    groups : list
+        Column labels of `values`.
+    values : numpy.ndarray
+        Matrix of shape (len(times), len(groups)). Buckets without rows are
+        0 for counts and NaN otherwise.
+
+    '''
+    if group_col not in table_cols[table]['groupable']:
+        raise ValueError('Column {} not in table {} groupable'.format(
+            group_col, table))
+    if bucket not in BUCKETS:
+        raise ValueError('Unknown bucket {}'.format(bucket))
+
+    r = rollup.find(table, group_col) if bucket != 'hour' else None
+    value = rollup.aggregate(r, response_col, how) \
+        if r is not None and rollup.covers(table, [response_col], start, end) \
+        else None
+    if value is not None:
+        group = r.c[group_col]
+        ts_bucket = func.date_trunc(bucket, r.c.day)
+        conds = rollup.day_filters(r, start, end) + [group != None]
+    else:
+        t = tables[table]
+        ts = getattr(t, table_cols[table]['timestamp'])
+        group = getattr(t, group_col)
+        ts_bucket = func.date_trunc(bucket, ts)
+        value = bucket_aggregate(getattr(t, response_col), how)
+        conds = [group != None]
+        if start:
+            conds.append(ts >= start)
+        if end:
+            conds.append(ts < end)
+
+    q = session.query(group, ts_bucket, value).group_by(group, ts_bucket)
+    if groups is not None:
+        q = q.filter(group.in_(list(groups)))
+    for cond in conds:
+        q = q.filter(cond)
+
+    df = pandas.DataFrame(q.all(), columns=['group', 'time', 'value'])
+    if df.empty:
+        return pandas.DatetimeIndex([]), [], np.zeros((0, 0))
+
+    wide = df.pivot(index='time', columns='group', values='value')
+    times = pandas.date_range(wide.index.min(), wide.index.max(),
+                              freq=BUCKET_FREQ[bucket])
+    wide = wide.reindex(times).astype(float)
+    if how.lower() == 'count':
+        wide = wide.fillna(0)
+
+    return times, list(wide.columns), wide.values
+
+def forecast(table, response_col, group_col=None, groups=None, bucket='day',
+             how='avg', steps=30, start=None, end=None, d=1, max_p=5):
+    '''
+    Forecasts the bucketed response of one or many groups.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    response_col : str
+        Response variable.
+    group_col : str, optional
+        Groupable column; without it the whole table is one series.
+    groups : iterable of str, optional
+        Groups to forecast (the default is every group of `group_col`).
+    bucket : {'hour', 'day', 'week', 'month'}, optional
+        Time bucket of the series (the default is 'day').
+    how : str, optional
+        Aggregate per bucket, see `get` (the default is 'avg').
+    steps : int, optional
+        Number of buckets to forecast (the default is 30).
+    start : datetime.datetime, optional
+        Only fit on entries at or after `start`.
+    end : datetime.datetime, optional
+        Only fit on entries before `end`.
+    d : int, optional
+        Order of differencing (the default is 1).
+    max_p : int, optional
+        Largest autoregressive order considered (the default is 5).
+
+    Returns
+    -------
+    dict
+        Maps each group (None without `group_col`) to {order, t, mean,
+        lower, upper}, where `t` holds the forecast bucket starts and
+        `lower`/`upper` bound the 95% interval. Groups whose series are too
+        short to fit are left out.
+
+    See Also
+    --------
+    arima.fit: The model fitted to each series.
+
+    '''
+    if group_col:
+        times, groups, Y = get_series_matrix(table, response_col, group_col,
+                                             groups, bucket, how, start, end)
+    else:
+        rows = get(table, response_col, start=start, end=end, sort=True,
+                   bucket=bucket, how=how)
+        times = pandas.DatetimeIndex([row[0] for row in rows])
+        groups = [None]
+        Y = np.array([[row[1]] for row in rows], dtype=float)
+
+    if not len(times):
+        return {}
+
+    keys = [(table, group_col, g, response_col, bucket, how, start, end)
+            for g in groups]
+    params = arima.fit_many(keys, Y, d=d, max_p=max_p)
+
+    forecasts = {}
+    for i, (g, p) in enumerate(zip(groups, params)):
+        if p is None:
+            continue
+        # Fits drop a series' trailing empty buckets, so its forecast starts
+        # after its own last observation
+        last = times[np.flatnonzero(~np.isnan(Y[:, i]))[-1]]
+        future = pandas.date_range(last, periods=steps + 1,
+                                   freq=BUCKET_FREQ[bucket])[1:]
+        mean, lower, upper = arima.predict(p, steps)
+        forecasts[g] = {'order': (p['p'], p['d'], 0),
+                        't': [str(t) for t in future],
+                        'mean': mean.tolist(), 'lower': lower.tolist(),
+                        'upper': upper.tolist()}
+    return forecasts
+
+@cache.cached()
+def changepoints(table, group_col, response_col=None, groups=None,
+                 bucket='day', how='count', method='pelt', penalty=None,
+                 min_size=2, start=None, end=None):
+    '''
+    Finds changes in the mean of the bucketed series of every group.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    group_col : str
+        Groupable column.
+    response_col : str, optional
+        Response variable (the default counts rows).
+    groups : iterable of str, optional
+        Groups to scan (the default is every group of `group_col`).
+    bucket : {'hour', 'day', 'week', 'month'}, optional
+        Time bucket of the series (the default is 'day').
+    how : str, optional
+        Aggregate per bucket, see `get` (the default is 'count').
+    method : {'pelt', 'binseg', 'amoc'}, optional
+        Detector, see `changepoint` (the default is 'pelt').
+    penalty : float, optional
+        Cost of a change point (the default scales with each series' noise
+        variance and length).
+    min_size : int, optional
+        Minimum number of buckets between change points (the default is 2).
+    start : datetime.datetime, optional
+        Only scan entries at or after `start`.
+    end : datetime.datetime, optional
+        Only scan entries before `end`.
+
+    Returns
+    -------
+    dict
+        Maps each group to its change points, as a list of {t, before,
+        after}: the first bucket of the new segment, and the mean of the
+        segments either side of it.
+
+    '''
+    if response_col is None:
+        response_col, how = table_cols[table]['timestamp'], 'count'
+    times, groups, Y = get_series_matrix(table, response_col, group_col,
+                                         groups, bucket, how, start, end)
+    found = changepoint.detect_many(Y, method, penalty, min_size,
+                                    arima.arima_conf.get('threads'))
+
+    result = {}
+    for i, (g, changes) in enumerate(zip(groups, found)):
+        y = changepoint.interpolate(Y[:, i])
+        bounds = [0] + list(changes) + [len(y)]
+        means = [float(y[s:e].mean()) for s, e in zip(bounds, bounds[1:])]
+        result[g] = [{'t': str(times[c]), 'before': means[j],
+                      'after': means[j + 1]}
+                     for j, c in enumerate(changes)]
+    return result
+
+@cache.cached()
+def spatial_aggregate(table, response_col=None, how='count', bbox=None,
+                      center=None, radius_km=None, bucket=None, start=None,
+                      end=None):
+    '''
+    Aggregates a response variable by the geography rows are linked to.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name, with `coords` and `geo_linkages` configured and
+        linked (see `tempus.py link`).
+    response_col : str, optional
+        Response variable (the default counts rows).
+    how : str, optional
+        Aggregate, see `get` (the default is 'count').
+    bbox : tuple of float, optional
+        Only include rows within (west, south, east, north) degrees.
+    center : tuple of float, optional
+        (latitude, longitude) of a circle of `radius_km` to include rows
+        within.
+    radius_km : float, optional
+        Radius around `center`.
+    bucket : {'hour', 'day', 'week', 'month'}, optional
+        Also aggregate per time bucket.
+    start : datetime.datetime, optional
+        Only include entries at or after `start`.
+    end : datetime.datetime, optional
+        Only include entries before `end`.
+
+    Returns
+    -------
+    dict
+        Columnar result, one entry per geography (and bucket): `geoid`,
+        `lat` and `lon` of the geography's point, `t` (with `bucket`),
+        `value` and `n`, the number of non-NULL responses.
+
+    Notes
+    -----
+    The bounding box and radius filters are answered from the GiST index on
+    the linked points.
+
+    '''
+    geo = table_cols[table].get('geo_linkages')
+    if not geo:
+        raise ValueError('{} has no geo_linkages'.format(table))
+    if bucket is not None and bucket not in BUCKETS:
+        raise ValueError('Unknown bucket {}'.format(bucket))
+    if response_col is not None and \
+            response_col not in table_cols[table]['covariates']:
+        raise ValueError('Column {} not in table {} covariates'.format(
+            response_col, table))
+    if center is not None and radius_km is None:
+        raise ValueError('A center needs a radius')
+
+    geo_conf = conf['tempus_geography'][geo]
+    link = make_linkage_table(table, geo)
+    key = link.c[geo_conf['linkage']]
+    points = Base_geo.classes[geo]
+    lat = sqlalchemy.cast(getattr(points, geo_conf['coords']['latitude']),
+                          sqlalchemy.Float)
+    lon = sqlalchemy.cast(getattr(points, geo_conf['coords']['longitude']),
+                          sqlalchemy.Float)
+
+    t = tables[table]
+    pk = primary_key(table)
+    ts = getattr(t, table_cols[table]['timestamp'])
+    if response_col is None:
+        value = n = func.count()
+    else:
+        y = getattr(t, response_col)
+        value, n = bucket_aggregate(y, how), func.count(y)
+
+    groups = [key.label('geoid'), lat.label('lat'), lon.label('lon')]
+    if bucket:
+        groups.append(func.date_trunc(bucket, ts).label('t'))
+    q = sqlalchemy.select(groups + [value.label('value'), n.label('n')])\
+            .select_from(link.join(t.__table__, link.c[pk.name] == pk)
+                         .join(points.__table__,
+                               getattr(points, geo_conf['linkage']) == key))\
+            .group_by(*groups).order_by(*groups)
+
+    if bbox is not None:
+        west, south, east, north = bbox
+        envelope = func.ST_MakeEnvelope(west, south, east, north, 4326)
+        q = q.where(func.ST_Intersects(link.c.coords,
+                                       sqlalchemy.cast(envelope, Geography)))
+    if center is not None:
+        point = func.ST_SetSRID(func.ST_MakePoint(center[1], center[0]), 4326)
+        q = q.where(func.ST_DWithin(link.c.coords,
+                                    sqlalchemy.cast(point, Geography),
+                                    radius_km * 1000))
+    if start:
+        q = q.where(ts >= start)
+    if end:
+        q = q.where(ts < end)
+
+    result = collections.OrderedDict(
+        (c, []) for c in ['geoid', 'lat', 'lon'] +
+        (['t'] if bucket else []) + ['value', 'n'])
+    for row in read_engine.execute(q):
+        result['geoid'].append(row['geoid'])
+        result['lat'].append(row['lat'])
+        result['lon'].append(row['lon'])
+        if bucket:
+            result['t'].append(str(row['t']))
+        result['value'].append(None if row['value'] is None
+                               else float(row['value']))
+        result['n'].append(row['n'])
+    return result
 
 def make_postgres_array(li):
     return '{' + ','.join(map('"{}"'.format, li)) + '}'
 
-def get_comparison_ts(table, target_col, groups, resp, sort=False):
+def get_comparison_ts(table, target_col, groups, resp, sort=False,
+                      bucket=None):
+    '''
+    Returns the average response of a set of groups over time.
+
+    With `bucket='day'` the average is taken per day, which the daily
+    rollups can answer; otherwise it is taken per distinct timestamp.
+    '''
+    store = _columnar_store(table, [target_col, resp])
+    if store is not None:
+        return store.comparison_ts(target_col, groups, resp, bucket)
+
+    r = rollup.find(table, target_col) if bucket == 'day' else None
+    if r is not None and rollup.covers(table, [resp]):
+        ts = r.c.day
+        q = session.query(ts, rollup.aggregate(r, resp, 'AVG'))\
+                .filter(r.c[target_col].in_(groups)).group_by(ts)
+        if sort:
+            q = q.order_by(ts)
+        return q.all()
+
     t = tables[table]
     ts = getattr(t, table_cols[table]['timestamp'])
+    if bucket == 'day':
+        ts = sqlalchemy.cast(ts, sqlalchemy.Date)
     group_col = getattr(t, target_col)
     resp_col = getattr(t, resp)
 
@@ -70,36 +654,58 @@ def get_comparison_ts(table, target_col, groups, resp, sort=False):
     return q.all()
 
 
-def get_comparisons(table, target_col, target, covs):
+@cache.cached()
+def get_comparisons(table, target_col, target, covs, num_matches=3,
+                    backend='native'):
+    '''
+    Returns the groups that best match a target group on a set of covariates.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    target_col : str
+        Groupable column that holds the target and comparison groups.
+    target : str
+        Target group.
+    covs : iterable of str
+        Covariates to match on.
+    num_matches : int, optional
+        Number of comparison groups to return (the default is 3).
+    backend : {'native', 'plr'}, optional
+        Fit the propensity model in-process on per-group covariate means (the
+        default), or run the PL/R `matchit` function inside Postgres.
+
+    Returns
+    -------
+    list
+        Comparison groups, closest propensity score first.
+
+    Notes
+    -----
+    Neither backend moves row-level data out of the database: the native
+    backend only reads one row of covariate means per group.
+
+    '''
+    if target_col not in table_cols[table]['groupable']:
+        raise ValueError("{} not in groupable for table {}".format(target_col,
+            table))
     for cov in covs:
         if cov not in table_cols[table]['covariates']:
             raise ValueError("{} not in covariates for table {}".format(cov,
                 table))
-    #Covariates to be used in select statement
-    cov_select = ','.join(covs)
-
-    #Construst the where clause.
-    where_clause = target_col + ' IS NOT NULL'
-    #Add the covariants to the where clause, we just loop through and append IS NOT NULL behind them
-    for cov in covs:
-        where_clause += ' AND ' + cov + ' IS NOT NULL'
 
     #Test if bad parameters were given to us, if so catch it. Also catch general errors. Raise both errors.
     try:
-        select_statement = 'SELECT ' + target_col + ', ' + cov_select + ' FROM ' + table + ' WHERE ' + where_clause
-        df = pandas.read_sql_query(select_statement, con=engine)
-
-        # Orient by records to dictionary
-        frame = df.to_dict(orient = 'records')
-
-        data = {'data':frame, 'treatment_col':target_col, 'treatment_selection':target, 'covariate_col':covs}
-        url = 'http://ec2-96-127-78-36.us-gov-west-1.compute.amazonaws.com/ocpu/library/rlines/R/matchit_data/json'
-        headers = {'Content-Type':'application/json'}
-        data = json.dumps(data)
-
-        #Call the opencpu server.
-        response = requests.post(url, data=data, headers=headers)
-        comparison_groups = json.loads(response.content)
+        if backend == 'native':
+            comparison_groups = _get_comparisons_native(table, target_col,
+                                                        target, covs,
+                                                        num_matches)
+        elif backend == 'plr':
+            comparison_groups = _get_comparisons_plr(table, target_col,
+                                                     target, covs)
+        else:
+            raise ValueError('Unknown comparison backend {}'.format(backend))
 
     except DataError as data_error:
         session.rollback()
@@ -108,9 +714,48 @@ def get_comparisons(table, target_col, target, covs):
         session.rollback()
         raise error
 
-    return comparison_groups
+    return comparison_groups[:num_matches]
 
-def diffindiff(target, comparisons, date):
+def _get_comparisons_native(table, target_col, target, covs, num_matches):
+    t = tables[table]
+    col = getattr(t, target_col)
+    cov_cols = [getattr(t, cov) for cov in covs]
+
+    # Collapse rows to one row of covariate means per group
+    q = session.query(col, func.count(), *[func.avg(c) for c in cov_cols])\
+            .filter(col != None)
+    for c in cov_cols:
+        q = q.filter(c != None)
+    rows = q.group_by(col).all()
+
+    groups = [row[0] for row in rows]
+    treated = np.array([str(g) == str(target) for g in groups])
+    if not treated.any():
+        raise ValueError("{} has no rows with covariates {}".format(target,
+            covs))
+
+    with metrics.phase('compute'):
+        weights = np.array([row[1] for row in rows], dtype=float)
+        X = np.array([row[2:] for row in rows], dtype=float)
+        scores = estimators.propensity_scores(X, treated, weights=weights)
+
+    distance = np.abs(scores - scores[treated][0])
+    order = [i for i in np.argsort(distance, kind='mergesort')
+             if not treated[i]]
+    return [groups[i] for i in order[:num_matches]]
+
+def _get_comparisons_plr(table, target_col, target, covs):
+    select_statement = sqlalchemy.text(
+        'SELECT * FROM matchit(:table, :target_col, :target, :covs)'
+        ' AS m(comparison TEXT)')
+    rows = session.execute(select_statement,
+                           {'table': table, 'target_col': target_col,
+                            'target': target, 'covs': list(covs)}).fetchall()
+    return [row[0] for row in rows]
+
+@cache.cached(table='escort_ads')
+def diffindiff(target, comparisons, date, logged=False, normalize=False,
+               backend='native'):
     '''
     Returns a difference-in-difference estimate between target region and
     comparison groups, at the given date.
@@ -123,6 +768,14 @@ def diffindiff(target, comparisons, date):
         Variable(s) to compare to.
     date : str
         Date string, in the format YYYY-mm-dd
+    logged : bool, optional
+        Log transform the counts before fitting (the default is False).
+    normalize : bool, optional
+        Rescale the comparison series to the target's pre-event mean (the
+        default is False).
+    backend : {'native', 'opencpu'}, optional
+        Fit the model in-process with NumPy (the default), or post the panel
+        to the `rlines::diffindiff_data` OpenCPU function for cross-checking.
 
     Returns
     -------
@@ -137,21 +790,46 @@ def diffindiff(target, comparisons, date):
         dictionaries mapping to scalar values.
 
     '''
-    # The comparison dictionary (soon to be json)  that will be passed to the open cpu api
-    comparison_json = get_comparison_dictionary(comparisons)
-    msanames = comparisons
-    msanames.append(target)
-    df = get_diffindiff_data(msanames)
-    valid = check_dataframe(df, date)
+    if isinstance(comparisons, basestring):
+        comparisons = [comparisons]
+    comparisons = list(comparisons)
+    dates, regions, counts = get_panel(comparisons + [target])
+    valid = check_panel(dates, date)
     if valid:
         pass
     else:
         raise ValueError
+
+    if backend == 'native':
+        return _diffindiff_native(dates, regions, counts, target, comparisons,
+                                  date, logged, normalize)
+    elif backend == 'opencpu':
+        df = panel_frame(dates, regions, counts)
+        return _diffindiff_opencpu(df, target, comparisons, date, logged,
+                                   normalize)
+
+    raise ValueError('Unknown diffindiff backend {}'.format(backend))
+
+def _diffindiff_native(dates, regions, counts, target, comparisons, date,
+                       logged, normalize):
+    comparison_idx = [regions.index(c) for c in set(comparisons)]
+    with metrics.phase('compute'):
+        return estimators.diffindiff(dates,
+                                     counts[:, regions.index(target)],
+                                     counts[:, comparison_idx].sum(axis=1),
+                                     date, logged=logged, normalize=normalize)
+
+def _diffindiff_opencpu(df, target, comparisons, date, logged, normalize):
+    # The comparison dictionary (soon to be json)  that will be passed to the open cpu api
+    comparison_json = get_comparison_dictionary(comparisons)
     # Orient by records to dictionary
-    frame = df.to_dict(orient = 'records')
+    with metrics.phase('transform'):
+        frame = df.to_dict(orient = 'records')
 
-    data = {'target.region':target, 'comparison.region.set':comparison_json, 'event.date':date, 'input_data':frame}
-    url = 'http://ec2-96-127-78-36.us-gov-west-1.compute.amazonaws.com/ocpu/library/rlines/R/diffindiff_data/json'
+    data = {'target.region':target, 'comparison.region.set':comparison_json,
+            'event.date':date, 'input_data':frame, 'logged':logged,
+            'normalize':normalize}
+    url = conf['opencpu'] + '/diffindiff_data/json'
     headers = {'Content-Type':'application/json'}
     date_handler = lambda obj: (
         obj.isoformat()
@@ -159,11 +837,112 @@ def diffindiff(target, comparisons, date):
         or isinstance(obj, datetime.date)
         else None
     )
-    data = json.dumps(data, default=date_handler)
-    response = requests.post(url, data=data, headers=headers)
+    with metrics.phase('serialize'):
+        data = json.dumps(data, default=date_handler)
+    with metrics.phase('remote'):
+        response = requests.post(url, data=data, headers=headers)
+    with metrics.phase('serialize'):
+        result = json.loads(response.content)
+
+    # OpenCPU boxes R scalars into length-1 arrays
+    for key in ('diff_in_diff', 'target_diff', 'comparison_diff'):
+        result[key] = dict((k, v[0]) for k, v in result[key].items())
+
+    return result
+
+@cache.cached(table='escort_ads')
+def diffindiff_many(targets, comparisons, date, logged=False,
+                    normalize=False):
+    '''
+    Returns difference-in-difference estimates of many targets around the
+    same event date.
+
+    All regions are read in one panel and every estimate is fitted at once,
+    which is much faster than calling `diffindiff` per target.
+
+    Parameters
+    ----------
+    targets : iterable of str
+        Target regions.
+    comparisons : iterable of str, or iterable of iterable of str
+        Either one set of comparison regions shared by every target (a
+        target is left out of its own comparison set), or one set per target.
+    date : str
+        Date string, in the format YYYY-mm-dd
+    logged : bool, optional
+        Log transform the counts before fitting (the default is False).
+    normalize : bool, optional
+        Rescale each comparison series to its target's pre-event mean (the
+        default is False).
+
+    Returns
+    -------
+    list of dict
+        One row per target: `target`, `comparisons`, and `diff_in_diff`,
+        `target_diff` and `comparison_diff` as in `diffindiff`.
+
+    '''
+    targets = list(targets)
+    comparisons = list(comparisons)
+    if comparisons and all(isinstance(c, basestring) for c in comparisons):
+        comparisons = [sorted(set(comparisons) - set([t])) for t in targets]
+    else:
+        comparisons = [sorted(set(c)) for c in comparisons]
+    if len(comparisons) != len(targets):
+        raise ValueError('Need one comparison set per target')
+
+    regions = targets + [c for cs in comparisons for c in cs]
+    dates, regions, counts = get_panel(regions)
+    if not check_panel(dates, date):
+        raise ValueError('{} is outside the observed dates'.format(date))
+
+    # Region x target selection matrix summing each target's comparisons
+    selection = np.zeros((len(regions), len(targets)))
+    for k, cs in enumerate(comparisons):
+        selection[[regions.index(c) for c in cs], k] = 1
+
+    estimates = estimators.diffindiff_many(
+        dates, counts[:, [regions.index(t) for t in targets]],
+        counts.dot(selection), date, logged=logged, normalize=normalize)
+    return [dict(estimate, target=t, comparisons=cs)
+            for t, cs, estimate in zip(targets, comparisons, estimates)]
+
+@cache.cached(table='escort_ads')
+def causalimpact(target, comparisons, date, logged=False):
+    '''
+    Returns the effect of an event on the target region's ad counts, against
+    a counterfactual predicted from the comparison regions.
+
+    Parameters
+    ----------
+    target : str
+        Target region.
+    comparisons : str or iterable of str
+        Comparison region(s); each is a separate control series.
+    date : str
+        Date string, in the format YYYY-mm-dd
+    logged : bool, optional
+        Log transform the counts before fitting (the default is False).
 
-    return response.content
+    Returns
+    -------
+    dict
+        See `estimators.causal_impact`.
 
+    '''
+    if isinstance(comparisons, basestring):
+        comparisons = [comparisons]
+    comparisons = sorted(set(comparisons) - set([target]))
+    dates, regions, counts = get_panel(comparisons + [target])
+    if not check_panel(dates, date):
+        raise ValueError('{} is outside the observed dates'.format(date))
+
+    return estimators.causal_impact(
+        dates, counts[:, regions.index(target)],
+        counts[:, [regions.index(c) for c in comparisons]], date,
+        logged=logged)
+
+@cache.cached()
 def groupby(table, xs, ys, agg, **kwargs):
     '''
     Returns result of an aggregation function applied to groups.
@@ -180,11 +959,14 @@ def groupby(table, xs, ys, agg, **kwargs):
         Aggregation function name, from list of valid MySQL aggregation
         functions.
     tstart : datetime.datetime, optional
-        Only include entries after `tstart` (the default is to include
-        everything)
+        Only include entries at or after `tstart` (the default is to
+        include everything)
     tend : datetime.datetime, optional
         Only include entries before `tend` (the default is to include
         everything)
+    sample : float, optional
+        Estimate a count, sum or average from a sample of this percentage
+        of the table instead (see `groupby_sample` for their errors).
 
     Returns
     -------
@@ -198,6 +980,10 @@ def groupby(table, xs, ys, agg, **kwargs):
 
     Notes
     -----
+    A single groupable `xs` with day-aligned (or no) time bounds is answered
+    from the daily rollup of that column when one has been built (see
+    `tempus.py rollup`); the bounds then resolve to whole days.
+
     Valid agg function strings:
         AVG -- Return the average value of the argument
         BIT_AND -- Return bitwise and
@@ -224,29 +1010,22 @@ def groupby(table, xs, ys, agg, **kwargs):
     if isinstance(ys, basestring):
         ys = [ys]
 
-    t = tables[table]
-    columns = [getattr(t, x) for x in xs]
-
-    yvars = [getattr(t, y) for y in ys]
-    f = getattr(func, agg)
-
     tstart = kwargs.get('tstart', None)
     tend = kwargs.get('tend', None)
 
-    conds = []
-    if tstart and tend:
-        ts = getattr(t, table_cols[table]['timestamp'])
+    if kwargs.get('sample'):
+        estimates = groupby_sample(table, xs, ys, agg,
+                                   percent=kwargs['sample'], tstart=tstart,
+                                   tend=tend)
+        keys = zip(*[estimates[x] for x in xs])
+        return dict((key, dict((y, estimates[y][i]) for y in ys))
+                    for i, key in enumerate(keys))
 
-        conds = [(ts > tstart), (ts < tend)]
-
-    funcs = [f(y) for y in yvars]
-    q = session.query(*(funcs + columns))
-    for col in columns:
-        q = q.group_by(col)
-
-    for cond in conds:
-        q = q.filter(cond)
+    store = _columnar_store(table, xs + ys, tstart)
+    if store is not None and columnar.supported(agg):
+        return store.groupby(xs, ys, agg, tstart, tend)
 
+    q = _groupby_query(table, xs, ys, agg, tstart, tend)
     counts = q.all()
     countdict = {}
     for row in counts:
@@ -258,6 +1037,67 @@ def groupby(table, xs, ys, agg, **kwargs):
     return countdict
 
 
+def _time_filters(table, tstart=None, tend=None):
+    ''' Returns conditions keeping rows from `tstart` until before `tend` '''
+    ts = getattr(tables[table], table_cols[table]['timestamp'])
+    conds = []
+    if tstart:
+        conds.append(ts >= tstart)
+    if tend:
+        conds.append(ts < tend)
+    return conds
+
+def _groupby_query(table, xs, ys, agg, tstart=None, tend=None):
+    '''
+    Returns the `groupby` query: aggregates labeled by their response
+    variable, followed by the group columns labeled by name.
+    '''
+    q = _groupby_rollup(table, xs, ys, agg, tstart, tend)
+    if q is not None:
+        return q
+
+    t = tables[table]
+    columns = [getattr(t, x).label(x) for x in xs]
+
+    yvars = [getattr(t, y) for y in ys]
+    f = getattr(func, agg)
+
+    funcs = [f(y).label(name) for y, name in zip(yvars, ys)]
+    q = session.query(*(funcs + columns))
+    for col in columns:
+        q = q.group_by(col)
+
+    for cond in _time_filters(table, tstart, tend):
+        q = q.filter(cond)
+
+    return q
+
+
+def _groupby_rollup(table, xs, ys, agg, tstart=None, tend=None):
+    '''
+    Returns a `groupby` query against the daily rollups, or None if the
+    rollups cannot answer it.
+
+    Time bounds resolve to whole days, see `rollup.day_filters`.
+    '''
+    if len(xs) != 1 or not rollup.covers(table, ys, tstart, tend):
+        return None
+    r = rollup.find(table, xs[0])
+    if r is None:
+        return None
+
+    funcs = [rollup.aggregate(r, y, agg) for y in ys]
+    if any(f is None for f in funcs):
+        return None
+    funcs = [f.label(y) for f, y in zip(funcs, ys)]
+
+    group = r.c[xs[0]]
+    q = session.query(*(funcs + [group])).group_by(group)
+    for cond in rollup.day_filters(r, tstart, tend):
+        q = q.filter(cond)
+    return q
+
+
 def groupdo(table, yn, *aggs, **kwargs):
     '''
     Returns result of an aggregation function applied to the entire population.
@@ -272,8 +1112,8 @@ def groupdo(table, yn, *aggs, **kwargs):
         Aggregation function names, from list of valid MySQL aggregation
         functions.
     tstart : datetime.datetime, optional
-        Only include entries after `tstart` (the default is to include
-        everything)
+        Only include entries at or after `tstart` (the default is to
+        include everything)
     tend : datetime.datetime, optional
         Only include entries before `tend` (the default is to include
         everything)
@@ -291,6 +1131,8 @@ def groupdo(table, yn, *aggs, **kwargs):
 
     Notes
     -----
+    Like `groupby`, this is answered from a daily rollup when possible.
+
     Valid agg function strings:
         AVG -- Return the average value of the argument
         BIT_AND -- Return bitwise and
@@ -315,21 +1157,28 @@ def groupdo(table, yn, *aggs, **kwargs):
     logger.debug('Executing groupdo: kwargs={}'.format(kwargs))
     t = tables[table]
 
-    fs = [getattr(func, agg) for agg in aggs]
-    y = getattr(t, yn)
-
     tstart = kwargs.get('tstart', None)
     tend = kwargs.get('tend', None)
 
-    conds = []
-    if tstart and tend:
-        ts = getattr(t, table_cols[table]['timestamp'])
+    store = _columnar_store(table, [yn], tstart)
+    if store is not None and all(columnar.supported(agg) for agg in aggs):
+        return store.groupdo(yn, aggs, tstart, tend)
 
-        conds = [(ts > tstart), (ts < tend)]
+    r = rollup.find(table)
+    if r is not None and rollup.covers(table, [yn], tstart, tend):
+        funcs = [rollup.aggregate(r, yn, agg) for agg in aggs]
+        if all(f is not None for f in funcs):
+            q = session.query(*funcs)
+            for cond in rollup.day_filters(r, tstart, tend):
+                q = q.filter(cond)
+            return q.all()
+
+    fs = [getattr(func, agg) for agg in aggs]
+    y = getattr(t, yn)
 
     q = session.query(*[f(y) for f in fs])
 
-    for cond in conds:
+    for cond in _time_filters(table, tstart, tend):
         q = q.filter(cond)
 
     aggs = q.all()
@@ -337,7 +1186,421 @@ def groupdo(table, yn, *aggs, **kwargs):
     return aggs
 
 
-def outliers(table, x, y, **kwargs):
+GROUPINGS = ('sets', 'rollup', 'cube')
+
+# Aggregates `aggregate` adds to those of `bucket_aggregate`
+SPEC_AGGREGATES = {
+    'stddev': func.stddev_samp,
+    'stddev_pop': func.stddev_pop,
+    'variance': func.var_samp,
+    'var_pop': func.var_pop,
+    'count_distinct': lambda col: func.count(sqlalchemy.distinct(col)),
+}
+
+FILTER_OPS = ('=', '!=', '<', '<=', '>', '>=', 'in', 'not in', 'null',
+              'not null')
+
+def _spec_aggregate(col, how):
+    ''' Returns the SQL aggregate of an `aggregate` spec '''
+    if col is None:
+        if how.lower() != 'count':
+            raise ValueError('Only count applies to *')
+        return func.count()
+    if how.lower() in SPEC_AGGREGATES:
+        return SPEC_AGGREGATES[how.lower()](col)
+    return bucket_aggregate(col, how)
+
+def _filter(col, op, value):
+    ''' Returns the condition of an `aggregate` filter '''
+    if op == 'null':
+        return col == None
+    if op == 'not null':
+        return col != None
+    if op == 'in':
+        return col.in_(value)
+    if op == 'not in':
+        return ~col.in_(value)
+    ops = {'=': col.__eq__, '!=': col.__ne__, '<': col.__lt__,
+           '<=': col.__le__, '>': col.__gt__, '>=': col.__ge__}
+    if op not in ops:
+        raise ValueError('Unknown filter operator {}'.format(op))
+    return ops[op](value)
+
+@cache.cached()
+def aggregate(table, by=(), specs=(('*', 'count'),), bucket=None,
+              filters=(), start=None, end=None, grouping=None):
+    '''
+    Computes several aggregates of several columns per group in one query.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    by : iterable of str, optional
+        Groupable columns to group by (the default aggregates every row
+        together).
+    specs : iterable of (str, str), optional
+        (column, aggregate) pairs. Columns are covariates (or the price), or
+        '*' for `count` of rows, the default. Aggregates are those of `get`
+        and 'stddev', 'stddev_pop', 'variance', 'var_pop' and
+        'count_distinct'.
+    bucket : {'hour', 'day', 'week', 'month'}, optional
+        Also group by time bucket.
+    filters : iterable of (str, str, object), optional
+        (column, operator, value) conditions rows must meet, with operator
+        one of `FILTER_OPS`; 'in' and 'not in' take a list, 'null' and
+        'not null' ignore the value.
+    start : datetime.datetime, optional
+        Only include entries at or after `start`.
+    end : datetime.datetime, optional
+        Only include entries before `end`.
+    grouping : {'sets', 'rollup', 'cube'}, optional
+        Also aggregate over subsets of `by`: each column on its own plus the
+        total ('sets'), each prefix of `by` ('rollup') or every combination
+        ('cube'). The time bucket is always kept.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Columnar result: `t` (with `bucket`), one list per `by` column,
+        `grouping_id` (with `grouping`; bit i, counting from the last column
+        of `by`, is set where that column was aggregated over) and one per
+        spec, named '<column>_<aggregate>' ('count' for '*').
+
+    '''
+    if isinstance(by, basestring):
+        by = [by]
+    by, specs = list(by), [tuple(spec) for spec in specs]
+    cols = table_cols[table]
+    measures = set(cols['covariates'] + [cols['price']])
+    filterable = measures | set(cols['groupable'] + [cols['timestamp']])
+    for x in by:
+        if x not in cols['groupable']:
+            raise ValueError('Column {} not in table {} groupable'.format(
+                x, table))
+    for col, how in specs:
+        if col != '*' and col not in measures:
+            raise ValueError('Column {} not in table {} covariates'.format(
+                col, table))
+    if not specs:
+        raise ValueError('No aggregates given')
+    if bucket is not None and bucket not in BUCKETS:
+        raise ValueError('Unknown bucket {}'.format(bucket))
+    if grouping is not None and grouping not in GROUPINGS:
+        raise ValueError('Unknown grouping {}'.format(grouping))
+    if grouping and not by:
+        raise ValueError('Grouping {} needs columns to group by'.format(
+            grouping))
+
+    t = tables[table]
+    groups = [getattr(t, x).label(x) for x in by]
+    names = ['{}_{}'.format(col, how.lower()) if col != '*' else 'count'
+             for col, how in specs]
+    aggs = [_spec_aggregate(None if col == '*' else getattr(t, col), how)
+            .label(name) for (col, how), name in zip(specs, names)]
+
+    keys = []
+    if bucket:
+        ts = getattr(t, cols['timestamp'])
+        keys.append(func.date_trunc(bucket, ts).label('t'))
+    if grouping is None:
+        group_by = keys + groups
+    else:
+        plain = [getattr(t, x) for x in by]
+        keys.append(func.grouping(*plain).label('grouping_id'))
+        if grouping == 'sets':
+            quote = engine.dialect.identifier_preparer.quote
+            group_by = [sqlalchemy.literal_column('GROUPING SETS ({}, ())'
+                .format(', '.join('({})'.format(quote(x)) for x in by)))]
+        else:
+            group_by = [getattr(func, grouping)(*plain)]
+        if bucket:
+            group_by.insert(0, keys[0])
+
+    q = sqlalchemy.select(keys + groups + aggs)
+    if group_by:
+        q = q.group_by(*group_by).order_by(*(keys[:1] if bucket else []) +
+                                             [getattr(t, x) for x in by])
+    for col, op, value in filters:
+        if col not in filterable:
+            raise ValueError('Column {} not in table {}'.format(col, table))
+        q = q.where(_filter(getattr(t, col), op, value))
+    for cond in _time_filters(table, start, end):
+        q = q.where(cond)
+
+    result = collections.OrderedDict(
+        (c, []) for c in (['t'] if bucket else []) + by +
+        (['grouping_id'] if grouping else []) + names)
+    for row in read_engine.execute(q):
+        if bucket:
+            result['t'].append(str(row['t']))
+        for x in by:
+            result[x].append(row[x])
+        if grouping:
+            result['grouping_id'].append(row['grouping_id'])
+        for name in names:
+            value = row[name]
+            result[name].append(None if value is None else float(value))
+    return result
+
+SAMPLE_METHODS = ('bernoulli', 'system')
+
+# Aggregates `groupby_sample` estimates from a sample
+SAMPLE_AGGREGATES = ('count', 'sum', 'avg')
+
+@cache.cached()
+def groupby_sample(table, xs, ys, agg='count', percent=1, method='bernoulli',
+                   seed=None, tstart=None, tend=None):
+    '''
+    Estimates a `groupby` count, sum or average from a TABLESAMPLE of the
+    table, with the standard error of each estimate.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    xs : str or iterable of str
+        Groupable column(s) to group by.
+    ys : str or iterable of str
+        Response variable(s); counts are of their non-null values.
+    agg : {'count', 'sum', 'avg'}, optional
+        Aggregate to estimate.
+    percent : float, optional
+        Percentage of the table sampled, in (0, 100].
+    method : {'bernoulli', 'system'}, optional
+        'bernoulli' samples rows, 'system' whole pages, which is faster
+        but less random.
+    seed : int, optional
+        Repeat the same sample (REPEATABLE); the default samples anew.
+    tstart : datetime.datetime, optional
+        Only include entries at or after `tstart`.
+    tend : datetime.datetime, optional
+        Only include entries before `tend`.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Columnar result: one list per `xs` column, `n` (rows sampled in the
+        group), and per response its estimate and '<y>_stderr'.
+
+    Notes
+    -----
+    With sampling fraction f and the n sampled values y of a group,
+
+        count   n / f               stderr  sqrt(n (1 - f)) / f
+        sum     sum(y) / f          stderr  sqrt((1 - f) sum(y^2)) / f
+        avg     sum(y) / n          stderr  s sqrt(1 - f) / sqrt(n)
+
+    The errors assume rows are sampled independently; under 'system' they
+    are understated when values cluster in pages (e.g. rows of a group
+    inserted together). Groups missing from the sample are missing from the
+    result.
+
+    '''
+    if isinstance(xs, basestring):
+        xs = [xs]
+    if isinstance(ys, basestring):
+        ys = [ys]
+    xs, ys = list(xs), list(ys)
+    cols = table_cols[table]
+    for x in xs:
+        if x not in cols['groupable']:
+            raise ValueError('Column {} not in table {} groupable'.format(
+                x, table))
+    for y in ys:
+        if y not in cols['covariates'] + [cols['price']]:
+            raise ValueError('Column {} not in table {} covariates'.format(
+                y, table))
+    agg = agg.lower()
+    if agg not in SAMPLE_AGGREGATES:
+        raise ValueError('Cannot estimate {} from a sample'.format(agg))
+    if method not in SAMPLE_METHODS:
+        raise ValueError('Unknown sampling method {}'.format(method))
+    percent = float(percent)
+    if not 0 < percent <= 100:
+        raise ValueError('Sample percent must be in (0, 100]')
+    f = percent / 100
+
+    # The sampled table is a FROM clause of its own, so its columns are
+    # referred to unqualified
+    source = '{} TABLESAMPLE {}({!r})'.format(
+        engine.dialect.identifier_preparer.format_table(
+            tables[table].__table__), method.upper(), percent)
+    if seed is not None:
+        source += ' REPEATABLE({:d})'.format(int(seed))
+    groups = [sqlalchemy.column(x) for x in xs]
+    stats = [func.count()]
+    for y in ys:
+        v = sqlalchemy.column(y)
+        stats += [func.count(v), func.sum(v), func.sum(v * v)]
+    q = sqlalchemy.select(groups + stats)\
+        .select_from(sqlalchemy.text(source))
+    if groups:
+        q = q.group_by(*groups)
+    ts = sqlalchemy.column(cols['timestamp'])
+    if tstart:
+        q = q.where(ts >= tstart)
+    if tend:
+        q = q.where(ts < tend)
+
+    result = collections.OrderedDict((c, []) for c in xs + ['n'])
+    for y in ys:
+        result[y] = []
+        result['{}_stderr'.format(y)] = []
+    with metrics.phase('compute'):
+        for row in read_engine.execute(q):
+            row = list(row)
+            for x, value in zip(xs, row):
+                result[x].append(value)
+            result['n'].append(row[len(xs)])
+            for i, y in enumerate(ys):
+                n, total, squares = row[len(xs) + 1 + 3 * i:
+                                        len(xs) + 4 + 3 * i]
+                total = float(total or 0)
+                squares = float(squares or 0)
+                if agg == 'count':
+                    estimate = n / f
+                    stderr = math.sqrt(n * (1 - f)) / f
+                elif agg == 'sum':
+                    estimate = total / f
+                    stderr = math.sqrt((1 - f) * squares) / f
+                elif not n:
+                    estimate = stderr = None
+                else:
+                    estimate = total / n
+                    stderr = None if n < 2 else math.sqrt(
+                        max(squares - total * total / n, 0) / (n - 1) *
+                        (1 - f) / n)
+                result[y].append(estimate)
+                result['{}_stderr'.format(y)].append(stderr)
+    return result
+
+def _sketches(table, group_col, column, start, end, groups):
+    ''' Returns {group: sketch} of a sketch column, if they are built '''
+    if not sketches.available(table, group_col):
+        raise ValueError('No sketches of {}{}; run `tempus.py sketches`'
+                         .format(table, ' per ' + group_col if group_col
+                                 else ''))
+    with metrics.phase('sketches'):
+        return sketches.load(table, group_col, column, start, end, groups)
+
+@cache.cached()
+def distinct_count(table, col, group_col=None, groups=None, start=None,
+                   end=None):
+    '''
+    Estimates the number of distinct values of a groupable column, per
+    group, from its daily HyperLogLog sketches (see `tempus.py sketches`).
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    col : str
+        Groupable column whose distinct values are counted.
+    group_col : str, optional
+        Another groupable column to count per group of (the default counts
+        over the whole table).
+    groups : list of str, optional
+        Only these groups (the default is every group).
+    start : datetime.datetime, optional
+        First day included; time bounds resolve to whole days.
+    end : datetime.datetime, optional
+        Day after the last one included.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Columnar result: `group_col` (when given), `estimate`, and the
+        `low` and `high` bounds of its 95% interval.
+
+    '''
+    if col not in sketches.distinct_columns(table, group_col):
+        raise ValueError('Column {} not in table {} groupable{}'.format(
+            col, table, ' (other than ' + group_col + ')' if group_col
+            else ''))
+    if group_col is not None and \
+            group_col not in table_cols[table]['groupable']:
+        raise ValueError('Column {} not in table {} groupable'.format(
+            group_col, table))
+
+    merged = _sketches(table, group_col, sketches.hll_col(col), start, end,
+                       groups)
+    keys = sorted(merged) if group_col else [None]
+    result = collections.OrderedDict(
+        (c, []) for c in ([group_col] if group_col else []) +
+        ['estimate', 'low', 'high'])
+    for key in keys:
+        hll = merged.get(key)
+        estimate = hll.count() if hll is not None else 0.
+        margin = 1.96 * hll.relative_error() * estimate if hll else 0.
+        if group_col:
+            result[group_col].append(key)
+        result['estimate'].append(estimate)
+        result['low'].append(max(estimate - margin, 0.))
+        result['high'].append(estimate + margin)
+    return result
+
+@cache.cached()
+def quantiles(table, response_col, qs=(0.5,), group_col=None, groups=None,
+              start=None, end=None):
+    '''
+    Estimates quantiles of a response variable, per group, from its daily
+    DDSketches (see `tempus.py sketches`).
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    response_col : str
+        Response variable.
+    qs : iterable of float, optional
+        Quantiles, in [0, 1] (the default is the median).
+    group_col : str, optional
+        Groupable column to estimate per group of (the default is over the
+        whole table).
+    groups : list of str, optional
+        Only these groups (the default is every group).
+    start : datetime.datetime, optional
+        First day included; time bounds resolve to whole days.
+    end : datetime.datetime, optional
+        Day after the last one included.
+
+    Returns
+    -------
+    collections.OrderedDict
+        Columnar result: `group_col` (when given), `n` (values counted), and
+        one list per quantile named 'p<100 q>' (e.g. 'p95'). Every estimate
+        is within `sketches.accuracy` of the true quantile, relatively.
+
+    '''
+    qs = [float(q) for q in qs]
+    if not qs or any(not 0 <= q <= 1 for q in qs):
+        raise ValueError('Quantiles must be in [0, 1]')
+    cols = table_cols[table]
+    if response_col not in cols['covariates'] + [cols['price']]:
+        raise ValueError('Column {} not in table {} covariates'.format(
+            response_col, table))
+    if group_col is not None and group_col not in cols['groupable']:
+        raise ValueError('Column {} not in table {} groupable'.format(
+            group_col, table))
+
+    merged = _sketches(table, group_col, sketches.dd_col(response_col),
+                       start, end, groups)
+    keys = sorted(merged) if group_col else [None]
+    names = ['p{:g}'.format(100 * q) for q in qs]
+    result = collections.OrderedDict(
+        (c, []) for c in ([group_col] if group_col else []) + ['n'] + names)
+    for key in keys:
+        dd = merged.get(key)
+        if group_col:
+            result[group_col].append(key)
+        result['n'].append(dd.count() if dd is not None else 0)
+        for name, q in zip(names, qs):
+            result[name].append(dd.quantile(q) if dd is not None else None)
+    return result
+
+@cache.cached()
+def outliers(table, x, y, method='stddev', threshold=None, **kwargs):
     '''
     Finds outliers of a response variable to a baseline.
 
@@ -353,9 +1616,14 @@ def outliers(table, x, y, **kwargs):
     y : str, optional
         Response variable to send to the aggregate function (the default is
         `price_col` in the Tempus configuration file).
+    method : {'stddev', 'mad', 'iqr'}, optional
+        How to flag outliers, see Notes (the default is 'stddev').
+    threshold : float, optional
+        Multiplier on the spread, see Notes (the default is 2 for 'stddev',
+        3 for 'mad' and 1.5 for 'iqr').
     tstart : datetime.datetime, optional
-        Only include entries after `tstart` (the default is to include
-        everything)
+        Only include entries at or after `tstart` (the default is to
+        include everything)
     tend : datetime.datetime, optional
         Only include entries before `tend` (the default is to include
         everything)
@@ -371,9 +1639,16 @@ def outliers(table, x, y, **kwargs):
 
     Notes
     -----
-    The outlier is defined as a value 2 standard deviations away from the mean.
+    With 'stddev', the outlier is defined as a group average `threshold`
+    standard deviations away from the population mean. 'mad' flags group
+    averages more than `threshold` scaled median absolute deviations from
+    the median group average, and 'iqr' those more than `threshold`
+    interquartile ranges outside the quartiles of the group averages.
     Thus this function is only suitable for continuous variables.
 
+    Group and population statistics are computed in a single scan of the
+    table (or its daily rollup), and only the flagged groups are returned.
+
     '''
 
     if x not in table_cols[table]['groupable']:
@@ -383,22 +1658,160 @@ def outliers(table, x, y, **kwargs):
     if y not in table_cols[table]['covariates']:
         raise ValueError('Column {} not in table {} covariates'.format(y,
                                                                       table))
-    # Get average and standard deviation from data
-    avg, std = groupdo(table, y, 'AVG', 'STDDEV', **kwargs)[0]
+    tstart = kwargs.get('tstart', None)
+    tend = kwargs.get('tend', None)
 
-    avgs = groupby(table, x, y, 'AVG', **kwargs)
-    outliers = {}
+    store = _columnar_store(table, [x, y], tstart)
+    if store is not None:
+        groups, means, values = store.group_means(x, y, tstart, tend)
+        lo, hi = _outlier_bounds_array(means, method, threshold,
+                                       values if method == 'stddev' else None)
+        flagged = (means < lo) | (means > hi)
+        return dict((g, float(m)) for g, m, f in zip(groups, means, flagged)
+                    if f)
+
+    g = _group_moments(table, x, y, tstart, tend).cte('g')
+    v = sqlalchemy.select([g.c.grp, (g.c.total / g.c.n).label('value')])\
+            .where(g.c.n > 0).cte('v')
+    # The standard deviation baseline is the population's, not the groups'
+    bounds = _outlier_bounds(v, method, threshold,
+                             moments=g if method == 'stddev' else None)
 
-    logger.debug('Groupdo results: avg {}, std {}'.format(avg, std))
-    logger.debug('Length of outlier averages: {}'.format(len(avgs)))
-    for group in avgs:
-        if avgs[group][y] and abs(avgs[group][y] - avg) > 2*std:
-            outliers[group[0]] = float(avgs[group][y])
+    outliers = {}
+    for group, value in read_engine.execute(_outlier_select(v, [v.c.grp],
+                                                        bounds)):
+        outliers[group] = float(value)
 
+    logger.debug('Number of outliers: {}'.format(len(outliers)))
     return outliers
 
 
-def outlier_in(table, xs, agg, y=None, **kwargs):
+def _group_moments(table, x, y, tstart=None, tend=None):
+    '''
+    Returns a SELECT of (grp, n, total, sumsq) of `y` per `x` group, from
+    the daily rollup when it can answer.
+    '''
+    r = rollup.find(table, x)
+    if r is not None and rollup.covers(table, [y], tstart, tend):
+        stat = lambda s: r.c[rollup.stat_col(y, s)]
+        q = sqlalchemy.select([
+            r.c[x].label('grp'),
+            func.sum(stat('n')).label('n'),
+            func.sum(stat('sum')).label('total'),
+            func.sum(stat('sumsq')).label('sumsq'),
+        ]).group_by(r.c[x])
+        for cond in rollup.day_filters(r, tstart, tend):
+            q = q.where(cond)
+        return q
+
+    t = tables[table]
+    group = getattr(t, x)
+    yvar = sqlalchemy.cast(getattr(t, y), sqlalchemy.Float)
+    q = sqlalchemy.select([
+        group.label('grp'),
+        func.count(yvar).label('n'),
+        func.sum(yvar).label('total'),
+        func.sum(yvar * yvar).label('sumsq'),
+    ]).group_by(group)
+
+    for cond in _time_filters(table, tstart, tend):
+        q = q.where(cond)
+    return q
+
+
+OUTLIER_THRESHOLDS = {'stddev': 2, 'mad': 3, 'iqr': 1.5}
+
+def _percentile(quantile, expr):
+    return sqlalchemy.literal_column(
+        'percentile_cont({!r}) WITHIN GROUP (ORDER BY {})'.format(quantile,
+                                                                  expr),
+        sqlalchemy.Float)
+
+def _outlier_bounds(v, method, threshold=None, moments=None):
+    '''
+    Returns a one-row CTE of (lo, hi) outlier bounds for `v.c.value`.
+
+    With `moments`, a CTE of per-group (n, total, sumsq), the 'stddev'
+    bounds use the population moments they add up to.
+    '''
+    if method not in OUTLIER_THRESHOLDS:
+        raise ValueError('Unknown outlier method {}'.format(method))
+    k = OUTLIER_THRESHOLDS[method] if threshold is None else threshold
+
+    if method == 'stddev':
+        if moments is None:
+            center = func.avg(v.c.value)
+            spread = func.stddev_pop(v.c.value)
+            source = v
+        else:
+            n = func.sum(moments.c.n)
+            total = func.sum(moments.c.total)
+            center = total / func.nullif(n, 0)
+            spread = func.sqrt(func.greatest(
+                func.sum(moments.c.sumsq) - total * total / func.nullif(n, 0),
+                0) / func.nullif(n - 1, 0))
+            source = moments
+        bounds = sqlalchemy.select([(center - k * spread).label('lo'),
+                                    (center + k * spread).label('hi')])\
+                .select_from(source)
+
+    elif method == 'mad':
+        med = sqlalchemy.select([_percentile(0.5, v.c.value).label('m')])\
+                .select_from(v).cte('med')
+        # 1.4826 scales the MAD to a standard deviation under normality
+        spread = sqlalchemy.literal(1.4826) * _percentile(
+            0.5, 'abs({} - {})'.format(v.c.value, med.c.m))
+        center = func.min(med.c.m)
+        bounds = sqlalchemy.select([(center - k * spread).label('lo'),
+                                    (center + k * spread).label('hi')])\
+                .select_from(v).select_from(med)
+
+    else:
+        q1 = _percentile(0.25, v.c.value)
+        q3 = _percentile(0.75, v.c.value)
+        bounds = sqlalchemy.select([(q1 - k * (q3 - q1)).label('lo'),
+                                    (q3 + k * (q3 - q1)).label('hi')])\
+                .select_from(v)
+
+    return bounds.cte('bounds')
+
+def _outlier_bounds_array(values, method, threshold=None, population=None):
+    '''
+    Returns the (lo, hi) outlier bounds of an array of values, as
+    `_outlier_bounds` computes them in SQL; with `population`, the 'stddev'
+    bounds use its moments instead.
+    '''
+    if method not in OUTLIER_THRESHOLDS:
+        raise ValueError('Unknown outlier method {}'.format(method))
+    k = OUTLIER_THRESHOLDS[method] if threshold is None else threshold
+
+    if method == 'stddev':
+        source = values if population is None else population
+        if len(source) < 2:
+            return np.nan, np.nan
+        center = source.mean()
+        spread = source.std(ddof=0 if population is None else 1)
+        return center - k * spread, center + k * spread
+    if not len(values):
+        return np.nan, np.nan
+    if method == 'mad':
+        med = np.median(values)
+        spread = 1.4826 * np.median(np.abs(values - med))
+        return med - k * spread, med + k * spread
+    q1, q3 = np.percentile(values, [25, 75])
+    return q1 - k * (q3 - q1), q3 + k * (q3 - q1)
+
+def _outlier_select(v, keys, bounds, upper_only=False):
+    ''' Returns a SELECT of `keys` and value for rows of `v` out of bounds '''
+    cond = v.c.value > bounds.c.hi
+    if not upper_only:
+        cond = sqlalchemy.or_(v.c.value < bounds.c.lo, cond)
+    return sqlalchemy.select(keys + [v.c.value]).select_from(v)\
+            .select_from(bounds).where(cond)
+
+
+def outlier_in(table, xs, agg, y=None, method='stddev', threshold=None,
+               **kwargs):
     '''
     Finds outliers in a table aggregation.
 
@@ -416,9 +1829,13 @@ def outlier_in(table, xs, agg, y=None, **kwargs):
     agg : str
         Aggregation function name, from list of valid MySQL aggregation
         functions.
+    method : {'stddev', 'mad', 'iqr'}, optional
+        How to flag outliers, see `outliers` (the default is 'stddev').
+    threshold : float, optional
+        Multiplier on the spread, see `outliers`.
     tstart : datetime.datetime, optional
-        Only include entries after `tstart` (the default is to include
-        everything)
+        Only include entries at or after `tstart` (the default is to
+        include everything)
     tend : datetime.datetime, optional
         Only include entries before `tend` (the default is to include
         everything)
@@ -434,7 +1851,9 @@ def outlier_in(table, xs, agg, y=None, **kwargs):
 
     Notes
     -----
-    The outlier is defined as a value 2 standard deviations away from the mean.
+    With 'stddev', the outlier is defined as a value 2 standard deviations
+    above the mean of the aggregated values; the robust methods flag values
+    above the upper bound described in `outliers`.
     Thus this function is only suitable for continuous variables.
 
     Valid agg function strings:
@@ -459,19 +1878,22 @@ def outlier_in(table, xs, agg, y=None, **kwargs):
 
     '''
     y = y or table_cols[table]['price']
-    results = groupby(table, xs, y, agg, **kwargs)
-    outliers = []
+    if isinstance(xs, basestring):
+        xs = [xs]
 
-    resps = [results[j][y] for j in results]
-    avg, std = np.mean(resps), np.std(resps)
+    grouped = _groupby_query(table, xs, [y], agg, kwargs.get('tstart', None),
+                             kwargs.get('tend', None)).subquery('grouped')
+    v = sqlalchemy.select([grouped.c[x] for x in xs] +
+                          [grouped.c[y].label('value')]).cte('v')
+    bounds = _outlier_bounds(v, method, threshold)
 
-    logger.debug('outlier_in: {}, {}, avg: {}, std: {}'.format(y, agg, avg,
-                                                               std))
     outliers = []
-    for r in results:
-        if results[r][y] > avg + 2*std:
-            outliers.append((r, results[r][y]))
+    q = _outlier_select(v, [v.c[x] for x in xs], bounds, upper_only=True)
+    for row in read_engine.execute(q):
+        outliers.append((tuple(row[:-1]), row[-1]))
 
+    logger.debug('outlier_in: {}, {}, {} outliers'.format(y, agg,
+                                                          len(outliers)))
     return outliers
 
 if __name__ == '__main__':
@@ -481,15 +1903,6 @@ if __name__ == '__main__':
 
     print(o)
 
-def concatenate_list(value):
-    for i in range(0, len(value)):
-        if i == 0:
-            new_value = '\'' + value[i] + '\''
-        else:
-            new_value += ', \'' + value[i] + '\''
-
-    return new_value
-
 def get_comparison_dictionary(comparisons):
     comparison_dictionary = []
     for i in range(0, len(comparisons)):
@@ -497,12 +1910,84 @@ def get_comparison_dictionary(comparisons):
 
     return comparison_dictionary
 
-def get_period_range(msanames):
-    regions = concatenate_list(msanames)
-    select_statement = 'SELECT max(to_char(timestamp, \'YYYY-MM-dd\')) AS max, min(to_char(timestamp, \'YYYY-MM-dd\')) AS min FROM escort_ads WHERE msaname IN (' + regions + ')'
-    df = pandas.read_sql_query(select_statement, con=engine)
-    period = pandas.date_range(df['min'][0], df['max'][0], freq = 'd')
-    return period
+def get_panel(regions, table='escort_ads', group_col='msaname'):
+    '''
+    Returns daily row counts of several groups as a dense date x group matrix.
+
+    All groups are fetched with a single query and pivoted in one pass, so
+    the cost does not grow with a round trip per group.
+
+    Parameters
+    ----------
+    regions : iterable of str
+        Groups (e.g. MSA names) to include, in column order. Duplicates are
+        dropped.
+    table : str, optional
+        Tempus table name (the default is 'escort_ads').
+    group_col : str, optional
+        Groupable column holding `regions` (the default is 'msaname').
+
+    Returns
+    -------
+    dates : numpy.ndarray
+        Every day, as datetime64[D], between the first and last observation
+        of any of the groups.
+    regions : list of str
+        Column labels of `counts`.
+    counts : numpy.ndarray
+        Matrix of shape (len(dates), len(regions)); days without rows are 0.
+
+    '''
+    if group_col not in table_cols[table]['groupable']:
+        raise ValueError('Column {} not in table {} groupable'.format(
+            group_col, table))
+
+    regions = list(collections.OrderedDict.fromkeys(regions))
+    r = rollup.find(table, group_col)
+    if r is not None:
+        select_statement = sqlalchemy.select(
+            [r.c[group_col], r.c.day, r.c.rows])\
+            .where(r.c[group_col].in_(regions))
+        rows = read_engine.execute(select_statement).fetchall()
+    else:
+        select_statement = sqlalchemy.text(
+            'SELECT {group} AS region, CAST({ts} AS DATE) AS day, count(*) AS counts'
+            ' FROM {table} WHERE {group} = ANY(:regions)'
+            ' GROUP BY region, day'.format(group=group_col, table=table,
+                                           ts=table_cols[table]['timestamp']))
+        rows = read_engine.execute(select_statement,
+                                   regions=regions).fetchall()
+
+    if not rows:
+        return (np.array([], dtype='datetime64[D]'), regions,
+                np.zeros((0, len(regions)), dtype=np.int64))
+
+    with metrics.phase('transform'):
+        names, days, n = zip(*rows)
+        days = np.array(days, dtype='datetime64[D]')
+        start = days.min()
+        dates = np.arange(start, days.max() + 1)
+
+        column = dict((r, i) for i, r in enumerate(regions))
+        counts = np.zeros((len(dates), len(regions)), dtype=np.int64)
+        counts[(days - start).astype(np.int64),
+               [column[name] for name in names]] = n
+
+    return dates, regions, counts
+
+def panel_frame(dates, regions, counts):
+    ''' Melts a `get_panel` matrix into a long (date, region, counts) frame '''
+    with metrics.phase('transform'):
+        return pandas.DataFrame({
+            'date': np.tile(dates, len(regions)).astype('datetime64[ns]'),
+            'region': np.repeat(regions, len(dates)),
+            'counts': counts.T.ravel(),
+        }, columns=['date', 'region', 'counts'])
+
+def check_panel(dates, event_date):
+    # Check to ensure there is data before and after the event date
+    event_date = np.datetime64(event_date, 'D')
+    return bool((dates < event_date).any() and (dates >= event_date).any())
 
 def check_dataframe(dataframe, event_date):
     # Check to ensure there is data before and after the event date
@@ -515,28 +2000,4 @@ def check_dataframe(dataframe, event_date):
         return False
 
 def get_diffindiff_data(msanames):
-    period = get_period_range(msanames)
-    dataframes = []
-
-    for msaname in msanames:
-        select_statement = 'SELECT msaname AS region, to_char(timestamp, \'YYYY-MM-dd\') AS date, count(*) AS counts FROM escort_ads WHERE msaname = \'' + msaname + '\' GROUP BY region, date ORDER BY date'
-        df = pandas.read_sql_query(select_statement, con=engine)
-
-        # Make the date column of type datetime
-        df['date'] = pandas.to_datetime(df['date'])
-        # Now make the column a period, we had to make it a datetime before making it a period
-        #df['date'] = df['date'].dt.to_period('d')
-        # Now make the date column the index
-        df = df.set_index('date')
-        # Reindex the columns, this will fill in 0's for where there aren't any values
-        df = df.reindex(index = period, columns = ['region', 'counts'], fill_value = 0)
-        # This also makes the region column equal 0 where there is no value, so we need to put the correct value there
-        df['region'] = msaname
-        df = df.reset_index()
-        df.columns = ['date', 'region', 'counts']
-        dataframes.append(df)
-
-    # Now we concat all the frames
-    result = pandas.concat(dataframes)
-    return result
-
+    return panel_frame(*get_panel(msanames))
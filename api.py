@@ -1,11 +1,24 @@
 from functools import wraps
-from flask import Flask, make_response, request, jsonify, abort
-from initdb import tables, session, table_cols, table_conf
+from flask import Flask, Response, make_response, request, jsonify, abort, \
+    stream_with_context, g
+from initdb import tables, session, table_cols, table_conf, conf, \
+    start_time_ranges
 from sqlalchemy.exc import DataError, SQLAlchemyError
 import agg
+import cache
+import changepoint
+import collections
+import columnar
+import dictionary
+import indexes
+import jobs
 import json
+import metrics
+import serialize
+import downsample
 import logging
 import sys
+import time
 from jsonschema import validate
 from jsonschema.exceptions import ValidationError
 from flask.ext.cors import CORS
@@ -17,6 +30,72 @@ logging.basicConfig()
 app = Flask(__name__)
 cors = CORS(app)
 
+@app.before_first_request
+def start_background():
+    # Started once serving, not on import, so scripts importing the API
+    # (and processes forked before serving) do not run them
+    start_time_ranges()
+    columnar.start()
+
+@app.before_request
+def start_timer():
+    g.start = time.time()
+    metrics.context.endpoint = request.endpoint
+
+@app.after_request
+def observe_request(response):
+    metrics.request_seconds.observe(time.time() - g.start, request.endpoint,
+                                    response.status_code)
+    return response
+
+responses_conf = conf.get('responses') or {}
+
+@app.after_request
+def compress_response(response):
+    # Registered last, so it runs before the request is observed
+    if response.status_code != 200 or response.direct_passthrough or \
+            response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    encoding = next((e for e in ('gzip', 'deflate')
+                     if request.accept_encodings[e] > 0), None)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < responses_conf.get('compress_min_bytes', 1024):
+        return response
+    with metrics.phase('compress'):
+        response.set_data(serialize.compress(
+            data, encoding, responses_conf.get('compress_level', 6)))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def columns_response(t, v, **extra):
+    '''
+    Returns a series of epoch millisecond timestamps `t` and values `v` as
+    `{"t": [...], "v": [...]}` JSON, or in a binary encoding the client
+    asks for in its Accept header.
+    '''
+    formats = serialize.column_formats()
+    mimetype = request.accept_mimetypes.best_match(list(formats)) or \
+        'application/json'
+    with metrics.phase('serialize'):
+        body = formats[mimetype](t, v, **extra)
+    return Response(body, mimetype=mimetype)
+
+def wants_columns(data):
+    ''' Whether the client opted in to the columnar layout '''
+    # Binary types must be named; */* does not opt in
+    binary = set(serialize.column_formats()) - set(['application/json'])
+    return data.get('layout') == 'columnar' or any(
+        m in binary and q > 0 for m, q in request.accept_mimetypes)
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    # Return the request's connection to the pool
+    session.remove()
+    metrics.context.endpoint = None
+
 def validate_schema(schema):
     def decorator(f):
         @wraps(f)
@@ -32,6 +111,10 @@ def validate_schema(schema):
         return validation_wrapper
     return decorator
 
+def is_true(value):
+    ''' Parses a boolean query argument '''
+    return str(value).lower() in ('1', 'true', 'yes')
+
 @app.route('/api')
 def api_root():
     ''' GET Tempus configuration file '''
@@ -40,15 +123,505 @@ def api_root():
     return response
 
 
+@app.route('/api/_cache')
+def api_cache_stats():
+    ''' GET result cache hit and miss counters per agg function '''
+    return jsonify(cache.stats())
+
+
+@app.route('/api/_metrics')
+def api_metrics():
+    ''' GET latency histograms in Prometheus text format '''
+    return Response(metrics.exposition(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/_metrics/slow')
+def api_slow_queries():
+    ''' GET recent slow queries and their plans '''
+    return jsonify({'result': metrics.slow()})
+
+
+@app.route('/api/_indexes')
+def api_missing_indexes():
+    ''' GET the indexes the hot queries of the configured tables lack '''
+    return jsonify({'result': [a._asdict() for a in indexes.report()]})
+
+
+@app.route('/api/_columnar')
+def api_columnar_stats():
+    ''' GET rows, memory and watermark of each in-memory table '''
+    return jsonify(columnar.stats())
+
+
+arima_schema = {
+        "title": "ARIMA forecast",
+        "description": "Forecast the bucketed response of a table, or of"\
+                       " every group (or the listed groups) of a groupable"\
+                       " column.",
+        "type": "object",
+        "properties": {
+            "table": {
+                "type": "string"
+                },
+            "response_col": {
+                "type": "string"
+                },
+            "group_col": {
+                "type": "string"
+                },
+            "groups": {
+                "type": "string"
+                },
+            "bucket": {
+                "enum": list(agg.BUCKETS)
+                },
+            "agg": {
+                "type": "string"
+                },
+            "steps": {
+                "type": "string",
+                "pattern": "^[1-9][0-9]*$"
+                },
+            "start": {
+                "type": "string"
+                },
+            "end": {
+                "type": "string"
+                }
+            },
+        "required": ["table", "response_col"]
+        }
 @app.route('/api/arima')
+@validate_schema(arima_schema)
 def api_arima():
-    data['table'], data['response']
+    data = request.args
+    groups = data['groups'].split('|') if 'groups' in data else None
+    try:
+        forecasts = agg.forecast(data['table'], data['response_col'],
+                                 data.get('group_col', None), groups,
+                                 bucket=data.get('bucket', 'day'),
+                                 how=data.get('agg', 'avg'),
+                                 steps=int(data.get('steps', 30)),
+                                 start=data.get('start', None),
+                                 end=data.get('end', None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = make_response(json.dumps(
+        {'result': [dict(group=g, **f) for g, f in forecasts.items()]}))
+    response.mimetype = 'application/json'
+    return response
+
+changepoints_schema = {
+        "title": "Change points",
+        "description": "Find changes in the mean of the bucketed series of"\
+                       " every group (or the listed groups) of a groupable"\
+                       " column. Without a response column, rows are"\
+                       " counted.",
+        "type": "object",
+        "properties": {
+            "table": {
+                "type": "string"
+                },
+            "group_col": {
+                "type": "string"
+                },
+            "response_col": {
+                "type": "string"
+                },
+            "groups": {
+                "type": "string"
+                },
+            "bucket": {
+                "enum": list(agg.BUCKETS)
+                },
+            "agg": {
+                "type": "string"
+                },
+            "method": {
+                "enum": list(changepoint.METHODS)
+                },
+            "penalty": {
+                "type": "string",
+                "pattern": "^[0-9]*\\.?[0-9]+$"
+                },
+            "min_size": {
+                "type": "string",
+                "pattern": "^[1-9][0-9]*$"
+                },
+            "start": {
+                "type": "string"
+                },
+            "end": {
+                "type": "string"
+                }
+            },
+        "required": ["table", "group_col"]
+        }
+@app.route('/api/changepoints')
+@validate_schema(changepoints_schema)
+def api_changepoints():
+    data = request.args
+    groups = data['groups'].split('|') if 'groups' in data else None
+    penalty = data.get('penalty', None)
+    try:
+        changes = agg.changepoints(data['table'], data['group_col'],
+                                   data.get('response_col', None), groups,
+                                   bucket=data.get('bucket', 'day'),
+                                   how=data.get('agg', 'count'),
+                                   method=data.get('method', 'pelt'),
+                                   penalty=penalty and float(penalty),
+                                   min_size=int(data.get('min_size', 2)),
+                                   start=data.get('start', None),
+                                   end=data.get('end', None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = make_response(json.dumps(
+        {'result': [{'group': g, 'changes': c} for g, c in changes.items()]}))
+    response.mimetype = 'application/json'
+    return response
+
+NUMBER = "-?[0-9]*\\.?[0-9]+"
+geo_schema = {
+        "title": "Geospatial aggregate",
+        "description": "Aggregate a response column (or count rows) by the"\
+                       " geography rows are linked to, optionally within a"\
+                       " bounding box (west,south,east,north) or a radius in"\
+                       " km around a center (lat,lon), and per time bucket.",
+        "type": "object",
+        "properties": {
+            "table": {
+                "type": "string"
+                },
+            "response_col": {
+                "type": "string"
+                },
+            "agg": {
+                "type": "string"
+                },
+            "bbox": {
+                "type": "string",
+                "pattern": "^{0},{0},{0},{0}$".format(NUMBER)
+                },
+            "center": {
+                "type": "string",
+                "pattern": "^{0},{0}$".format(NUMBER)
+                },
+            "radius_km": {
+                "type": "string",
+                "pattern": "^[0-9]*\\.?[0-9]+$"
+                },
+            "bucket": {
+                "enum": list(agg.BUCKETS)
+                },
+            "format": {
+                "enum": ["geojson", "columnar"]
+                },
+            "start": {
+                "type": "string"
+                },
+            "end": {
+                "type": "string"
+                }
+            },
+        "required": ["table"]
+        }
+@app.route('/api/geo')
+@validate_schema(geo_schema)
+def api_geo():
+    data = request.args
+    bbox = data.get('bbox', None)
+    center = data.get('center', None)
+    radius_km = data.get('radius_km', None)
+    try:
+        result = agg.spatial_aggregate(
+            data['table'], data.get('response_col', None),
+            how=data.get('agg', 'count'),
+            bbox=bbox and tuple(float(x) for x in bbox.split(',')),
+            center=center and tuple(float(x) for x in center.split(',')),
+            radius_km=radius_km and float(radius_km),
+            bucket=data.get('bucket', None), start=data.get('start', None),
+            end=data.get('end', None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if data.get('format', 'geojson') == 'columnar':
+        payload = result
+    else:
+        payload = {'type': 'FeatureCollection', 'features': geo_features(result)}
+    response = make_response(json.dumps(payload, separators=(',', ':')))
+    response.mimetype = 'application/json'
+    return response
+
+def geo_features(result):
+    '''
+    Returns a GeoJSON point feature per geography of a
+    `agg.spatial_aggregate` result; bucketed values become `t`, `value` and
+    `n` arrays of the feature's properties.
+    '''
+    features = collections.OrderedDict()
+    bucketed = 't' in result
+    for i, geoid in enumerate(result['geoid']):
+        if geoid not in features:
+            props = {'geoid': geoid}
+            if bucketed:
+                props.update(t=[], value=[], n=[])
+            features[geoid] = {
+                'type': 'Feature',
+                'geometry': {'type': 'Point',
+                             'coordinates': [result['lon'][i],
+                                             result['lat'][i]]},
+                'properties': props}
+        props = features[geoid]['properties']
+        if bucketed:
+            for key in ('t', 'value', 'n'):
+                props[key].append(result[key][i])
+        else:
+            props.update(value=result['value'][i], n=result['n'][i])
+    return list(features.values())
+
+aggregate_schema = {
+        "title": "Aggregate",
+        "description": "Compute several aggregates per group (and time"\
+                       " bucket) in one scan. aggs are pipe separated"\
+                       " column:aggregate pairs (*:count counts rows),"\
+                       " filters pipe separated column:operator:value"\
+                       " conditions (comma separated values for in and not"\
+                       " in). grouping adds subtotals over the group"\
+                       " columns.",
+        "type": "object",
+        "properties": {
+            "table": {
+                "type": "string"
+                },
+            "by": {
+                "type": "string"
+                },
+            "aggs": {
+                "type": "string"
+                },
+            "bucket": {
+                "enum": list(agg.BUCKETS)
+                },
+            "filters": {
+                "type": "string"
+                },
+            "grouping": {
+                "enum": list(agg.GROUPINGS)
+                },
+            "start": {
+                "type": "string"
+                },
+            "end": {
+                "type": "string"
+                }
+            },
+        "required": ["table"]
+        }
+@app.route('/api/aggregate')
+@validate_schema(aggregate_schema)
+def api_aggregate():
+    data = request.args
+    by = data['by'].split('|') if data.get('by') else []
+    specs = [spec.split(':', 1) for spec in data.get('aggs', '*:count')
+             .split('|')]
+    filters = []
+    for f in data['filters'].split('|') if data.get('filters') else []:
+        col, op, value = (f.split(':', 2) + [None])[:3]
+        if op in ('in', 'not in'):
+            value = value.split(',')
+        filters.append((col, op, value))
+    try:
+        if any(len(spec) != 2 for spec in specs):
+            raise ValueError('Aggregates are column:aggregate pairs')
+        result = agg.aggregate(data['table'], by, specs,
+                               bucket=data.get('bucket', None),
+                               filters=filters, start=data.get('start', None),
+                               end=data.get('end', None),
+                               grouping=data.get('grouping', None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with metrics.phase('serialize'):
+        response = make_response(json.dumps({'result': result},
+                                            default=serialize.json_default))
+    response.mimetype = 'application/json'
+    return response
+
+sample_schema = {
+        "title": "Sampled aggregate",
+        "description": "Estimate a count, sum or average per group from a"\
+                       " TABLESAMPLE of percent of the table, with the"\
+                       " standard error of each estimate. group_col and"\
+                       " response_col are pipe separated.",
+        "type": "object",
+        "properties": {
+            "table": {
+                "type": "string"
+                },
+            "group_col": {
+                "type": "string"
+                },
+            "response_col": {
+                "type": "string"
+                },
+            "agg": {
+                "enum": list(agg.SAMPLE_AGGREGATES)
+                },
+            "percent": {
+                "type": "string",
+                "pattern": "^[0-9]*\\.?[0-9]+$"
+                },
+            "method": {
+                "enum": list(agg.SAMPLE_METHODS)
+                },
+            "seed": {
+                "type": "string",
+                "pattern": "^[0-9]+$"
+                },
+            "start": {
+                "type": "string"
+                },
+            "end": {
+                "type": "string"
+                }
+            },
+        "required": ["table", "response_col"]
+        }
+@app.route('/api/sample')
+@validate_schema(sample_schema)
+def api_sample():
+    data = request.args
+    seed = data.get('seed', None)
+    try:
+        result = agg.groupby_sample(
+            data['table'],
+            data['group_col'].split('|') if data.get('group_col') else [],
+            data['response_col'].split('|'), agg=data.get('agg', 'count'),
+            percent=float(data.get('percent', 1)),
+            method=data.get('method', 'bernoulli'),
+            seed=seed and int(seed), tstart=data.get('start', None),
+            tend=data.get('end', None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with metrics.phase('serialize'):
+        response = make_response(json.dumps({'result': result}))
+    response.mimetype = 'application/json'
+    return response
+
+distinct_schema = {
+        "title": "Approximate distinct count",
+        "description": "Estimate the distinct values of col, overall or per"\
+                       " group of group_col (pipe separated groups), from"\
+                       " the daily HyperLogLog sketches built by tempus.py"\
+                       " sketches. Time bounds resolve to whole days.",
+        "type": "object",
+        "properties": {
+            "table": {
+                "type": "string"
+                },
+            "col": {
+                "type": "string"
+                },
+            "group_col": {
+                "type": "string"
+                },
+            "groups": {
+                "type": "string"
+                },
+            "start": {
+                "type": "string"
+                },
+            "end": {
+                "type": "string"
+                }
+            },
+        "required": ["table", "col"]
+        }
+@app.route('/api/distinct')
+@validate_schema(distinct_schema)
+def api_distinct():
+    data = request.args
+    try:
+        result = agg.distinct_count(
+            data['table'], data['col'], data.get('group_col', None),
+            groups=data['groups'].split('|') if data.get('groups') else None,
+            start=data.get('start', None), end=data.get('end', None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with metrics.phase('serialize'):
+        response = make_response(json.dumps({'result': result}))
+    response.mimetype = 'application/json'
+    return response
+
+quantiles_schema = {
+        "title": "Approximate quantiles",
+        "description": "Estimate pipe separated quantiles (in [0, 1]) of a"\
+                       " response column, overall or per group of group_col"\
+                       " (pipe separated groups), from the daily sketches"\
+                       " built by tempus.py sketches. Time bounds resolve to"\
+                       " whole days.",
+        "type": "object",
+        "properties": {
+            "table": {
+                "type": "string"
+                },
+            "response_col": {
+                "type": "string"
+                },
+            "qs": {
+                "type": "string",
+                "pattern": "^{0}(\\|{0})*$".format(NUMBER)
+                },
+            "group_col": {
+                "type": "string"
+                },
+            "groups": {
+                "type": "string"
+                },
+            "start": {
+                "type": "string"
+                },
+            "end": {
+                "type": "string"
+                }
+            },
+        "required": ["table", "response_col"]
+        }
+@app.route('/api/quantiles')
+@validate_schema(quantiles_schema)
+def api_quantiles():
+    data = request.args
+    try:
+        result = agg.quantiles(
+            data['table'], data['response_col'],
+            [float(q) for q in data.get('qs', '0.5').split('|')],
+            group_col=data.get('group_col', None),
+            groups=data['groups'].split('|') if data.get('groups') else None,
+            start=data.get('start', None), end=data.get('end', None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with metrics.phase('serialize'):
+        response = make_response(json.dumps({'result': result}))
+    response.mimetype = 'application/json'
+    return response
 
 @app.route('/api/outliers')
 def api_outliers():
     data = request.args
-    outliers = agg.outliers(data['table'], data['group_col'],
-                            data['response_col'])
+    threshold = data.get('threshold', None)
+    try:
+        outliers = agg.outliers(data['table'], data['group_col'],
+                                data['response_col'],
+                                method=data.get('method', 'stddev'),
+                                threshold=threshold and float(threshold))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     logger.debug(outliers)
     response =  make_response(json.dumps(outliers))
     response.mimetype = 'application/json'
@@ -61,11 +634,66 @@ def api_diffindiff():
     comparisons = data['comparisons'].split('|')
     date = data['date']
     try:
-        diffindiff = agg.diffindiff(target, comparisons, date)
+        diffindiff = agg.diffindiff(target, comparisons, date,
+                                    logged=is_true(data.get('logged')),
+                                    normalize=is_true(data.get('normalize')),
+                                    backend=data.get('backend', 'native'))
     except ValueError:
         abort(400)
 
-    return diffindiff
+    with metrics.phase('serialize'):
+        response = make_response(json.dumps(diffindiff))
+    response.mimetype = 'application/json'
+    return response
+
+diffindiff_many_schema = {
+        "title": "Bulk difference in difference",
+        "description": "Estimate the difference in difference of many"\
+                       " targets around one event date. Comparisons are"\
+                       " either one pipe separated set shared by every"\
+                       " target, or one set per target, separated by"\
+                       " semicolons in the order of the targets.",
+        "type": "object",
+        "properties": {
+            "targets": {
+                "type": "string"
+                },
+            "comparisons": {
+                "type": "string"
+                },
+            "date": {
+                "type": "string",
+                "pattern": "^[0-9]{4}-[0-9]{2}-[0-9]{2}$"
+                },
+            "logged": {
+                "type": "string"
+                },
+            "normalize": {
+                "type": "string"
+                }
+            },
+        "required": ["targets", "comparisons", "date"]
+        }
+@app.route('/api/diffindiff_many')
+@validate_schema(diffindiff_many_schema)
+def api_diffindiff_many():
+    data = request.args
+    targets = data['targets'].split('|')
+    if ';' in data['comparisons']:
+        comparisons = [c.split('|') for c in data['comparisons'].split(';')]
+    else:
+        comparisons = data['comparisons'].split('|')
+    try:
+        results = agg.diffindiff_many(targets, comparisons, data['date'],
+                                      logged=is_true(data.get('logged')),
+                                      normalize=is_true(
+                                          data.get('normalize')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = make_response(json.dumps({'result': results}))
+    response.mimetype = 'application/json'
+    return response
 
 comparison_schema = {
         "title": "Comparison group selection",
@@ -88,6 +716,12 @@ comparison_schema = {
                 },
             "response_col": {
                 "type": "string"
+                },
+            "backend": {
+                "enum": ["native", "plr"]
+                },
+            "layout": {
+                "enum": ["rows", "columnar"]
                 }
             },
         "required": ["table", "group_col", "group", "covs", "response_col"]
@@ -99,7 +733,8 @@ def api_get_comparison():
     covs = data['covs'].split('|')
     try:
         comps = agg.get_comparisons(data['table'], data['group_col'],
-                                    data['group'], covs)
+                                    data['group'], covs,
+                                    backend=data.get('backend', 'native'))
     except ValueError:
         raise
     except KeyError as key_error:
@@ -114,12 +749,94 @@ def api_get_comparison():
     cdata = agg.get_comparison_ts(data['table'], data['group_col'],
                                   comps, data['response_col'],
                                   sort=data.get('sort', False))
-    response = []
-    for (dt, v) in cdata:
-        response.append((str(dt), v))
-    response = make_response(json.dumps({'result': response,
-                                    'groups': comps
-                                    }))
+    if wants_columns(data):
+        t, v = serialize.row_arrays(cdata)
+        return columns_response(t, v, groups=comps)
+
+    with metrics.phase('serialize'):
+        response = []
+        for (dt, v) in cdata:
+            response.append((str(dt), v))
+        response = make_response(json.dumps({'result': response,
+                                        'groups': comps
+                                        }))
+    response.mimetype = 'application/json'
+    return response
+
+def job_args(kind, data):
+    ''' Maps query arguments to the keyword arguments of a job kind '''
+    if kind == 'comparison':
+        return {'table': data['table'], 'target_col': data['group_col'],
+                'target': data['group'], 'covs': data['covs'].split('|'),
+                'num_matches': int(data.get('num_matches', 3)),
+                'backend': data.get('backend', 'native')}
+    args = {'target': data['target'],
+            'comparisons': data['comparisons'].split('|'),
+            'date': data['date'], 'logged': is_true(data.get('logged'))}
+    if kind == 'diffindiff':
+        args['normalize'] = is_true(data.get('normalize'))
+        args['backend'] = data.get('backend', 'native')
+    return args
+
+jobs_schema = {
+        "title": "Submit job",
+        "description": "POST to queue a long-running analysis and return its"\
+                       " id. Takes the arguments of /api/comparison"\
+                       " (comparison) or /api/diffindiff (diffindiff,"\
+                       " causalimpact), in the query string or form. Poll"\
+                       " /api/jobs/<id> for its status and result.",
+        "type": "object",
+        "properties": {
+            "kind": {
+                "enum": sorted(jobs.KINDS)
+                }
+            },
+        "required": ["kind"]
+        }
+@app.route('/api/jobs', methods=['GET', 'POST'])
+def api_submit_job():
+    # Submitting changes state, so only a POST does; a bare GET describes it
+    if request.method == 'GET':
+        if request.args:
+            abort(405, valid_methods=['POST'])
+        return jsonify(jobs_schema), 200
+    data = request.values.to_dict()
+    try:
+        validate(data, jobs_schema)
+    except ValidationError, e:
+        return jsonify({"error": e.message}), 400
+    try:
+        job_id = jobs.submit(data['kind'], job_args(data['kind'], data))
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({'id': job_id, 'status': '/api/jobs/' + job_id}), 202
+
+@app.route('/api/jobs/_metrics')
+def api_job_metrics():
+    ''' GET job counts, queue wait and run times per job kind '''
+    return jsonify(jobs.job_metrics())
+
+@app.route('/api/jobs/<job_id>')
+def api_get_job(job_id):
+    ''' GET a job's status and timings, and its result once done '''
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    response = make_response(json.dumps(job))
+    response.mimetype = 'application/json'
+    return response
+
+@app.route('/api/jobs/<job_id>/result')
+def api_get_job_result(job_id):
+    ''' GET a job's result: 202 while it is pending, 500 if it failed '''
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] == 'failed':
+        return jsonify({"error": job['error']}), 500
+    if job['status'] != 'done':
+        return jsonify({'status': job['status']}), 202
+    response = make_response(json.dumps(job['result']))
     response.mimetype = 'application/json'
     return response
 
@@ -149,6 +866,25 @@ get_series_schema = {
                 },
             "sort": {
                 "type": "string"
+                },
+            "stream": {
+                "type": "string"
+                },
+            "format": {
+                "enum": list(serialize.FORMATS)
+                },
+            "bucket": {
+                "enum": list(agg.BUCKETS)
+                },
+            "agg": {
+                "type": "string"
+                },
+            "max_points": {
+                "type": "string",
+                "pattern": "^([3-9]|[1-9][0-9]+)$"
+                },
+            "layout": {
+                "enum": ["rows", "columnar"]
                 }
             },
         "required": ["table", "response_col"]
@@ -157,21 +893,63 @@ get_series_schema = {
 @validate_schema(get_series_schema)
 def api_get_series():
     data = request.args
-    res = agg.get(data['table'], data['response_col'],
-            data.get('group_col', None), data.get('group', None),
-            start=data.get('start', None), end=data.get('end', None),
-            sort=data.get('sort', False))
+    fmt = data.get('format', 'json')
+    query = dict(start=data.get('start', None), end=data.get('end', None),
+                 sort=data.get('sort', False), bucket=data.get('bucket', None),
+                 how=data.get('agg', 'avg'))
+
+    try:
+        if fmt == 'json' and not is_true(data.get('stream')) and \
+                wants_columns(data):
+            query['sort'] = True
+            t, v = agg.get_arrays(data['table'], data['response_col'],
+                                  data.get('group_col', None),
+                                  data.get('group', None), **query)
+            if 'max_points' in data:
+                t, v = downsample.lttb_arrays(t, v, int(data['max_points']))
+            return columns_response(t, v)
+        elif 'max_points' in data:
+            # Downsampling needs the whole (sorted) series at once
+            query['sort'] = True
+            res = downsample.lttb_rows(
+                agg.get(data['table'], data['response_col'],
+                        data.get('group_col', None), data.get('group', None),
+                        **query),
+                int(data['max_points']))
+        elif is_true(data.get('stream')) or fmt != 'json':
+            # Stream from a server-side cursor rather than building the result
+            rows = agg.iter_get(data['table'], data['response_col'],
+                                data.get('group_col', None),
+                                data.get('group', None), **query)
+            mimetype, encode = serialize.FORMATS[fmt]
+            return Response(stream_with_context(encode(rows)),
+                            mimetype=mimetype)
+        else:
+            res = agg.get(data['table'], data['response_col'],
+                    data.get('group_col', None), data.get('group', None),
+                    **query)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if fmt != 'json':
+        mimetype, encode = serialize.FORMATS[fmt]
+        return Response(encode(res), mimetype=mimetype)
 
     response = []
     for (dt, v) in res:
         response.append((str(dt), v))
-    response =  make_response(json.dumps({'result': response}))
+    response =  make_response(json.dumps({'result': response},
+                                         default=serialize.json_default))
     response.mimetype = 'application/json'
     return response
 
 get_groups_schema = {
         "title": "Display group selection",
-        "description": "Show all variables within a given groupable column",
+        "description": "Show all variables within a given groupable column."\
+                       " With prefix, q (substring), sort, limit, offset or"\
+                       " top (the top groups by row count), search and page"\
+                       " them, with their row counts and first and last"\
+                       " timestamps.",
         "type": "object",
         "properties": {
             "table": {
@@ -179,6 +957,27 @@ get_groups_schema = {
                 },
             "group_col": {
                 "type": "string"
+                },
+            "prefix": {
+                "type": "string"
+                },
+            "q": {
+                "type": "string"
+                },
+            "sort": {
+                "enum": list(dictionary.SORTS)
+                },
+            "limit": {
+                "type": "string",
+                "pattern": "^[0-9]+$"
+                },
+            "offset": {
+                "type": "string",
+                "pattern": "^[0-9]+$"
+                },
+            "top": {
+                "type": "string",
+                "pattern": "^[0-9]+$"
                 }
             },
         "required": ["table", "group_col"]
@@ -187,11 +986,29 @@ get_groups_schema = {
 @validate_schema(get_groups_schema)
 def api_get_groups():
     data = request.args
-    res = agg.get_groups(data['table'], data['group_col'])
-    results = []
-    for x in res:
-        results.append(x[0])
-    return jsonify({data['group_col']: results})
+    search = ('prefix', 'q', 'sort', 'limit', 'offset', 'top')
+    if not any(k in data for k in search):
+        res = agg.get_groups(data['table'], data['group_col'])
+        results = []
+        for x in res:
+            results.append(x[0])
+        return jsonify({data['group_col']: results})
+
+    limit, offset = data.get('limit', None), data.get('offset', None)
+    sort = data.get('sort', 'value')
+    if 'top' in data:
+        limit, sort = data['top'], 'count'
+    try:
+        result = agg.find_groups(data['table'], data['group_col'],
+                                 prefix=data.get('prefix', None),
+                                 contains=data.get('q', None), sort=sort,
+                                 limit=limit and int(limit),
+                                 offset=offset and int(offset))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    groups = result.pop('value')
+    result[data['group_col']] = groups
+    return jsonify(result)
 
 if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
@@ -0,0 +1,173 @@
+# coding: utf-8
+'''
+ARIMA(p, d, 0) forecasting of many series at once.
+
+Each series is differenced `d` times and fitted with an autoregression by
+conditional least squares, choosing `p` by AIC. Fits run across a thread
+pool, one task per series, and fitted parameters are cached until the
+series they were fitted on changes.
+'''
+from __future__ import division
+from config import conf
+from util.lru import LRUCache
+from util.parallel import parallel_map
+import hashlib
+import numpy as np
+
+arima_conf = conf.get('arima') or {}
+
+# Fitted parameters, keyed on the series they describe
+fits = LRUCache(arima_conf.get('maxsize', 10000),
+                      arima_conf.get('ttl', 7 * 24 * 3600))
+
+
+def fill_gaps(y):
+    '''
+    Returns `y` with leading and trailing NaNs removed and interior NaNs
+    linearly interpolated.
+    '''
+    y = np.asarray(y, dtype=float)
+    observed = np.flatnonzero(~np.isnan(y))
+    if not len(observed):
+        return y[:0]
+    y = y[observed[0]:observed[-1] + 1]
+    missing = np.isnan(y)
+    if missing.any():
+        idx = np.arange(len(y))
+        y[missing] = np.interp(idx[missing], idx[~missing], y[~missing])
+    return y
+
+
+def _lagged(w, p):
+    ''' Returns the design matrix [1, w_{t-1}, ..., w_{t-p}] and targets '''
+    n = len(w)
+    X = np.ones((n - p, p + 1))
+    for i in range(1, p + 1):
+        X[:, i] = w[p - i:n - i]
+    return X, w[p:]
+
+
+def fit(y, d=1, max_p=5):
+    '''
+    Fits an ARIMA(p, d, 0) model with intercept to a series.
+
+    Parameters
+    ----------
+    y : array_like
+        Series, evenly spaced. NaNs are interpolated.
+    d : int, optional
+        Order of differencing (the default is 1).
+    max_p : int, optional
+        Largest autoregressive order considered (the default is 5).
+
+    Returns
+    -------
+    dict
+        `p`, `d`, autoregressive `coef`, `intercept`, residual variance
+        `sigma2`, `aic`, and the trailing observations (`tail`) needed to
+        forecast. None when the series is too short to fit.
+
+    '''
+    y = fill_gaps(y)
+    w = np.diff(y, d) if d else y
+    # Compare orders on the same sample so their AICs are comparable
+    max_p = min(max_p, (len(w) - 2) // 2)
+    if max_p < 0:
+        return None
+
+    best = None
+    for p in range(max_p + 1):
+        X, target = _lagged(w[max_p - p:], p)
+        beta = np.linalg.lstsq(X, target, rcond=-1)[0]
+        sigma2 = ((target - X.dot(beta)) ** 2).mean()
+        aic = len(target) * np.log(max(sigma2, 1e-300)) + 2 * (p + 1)
+        if best is None or aic < best['aic']:
+            best = {'p': p, 'd': d, 'intercept': float(beta[0]),
+                    'coef': [float(b) for b in beta[1:]],
+                    'sigma2': float(sigma2), 'aic': float(aic)}
+
+    best['tail'] = [float(v) for v in y[-(best['p'] + d):]] \
+        if best['p'] + d else []
+    return best
+
+
+def level_coef(params):
+    ''' Returns the AR coefficients of the undifferenced series '''
+    poly = np.r_[1, -np.asarray(params['coef'])]
+    for _ in range(params['d']):
+        poly = np.convolve(poly, [1, -1])
+    return -poly[1:]
+
+
+def predict(params, steps, z=1.96):
+    '''
+    Forecasts `steps` ahead from fitted parameters.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Mean forecast and the lower and upper bounds of its `z` interval,
+        empty for 0 steps.
+
+    '''
+    if steps < 0:
+        raise ValueError('Cannot forecast {} steps'.format(steps))
+    a = level_coef(params)
+    history = list(params['tail'])
+    mean = np.empty(steps)
+    for h in range(steps):
+        lags = history[::-1][:len(a)]
+        mean[h] = params['intercept'] + np.dot(a[:len(lags)], lags)
+        history.append(mean[h])
+
+    # Variance of the h-step error from the MA(infinity) weights
+    psi = np.zeros(steps)
+    psi[:1] = 1
+    for j in range(1, steps):
+        k = min(j, len(a))
+        psi[j] = np.dot(a[:k], psi[j - k:j][::-1])
+    se = np.sqrt(params['sigma2'] * np.cumsum(psi ** 2))
+    return mean, mean - z * se, mean + z * se
+
+
+def series_key(key, y):
+    ''' Returns a digest of a series and the query it came from '''
+    digest = hashlib.sha1(repr(key).encode('utf-8'))
+    digest.update(np.ascontiguousarray(y, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def _fit_task(args):
+    y, d, max_p = args
+    return fit(y, d, max_p)
+
+
+def fit_many(keys, Y, d=1, max_p=5, threads=None):
+    '''
+    Fits every column of `Y`, reusing cached fits of unchanged series.
+
+    Parameters
+    ----------
+    keys : list
+        Hashable description of each column, e.g. (table, group, response,
+        bucket); together with the column's values it keys the cache.
+    Y : numpy.ndarray
+        Series as columns.
+
+    Returns
+    -------
+    list
+        Fitted parameters per column (None where a series is too short).
+
+    '''
+    digests = [series_key((k, d, max_p), Y[:, i]) for i, k in enumerate(keys)]
+    params = [fits.get(digest) for digest in digests]
+    todo = [i for i, (found, _) in enumerate(params) if not found]
+    params = [value for _, value in params]
+
+    fitted = parallel_map(_fit_task, [(Y[:, i], d, max_p) for i in todo],
+                          threads or arima_conf.get('threads'))
+    for i, value in zip(todo, fitted):
+        fits.set(digests[i], value)
+        params[i] = value
+    return params
@@ -0,0 +1,66 @@
+'''
+Benchmark the native diff-in-diff engine against the OpenCPU R backend.
+
+Run from the repository root so the Tempus configuration is found:
+
+    python -m bench.diffindiff TARGET 'COMP1|COMP2' 2014-06-01 --repeat 5
+'''
+from __future__ import print_function
+import argparse
+import json
+import time
+import agg
+
+
+def timeit(f, repeat):
+    ''' Returns (best wall time in seconds, last result) of `repeat` calls. '''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('target')
+    parser.add_argument('comparisons', help='Pipe separated regions')
+    parser.add_argument('date', help='Event date, YYYY-mm-dd')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--logged', action='store_true')
+    parser.add_argument('--normalize', action='store_true')
+    args = parser.parse_args()
+
+    comparisons = args.comparisons.split('|')
+    regions = comparisons + [args.target]
+    timings = {}
+
+    timings['panel'], panel = timeit(lambda: agg.get_panel(regions),
+                                     args.repeat)
+    df = agg.panel_frame(*panel)
+
+    results = {}
+    timings['native'], results['native'] = timeit(
+        lambda: agg._diffindiff_native(*panel + (args.target, comparisons,
+                                                 args.date, args.logged,
+                                                 args.normalize)),
+        args.repeat)
+    timings['opencpu'], results['opencpu'] = timeit(
+        lambda: agg._diffindiff_opencpu(df, args.target, comparisons,
+                                        args.date, args.logged,
+                                        args.normalize),
+        args.repeat)
+
+    # Largest absolute disagreement between the backends' estimates
+    delta = max(abs(results['native'][k][s] - results['opencpu'][k][s])
+                for k in ('diff_in_diff', 'target_diff', 'comparison_diff')
+                for s in ('b', 'se', 't'))
+
+    print(json.dumps({'rows': len(df), 'seconds': timings,
+                      'max_abs_delta': delta}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+'''
+Generate synthetic tables shaped like the configured ones, for benchmarks.
+
+Every table in the Tempus configuration gets its timestamp, groupable
+columns, price and covariates (and coordinates, when configured) filled with
+random rows in time order. Group sizes follow a Zipf law, covariates vary
+around a mean per group of the first groupable column, and coordinates
+scatter around a point per group, which also becomes a row of each
+configured geography.
+
+    python -m bench.generate postgresql://tempus@localhost/tempus_bench \
+        --rows 1000000 --conf bench.yml.conf
+    TEMPUS_CONF=bench.yml.conf python tempus.py link
+    TEMPUS_CONF=bench.yml.conf python -m bench.suite
+
+Postgres is loaded with COPY. Any other SQLAlchemy URL (e.g. a SQLite file)
+is loaded with batched INSERTs, without the geography tables; it holds the
+same data, but the agg queries themselves need Postgres.
+'''
+from __future__ import division, print_function
+import argparse
+import csv
+import datetime
+import io
+import time
+import numpy as np
+import sqlalchemy
+import yaml
+from sqlalchemy import MetaData, Table, Column, BigInteger, DateTime, Float, \
+    String
+
+
+def group_names(col, n):
+    return np.array(['{}_{:05d}'.format(col, i) for i in range(n)])
+
+
+def zipf_probabilities(n, exponent=1.1):
+    p = 1 / np.arange(1, n + 1) ** exponent
+    return p / p.sum()
+
+
+def cardinalities(table_conf, rows, groups):
+    '''
+    Returns the number of distinct values of each groupable column: `groups`
+    for the first one, one per 20 rows (up to 100000) for the others.
+    '''
+    result = {}
+    for i, col in enumerate(table_conf.get('groupable', [])):
+        result[col] = groups if i == 0 else \
+            max(1, min(rows // 20, 100000))
+    return result
+
+
+def measures(table_conf):
+    ''' Returns the configured price and covariates, without repeats '''
+    cols = [table_conf.get('price')] + table_conf.get('covariates', [])
+    return [c for i, c in enumerate(cols) if c and c not in cols[:i]]
+
+
+def make_table(metadata, name, table_conf):
+    ''' Returns the `Table` of a configured table '''
+    columns = [Column('id', BigInteger, primary_key=True),
+               Column(table_conf['timestamp'], DateTime)]
+    columns += [Column(c, String) for c in table_conf.get('groupable', [])]
+    columns += [Column(c, Float) for c in measures(table_conf)]
+    coords = table_conf.get('coords')
+    if coords:
+        columns += [Column(coords['latitude'], Float),
+                    Column(coords['longitude'], Float)]
+    return Table(name, metadata, *columns)
+
+
+class Generator(object):
+    '''
+    Random rows of one configured table.
+
+    Per group parameters are drawn once, so every chunk comes from the same
+    population.
+    '''
+
+    def __init__(self, table_conf, rows, groups, days, seed):
+        self.conf = table_conf
+        self.rows = rows
+        self.days = days
+        self.random = np.random.RandomState(seed)
+
+        self.cardinality = cardinalities(table_conf, rows, groups)
+        self.probabilities = dict((c, zipf_probabilities(n))
+                                  for c, n in self.cardinality.items())
+        self.names = dict((c, group_names(c, n))
+                          for c, n in self.cardinality.items())
+
+        n = groups if table_conf.get('groupable') else 1
+        self.means = dict((m, self.random.lognormal(4, 0.5, n))
+                          for m in measures(table_conf))
+        # Group centers within the contiguous United States
+        self.lat = self.random.uniform(25, 49, n)
+        self.lon = self.random.uniform(-124, -67, n)
+
+    def chunks(self, chunk_size):
+        ''' Yields dicts of column arrays, `chunk_size` rows at a time '''
+        conf = self.conf
+        groupable = conf.get('groupable', [])
+        span = self.days * 86400.
+        for lo in range(0, self.rows, chunk_size):
+            k = min(chunk_size, self.rows - lo)
+            chunk = {'id': np.arange(lo, lo + k) + 1}
+
+            # Rows arrive in time order, as appended by a crawler
+            seconds = np.sort(self.random.uniform(
+                span * lo / self.rows, span * (lo + k) / self.rows, k))
+            chunk[conf['timestamp']] = seconds
+
+            first = None
+            for col in groupable:
+                codes = self.random.choice(self.cardinality[col], k,
+                                           p=self.probabilities[col])
+                chunk[col] = self.names[col][codes]
+                if first is None:
+                    first = codes
+            if first is None:
+                first = np.zeros(k, dtype=int)
+
+            for m in measures(conf):
+                chunk[m] = self.means[m][first] * \
+                    self.random.lognormal(0, 0.3, k)
+            coords = conf.get('coords')
+            if coords:
+                chunk[coords['latitude']] = self.lat[first] + \
+                    self.random.normal(0, 0.2, k)
+                chunk[coords['longitude']] = self.lon[first] + \
+                    self.random.normal(0, 0.2, k)
+            yield chunk
+
+    def centroids(self, geo_conf):
+        ''' Returns the rows of a geography with a point per group '''
+        return [{geo_conf['linkage']: '{:05d}'.format(i),
+                 geo_conf['coords']['latitude']: float(lat),
+                 geo_conf['coords']['longitude']: float(lon)}
+                for i, (lat, lon) in enumerate(zip(self.lat, self.lon))]
+
+
+def to_rows(table, chunk, start):
+    ''' Returns the tuples of a chunk, in `table`'s column order '''
+    columns = []
+    for c in table.columns:
+        values = chunk[c.name]
+        if isinstance(c.type, DateTime):
+            values = [start + datetime.timedelta(seconds=float(s))
+                      for s in values]
+        else:
+            values = values.tolist()
+        columns.append(values)
+    return zip(*columns)
+
+
+def copy_rows(engine, table, rows):
+    ''' Bulk-loads rows into a Postgres table with COPY '''
+    buf = io.BytesIO()
+    writer = csv.writer(buf)
+    writer.writerows(rows)
+    buf.seek(0)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(
+            table.fullname, ', '.join('"{}"'.format(c.name)
+                                      for c in table.columns)), buf)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def insert_rows(engine, table, rows):
+    names = [c.name for c in table.columns]
+    with engine.begin() as conn:
+        conn.execute(table.insert(), [dict(zip(names, row)) for row in rows])
+
+
+def load(url, conf, rows, groups=300, days=730,
+         start=datetime.datetime(2014, 1, 1), chunk_size=100000, seed=0):
+    '''
+    Replaces the configured tables (and geographies) at `url` with synthetic
+    rows.
+
+    Returns {table: seconds taken to generate and load it}.
+    '''
+    engine = sqlalchemy.create_engine(url)
+    postgres = engine.dialect.name == 'postgresql'
+    write = copy_rows if postgres else insert_rows
+    metadata = MetaData()
+    timings = {}
+    # Geography -> generator of a table linking to it
+    generators = {}
+
+    for i, (name, table_conf) in enumerate(sorted(conf['tables'].items())):
+        begin = time.time()
+        table = make_table(metadata, name, table_conf)
+        table.drop(engine, checkfirst=True)
+        table.create(engine)
+        generator = Generator(table_conf, rows, groups, days, seed + i)
+        for chunk in generator.chunks(chunk_size):
+            write(engine, table, to_rows(table, chunk, start))
+        if postgres:
+            with engine.connect() as conn:
+                conn.execution_options(isolation_level='AUTOCOMMIT')\
+                    .execute('ANALYZE {}'.format(table.name))
+
+        generators[table_conf.get('geo_linkages')] = generator
+        timings[name] = time.time() - begin
+        print('{}: {} rows in {:.1f}s'.format(name, rows, timings[name]))
+
+    if not postgres:
+        return timings
+    # initdb reflects every configured geography, linked to or not
+    engine.execute('CREATE SCHEMA IF NOT EXISTS tempus_geography')
+    engine.execute('CREATE SCHEMA IF NOT EXISTS tempus_internal')
+    for geo, geo_conf in (conf.get('tempus_geography') or {}).items():
+        geo_table = Table(geo, MetaData(schema='tempus_geography'),
+            Column(geo_conf['linkage'], String, primary_key=True),
+            Column(geo_conf['coords']['latitude'], Float),
+            Column(geo_conf['coords']['longitude'], Float))
+        geo_table.drop(engine, checkfirst=True)
+        geo_table.create(engine)
+        generator = generators.get(geo, generator)
+        engine.execute(geo_table.insert(), generator.centroids(geo_conf))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('url', help='SQLAlchemy URL of the database to fill')
+    parser.add_argument('--rows', type=float, default=1e5,
+                        help='Rows per table, e.g. 1e5 to 1e8')
+    parser.add_argument('--groups', type=int, default=300,
+                        help='Distinct values of the first groupable column')
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--source', default='application.yml.conf',
+                        help='Configuration whose tables are generated')
+    parser.add_argument('--conf', help='Write a copy of the configuration'
+                                       ' pointing at `url` here')
+    args = parser.parse_args()
+
+    with open(args.source) as f:
+        conf = yaml.safe_load(f)
+    load(args.url, conf, int(args.rows), groups=args.groups, days=args.days,
+         chunk_size=args.chunk_size, seed=args.seed)
+
+    if args.conf:
+        conf['db'] = args.url
+        with open(args.conf, 'w') as f:
+            yaml.safe_dump(conf, f, default_flow_style=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+'''
+Time the agg functions and the API endpoints on the configured database.
+
+Point TEMPUS_CONF at a database filled by `bench.generate` (or any Tempus
+database) and run from the repository root:
+
+    TEMPUS_CONF=bench.yml.conf python -m bench.suite --repeat 5 \
+        --output results.json
+
+Arguments are picked from the data: the most frequent groups of each
+table's first groupable column, and the middle of its time range as event
+date. The result cache is disabled unless `--warm` is given, so every call
+reaches the database (or the columnar store, when enabled). Results are
+written as JSON, one entry per benchmark with its best, median and mean
+wall time in seconds, for comparison between runs.
+'''
+from __future__ import division, print_function
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import sqlalchemy
+from initdb import table_cols, tables, read_engine, get_time_range
+import agg
+import api
+import cache
+
+# Endpoints that change state
+UNTIMED = ('api_submit_job',)
+
+# Endpoints that take no arguments
+STATIC = ('api_root', 'api_cache_stats', 'api_metrics', 'api_slow_queries',
+          'api_columnar_stats', 'api_job_metrics')
+
+
+def measure(f, repeat):
+    ''' Returns (wall time in seconds of each of `repeat` calls, last result) '''
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        result = f()
+        times.append(time.time() - start)
+    return times, result
+
+
+def summary(times):
+    return {'best': min(times), 'median': float(np.median(times)),
+            'mean': float(np.mean(times)), 'repeat': len(times)}
+
+
+def fixtures(table, n_groups=8):
+    ''' Returns arguments for the benchmarks of `table`, picked from its data '''
+    cols = table_cols[table]
+    group_col = cols['groupable'][0]
+    col = getattr(tables[table], group_col)
+    q = sqlalchemy.select([col]).where(col != None).group_by(col)\
+        .order_by(sqlalchemy.func.count().desc()).limit(n_groups)
+    groups = [row[0] for row in read_engine.execute(q)]
+    if not groups:
+        raise ValueError('{} has no groups to benchmark'.format(table))
+
+    first, last = [datetime.datetime.strptime(t[:10], '%Y-%m-%d')
+                   for t in get_time_range(table, cols['timestamp'])]
+    middle = first + (last - first) // 2
+    return {'table': table, 'group_col': group_col, 'groups': groups,
+            'response_col': cols['price'],
+            'covs': [c for c in cols['covariates'] if c != cols['price']],
+            'date': middle.strftime('%Y-%m-%d'),
+            'start': str(middle - datetime.timedelta(days=90)),
+            'end': str(middle)}
+
+
+def agg_benchmarks(fx):
+    ''' Returns (name, callable) of the agg benchmarks of a table '''
+    table, group_col, y = fx['table'], fx['group_col'], fx['response_col']
+    groups = fx['groups']
+    benchmarks = [
+        ('get', lambda: agg.get(table, y, group_col, groups[0], sort=True)),
+        ('get_day', lambda: agg.get(table, y, group_col, groups[0],
+                                    bucket='day', sort=True)),
+        ('get_range', lambda: agg.get(table, y, start=fx['start'],
+                                      end=fx['end'], sort=True)),
+        ('groupby', lambda: agg.groupby(table, group_col, y, 'avg')),
+        ('groupby_sample', lambda: agg.groupby_sample(
+            table, group_col, y, 'avg', percent=1, seed=0)),
+        ('aggregate', lambda: agg.aggregate(
+            table, [group_col], [(y, 'avg'), (y, 'stddev'), ('*', 'count')])),
+        ('outliers', lambda: agg.outliers(table, group_col, y)),
+        ('get_comparison_ts', lambda: agg.get_comparison_ts(
+            table, group_col, groups[1:4], y, sort=True)),
+        ('get_comparison_ts_day', lambda: agg.get_comparison_ts(
+            table, group_col, groups[1:4], y, sort=True, bucket='day')),
+    ]
+    # The diff-in-diff panel reads escort_ads' MSAs
+    if table == 'escort_ads' and group_col == 'msaname':
+        benchmarks.append(('get_diffindiff_data',
+                           lambda: agg.get_diffindiff_data(groups[:4])))
+    return benchmarks
+
+
+def api_requests(fx):
+    ''' Returns {endpoint: query arguments} of a table's API benchmarks '''
+    table, group_col, y = fx['table'], fx['group_col'], fx['response_col']
+    groups = fx['groups']
+    requests = {
+        'api_get_groups': {'table': table, 'group_col': group_col},
+        'api_get_series': {'table': table, 'response_col': y,
+                           'group_col': group_col, 'group': groups[0],
+                           'sort': 'true'},
+        'api_aggregate': {'table': table, 'by': group_col,
+                          'aggs': '{0}:avg|{0}:stddev|*:count'.format(y)},
+        'api_outliers': {'table': table, 'group_col': group_col,
+                         'response_col': y},
+        'api_arima': {'table': table, 'response_col': y,
+                      'group_col': group_col, 'groups': '|'.join(groups[:3])},
+        'api_changepoints': {'table': table, 'group_col': group_col,
+                             'groups': '|'.join(groups[:3])},
+        'api_get_comparison': {'table': table, 'group_col': group_col,
+                               'group': groups[0], 'covs': '|'.join(fx['covs']),
+                               'response_col': y},
+    }
+    if table_cols[table].get('geo_linkages'):
+        requests['api_geo'] = {'table': table, 'response_col': y}
+    if table == 'escort_ads' and group_col == 'msaname':
+        requests['api_diffindiff'] = {'target': groups[0],
+                                      'comparisons': '|'.join(groups[1:4]),
+                                      'date': fx['date']}
+        requests['api_diffindiff_many'] = {
+            'targets': '|'.join(groups[:2]),
+            'comparisons': '|'.join(groups[2:6]), 'date': fx['date']}
+    return requests
+
+
+def endpoints(app):
+    ''' Returns {endpoint: path} of the GET routes without path arguments '''
+    return dict((rule.endpoint, rule.rule) for rule in app.url_map.iter_rules()
+                if rule.rule.startswith('/api') and 'GET' in rule.methods
+                and not rule.arguments and rule.endpoint not in UNTIMED)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, repeat):
+    ''' Runs the benchmarks of tables `names`, returning the results '''
+    client = api.app.test_client()
+    routes = endpoints(api.app)
+    results, skipped = [], set(routes)
+
+    for table in names:
+        fx = fixtures(table)
+        for name, f in agg_benchmarks(fx):
+            try:
+                times, result = measure(f, repeat)
+            except Exception as e:
+                results.append({'kind': 'agg', 'name': name, 'table': table,
+                                'error': '{}: {}'.format(type(e).__name__, e)})
+                continue
+            entry = {'kind': 'agg', 'name': name, 'table': table}
+            entry.update(summary(times))
+            if hasattr(result, '__len__'):
+                entry['size'] = len(result)
+            results.append(entry)
+            print('{:<24} {:<12} {:.4f}s'.format(name, table, entry['best']),
+                  file=sys.stderr)
+
+        for endpoint, args in sorted(api_requests(fx).items()):
+            if endpoint not in routes:
+                continue
+            skipped.discard(endpoint)
+            path = routes[endpoint]
+            times, response = measure(
+                lambda: client.get(path, query_string=args), repeat)
+            entry = {'kind': 'api', 'name': path, 'table': table,
+                     'status': response.status_code,
+                     'bytes': len(response.data)}
+            entry.update(summary(times))
+            results.append(entry)
+            print('{:<24} {:<12} {:.4f}s {}'.format(path, table, entry['best'],
+                                                   response.status_code),
+                  file=sys.stderr)
+
+    for endpoint in STATIC:
+        if endpoint not in routes:
+            continue
+        skipped.discard(endpoint)
+        times, response = measure(lambda: client.get(routes[endpoint]),
+                                  repeat)
+        entry = {'kind': 'api', 'name': routes[endpoint], 'table': None,
+                 'status': response.status_code, 'bytes': len(response.data)}
+        entry.update(summary(times))
+        results.append(entry)
+    return results, sorted(routes[e] for e in skipped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('tables', nargs='*',
+                        help='Tables to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warm', action='store_true',
+                        help='Keep the result cache enabled')
+    parser.add_argument('--output', help='Write the JSON results here')
+    args = parser.parse_args()
+
+    cache.cache_conf['enabled'] = args.warm
+    names = args.tables or sorted(table_cols)
+    results, skipped = run(names, args.repeat)
+
+    rows = dict((table, read_engine.execute(
+        sqlalchemy.select([sqlalchemy.func.count()])
+        .select_from(tables[table].__table__)).scalar()) for table in names)
+    report = {'meta': {'revision': git_revision(), 'rows': rows,
+                       'repeat': args.repeat, 'warm': args.warm,
+                       'python': platform.python_version(),
+                       'time': datetime.datetime.utcnow().isoformat()},
+              'results': results, 'skipped': skipped}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
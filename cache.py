@@ -0,0 +1,193 @@
+# coding: utf-8
+'''
+Result cache for agg query functions.
+
+Results are keyed on the function, its normalized arguments and the data
+version of the table it reads, so loading new rows into a table makes its
+cached results unreachable. An in-process LRU tier is always consulted
+first; a shared tier (Redis, or a directory on disk) lets processes reuse
+each other's results.
+'''
+from initdb import conf, tables, table_cols, read_engine
+from util.lru import LRUCache
+import collections
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+cache_conf = conf.get('cache') or {}
+
+# (function name, tier) -> count
+hits = collections.Counter()
+misses = collections.Counter()
+
+
+class DiskCache(object):
+    ''' Pickled results in a directory shared by every process on a host '''
+
+    def __init__(self, directory, ttl=600):
+        self.directory = directory
+        self.ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                return False, None
+            with open(path, 'rb') as f:
+                return True, pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+
+class RedisCache(object):
+    ''' Pickled results in Redis (or any server speaking its protocol) '''
+
+    def __init__(self, url, ttl=600):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get('tempus:' + key)
+        if value is None:
+            return False, None
+        return True, pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.setex('tempus:' + key, self.ttl,
+                          pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def make_shared(url, ttl):
+    ''' Returns the shared tier configured by `url`, or None '''
+    if not url:
+        return None
+    if url.startswith('redis://'):
+        try:
+            return RedisCache(url, ttl)
+        except ImportError:
+            logger.warning('redis is not installed, no shared cache')
+            return None
+    return DiskCache(url, ttl)
+
+
+local = LRUCache(cache_conf.get('maxsize', 1024), cache_conf.get('ttl', 600))
+shared = make_shared(cache_conf.get('shared'), cache_conf.get('ttl', 600))
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def data_version(table):
+    '''
+    Returns a token that changes whenever rows of `table` change.
+
+    Combines the latest timestamp with Postgres' insert/update/delete
+    counters for the table. Looked up at most every `version_ttl` seconds.
+    '''
+    now = time.time()
+    with _versions_lock:
+        if table in _versions and _versions[table][0] > now:
+            return _versions[table][1]
+
+    ts = getattr(tables[table], table_cols[table]['timestamp'])
+    latest = sqlalchemy.select([ts]).where(ts != None)\
+        .order_by(ts.desc()).limit(1)
+    changes = sqlalchemy.text(
+        'SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables'
+        ' WHERE relname = :table')
+    with read_engine.connect() as conn:
+        version = (str(conn.execute(latest).scalar()),
+                   tuple(conn.execute(changes, table=table).first() or ()))
+
+    with _versions_lock:
+        _versions[table] = (now + cache_conf.get('version_ttl', 30), version)
+    return version
+
+
+def make_key(name, callargs, version):
+    ''' Returns a stable digest of a call '''
+    payload = json.dumps([name, callargs, version], sort_keys=True,
+                         default=repr)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def cached(table=None):
+    '''
+    Caches results of the decorated function.
+
+    Parameters
+    ----------
+    table : str, optional
+        Table the function reads (the default is its `table` argument).
+
+    '''
+    def decorator(f):
+        name = f.__name__
+
+        @functools.wraps(f)
+        def cache_wrapper(*args, **kwargs):
+            if not cache_conf.get('enabled', True):
+                return f(*args, **kwargs)
+
+            callargs = inspect.getcallargs(f, *args, **kwargs)
+            key = make_key(name, callargs,
+                           data_version(table or callargs['table']))
+
+            found, value = local.get(key)
+            if found:
+                hits[(name, 'local')] += 1
+                return value
+            if shared is not None:
+                found, value = shared.get(key)
+                if found:
+                    hits[(name, 'shared')] += 1
+                    local.set(key, value)
+                    return value
+
+            misses[name] += 1
+            value = f(*args, **kwargs)
+            local.set(key, value)
+            if shared is not None:
+                try:
+                    shared.set(key, value)
+                except Exception:
+                    logger.exception('Shared cache write failed')
+            return value
+        return cache_wrapper
+    return decorator
+
+
+def stats():
+    ''' Returns hit and miss counters per function '''
+    result = collections.defaultdict(lambda: {'local': 0, 'shared': 0,
+                                              'misses': 0})
+    for (name, tier), n in hits.items():
+        result[name][tier] = n
+    for name, n in misses.items():
+        result[name]['misses'] = n
+    return dict(result)
@@ -0,0 +1,221 @@
+# coding: utf-8
+'''
+Change-point detection for changes in the mean of many series.
+
+Segment costs are the within-segment sum of squares, read off cumulative
+sums in O(1), so every detector is linear or near-linear in the series
+length. `amoc` handles a whole matrix of series in one vectorized pass;
+`pelt` and `binseg` run per series across the thread pool.
+'''
+from __future__ import division
+from util.parallel import parallel_map
+import numpy as np
+
+METHODS = ('pelt', 'binseg', 'amoc')
+
+
+def interpolate(y):
+    ''' Returns `y` with NaNs linearly interpolated (and edges held) '''
+    y = np.array(y, dtype=float)
+    missing = np.isnan(y)
+    if missing.all():
+        return np.zeros_like(y)
+    if missing.any():
+        idx = np.arange(len(y))
+        y[missing] = np.interp(idx[missing], idx[~missing], y[~missing])
+    return y
+
+
+def noise_variance(y):
+    '''
+    Robust estimate of the noise variance of a series with mean shifts,
+    from the median absolute first difference.
+    '''
+    diffs = np.abs(np.diff(y, axis=0))
+    if not len(diffs):
+        return np.ones(np.shape(y)[1:])
+    sigma = np.median(diffs, axis=0) / (0.6745 * np.sqrt(2))
+    return np.maximum(sigma ** 2, 1e-12)
+
+
+def default_penalty(y):
+    ''' MBIC-style penalty: 3 log(n) times the noise variance '''
+    return 3 * np.log(max(len(y), 2)) * noise_variance(y)
+
+
+def _check(min_size):
+    if min_size < 1:
+        raise ValueError('min_size must be at least 1')
+
+
+def _sums(y):
+    return np.r_[0, np.cumsum(y)], np.r_[0, np.cumsum(y * y)]
+
+
+def _cost(S1, S2, s, t):
+    ''' Sum of squares of segment(s) y[s:t] '''
+    return S2[t] - S2[s] - (S1[t] - S1[s]) ** 2 / (t - s)
+
+
+def pelt(y, penalty=None, min_size=2):
+    '''
+    Optimal segmentation by Pruned Exact Linear Time.
+
+    Parameters
+    ----------
+    y : array_like
+        Series.
+    penalty : float, optional
+        Cost of adding a change point (the default is `default_penalty`).
+    min_size : int, optional
+        Minimum number of observations between change points, at least 1.
+
+    Returns
+    -------
+    list of int
+        Indices at which a new segment starts.
+
+    '''
+    _check(min_size)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if penalty is None:
+        penalty = default_penalty(y)
+    if n < 2 * min_size:
+        return []
+
+    S1, S2 = _sums(y)
+    F = np.empty(n + 1)
+    F[0] = -penalty
+    last = np.zeros(n + 1, dtype=int)
+    candidates = np.array([0])
+
+    for t in range(min_size, n + 1):
+        ready = candidates[candidates <= t - min_size]
+        costs = F[ready] + _cost(S1, S2, ready, t)
+        best = np.argmin(costs)
+        F[t] = costs[best] + penalty
+        last[t] = ready[best]
+        # Drop starts that can never be optimal again
+        candidates = np.r_[candidates[candidates > t - min_size],
+                           ready[costs <= F[t]], t]
+
+    changes = []
+    t = last[n]
+    while t > 0:
+        changes.append(int(t))
+        t = last[t]
+    return changes[::-1]
+
+
+def _best_split(S1, S2, s, t, min_size):
+    ''' Returns (gain, index) of the best single split of y[s:t] '''
+    taus = np.arange(s + min_size, t - min_size + 1)
+    if not len(taus):
+        return 0, None
+    gains = _cost(S1, S2, s, t) - _cost(S1, S2, s, taus) - \
+        _cost(S1, S2, taus, t)
+    i = np.argmax(gains)
+    return gains[i], int(taus[i])
+
+
+def binseg(y, penalty=None, min_size=2, max_changes=None):
+    '''
+    Approximate segmentation by binary segmentation.
+
+    Repeatedly splits the segment whose best split reduces the cost most,
+    while that reduction exceeds `penalty`. See `pelt` for the parameters;
+    `max_changes` caps the number of change points.
+    '''
+    _check(min_size)
+    y = np.asarray(y, dtype=float)
+    if penalty is None:
+        penalty = default_penalty(y)
+
+    S1, S2 = _sums(y)
+    segments = [(0, len(y))]
+    changes = []
+    while max_changes is None or len(changes) < max_changes:
+        splits = [_best_split(S1, S2, s, t, min_size) + (s, t)
+                  for s, t in segments]
+        gain, tau, s, t = max(splits, key=lambda split: split[0]) \
+            if splits else (0, None, 0, 0)
+        if tau is None or gain <= penalty:
+            break
+        changes.append(tau)
+        segments.remove((s, t))
+        segments.extend([(s, tau), (tau, t)])
+    return sorted(changes)
+
+
+def amoc(Y, penalty=None, min_size=2):
+    '''
+    At most one change in each column of `Y`, for all columns at once.
+
+    Returns
+    -------
+    list
+        Per column, [index] of the change point, or [] when no split gains
+        more than `penalty`.
+
+    '''
+    _check(min_size)
+    Y = np.asarray(Y, dtype=float)
+    n = Y.shape[0]
+    if penalty is None:
+        penalty = default_penalty(Y)
+    if n < 2 * min_size:
+        return [[] for _ in range(Y.shape[1])]
+
+    S1 = np.vstack([np.zeros(Y.shape[1]), np.cumsum(Y, axis=0)])
+    taus = np.arange(min_size, n - min_size + 1)[:, None]
+    left = S1[taus[:, 0]]
+    right = S1[n] - left
+    # Between-segment sum of squares gained by splitting at each tau
+    gains = left ** 2 / taus + right ** 2 / (n - taus) - S1[n] ** 2 / n
+    best = np.argmax(gains, axis=0)
+    found = gains[best, np.arange(Y.shape[1])] > penalty
+    return [[int(taus[b, 0])] if f else [] for b, f in zip(best, found)]
+
+
+def _detect_task(args):
+    y, method, penalty, min_size = args
+    if method == 'pelt':
+        return pelt(y, penalty, min_size)
+    return binseg(y, penalty, min_size)
+
+
+def detect_many(Y, method='pelt', penalty=None, min_size=2, threads=None):
+    '''
+    Change points of every column of `Y`.
+
+    Parameters
+    ----------
+    Y : numpy.ndarray
+        Series as columns; NaNs are interpolated.
+    method : {'pelt', 'binseg', 'amoc'}, optional
+        Detector (the default is 'pelt').
+    penalty : float, optional
+        Cost of a change point (the default is `default_penalty` of each
+        series).
+    min_size : int, optional
+        Minimum number of observations between change points.
+    threads : int, optional
+        Size of the thread pool for 'pelt' and 'binseg'.
+
+    Returns
+    -------
+    list
+        Change point indices per column.
+
+    '''
+    if method not in METHODS:
+        raise ValueError('Unknown change point method {}'.format(method))
+    _check(min_size)
+    Y = np.column_stack([interpolate(Y[:, i]) for i in range(Y.shape[1])]) \
+        if Y.shape[1] else Y
+    if method == 'amoc':
+        return amoc(Y, penalty, min_size)
+    return parallel_map(_detect_task,
+                        [(Y[:, i], method, penalty, min_size)
+                         for i in range(Y.shape[1])], threads)
@@ -0,0 +1,617 @@
+# coding: utf-8
+'''
+Optional in-memory columnar copy of the configured tables.
+
+Each table's timestamp, groupable and covariate columns are held as NumPy
+arrays sorted by timestamp, with groupable values dictionary-encoded as
+integer codes. `agg` answers `get`, `groupby`, `groupdo`, `outliers` and
+`get_comparison_ts` from these arrays when the store holds everything a
+query needs, and falls back to Postgres otherwise.
+
+A background thread, started by `start` in the processes that serve
+queries, starts each store from its memory-mapped snapshot (see `snapshot`)
+when there is one, and appends rows newer than the store's timestamp
+watermark every `refresh` seconds, converting each chunk fetched as it
+arrives. Snapshot columns stay memory-mapped and read-only, shared by
+every process mapping them: rows loaded later go to a separate in-memory
+tail, and queries read both. When a table outgrows `memory_mb`, its oldest
+rows are dropped, and queries reaching back before the rows kept go to
+Postgres.
+
+Rows inserted with a timestamp at or before the watermark are missed,
+unless `columnar.overlap` is set: each refresh then reloads the rows of
+that many seconds before the watermark, replacing those held.
+'''
+from __future__ import division
+from initdb import conf, tables, table_cols, engine, session
+import datetime
+import logging
+import threading
+import time
+import numpy as np
+import sqlalchemy
+from sqlalchemy.exc import SQLAlchemyError
+import rollup
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+columnar_conf = conf.get('columnar') or {}
+
+US_PER_DAY = 86400 * 10 ** 6
+
+# Aggregates the kernels implement, by lower-case SQL name. Postgres'
+# STDDEV and VARIANCE are the sample statistics.
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max', 'stddev', 'stddev_samp',
+              'stddev_pop', 'variance', 'var_samp', 'var_pop', 'median')
+
+
+def to_us(value):
+    ''' Returns a timestamp (datetime or string) as int64 epoch microseconds '''
+    return np.datetime64(value, 'us').astype(np.int64)
+
+
+def to_datetimes(us):
+    ''' Returns epoch microseconds as datetime.datetime objects '''
+    return np.asarray(us, dtype=np.int64).astype('M8[us]').astype(object)
+
+
+def bucket_keys(us, bucket):
+    ''' Returns the start of each timestamp's bucket, like date_trunc '''
+    if bucket == 'hour':
+        return us // (3600 * 10 ** 6) * (3600 * 10 ** 6)
+    if bucket == 'day':
+        return us // US_PER_DAY * US_PER_DAY
+    if bucket == 'week':
+        days = us // US_PER_DAY
+        # 1970-01-01 was a Thursday; weeks start on Monday
+        return (days - (days + 3) % 7) * US_PER_DAY
+    if bucket == 'month':
+        return us.astype('M8[us]').astype('M8[M]').astype('M8[us]')\
+                .astype(np.int64)
+    raise ValueError('Unknown bucket {}'.format(bucket))
+
+
+def quantile_of(how):
+    ''' Returns the quantile named by 'median' or 'p<N>', else None '''
+    if how == 'median':
+        return 0.5
+    if how.startswith('p'):
+        try:
+            quantile = float(how[1:]) / 100
+        except ValueError:
+            return None
+        if 0 <= quantile <= 1:
+            return quantile
+    return None
+
+
+def supported(how):
+    how = how.lower()
+    return how in AGGREGATES or quantile_of(how) is not None
+
+
+def reduce_runs(keys, values, how):
+    '''
+    Aggregates `values` over runs of equal, sorted `keys`, ignoring NaNs the
+    way SQL aggregates ignore NULLs.
+
+    Returns
+    -------
+    keys : numpy.ndarray
+        Distinct keys.
+    result : numpy.ndarray
+        Aggregate per key, NaN where SQL would return NULL.
+
+    '''
+    how = how.lower()
+    if not len(keys):
+        return keys[:0], np.zeros(0)
+    starts = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1]
+    present = ~np.isnan(values)
+    n = np.add.reduceat(present.astype(np.int64), starts)
+
+    quantile = quantile_of(how)
+    if quantile is not None:
+        result = np.array([np.percentile(seg[~np.isnan(seg)], quantile * 100)
+                           if (~np.isnan(seg)).any() else np.nan
+                           for seg in np.split(values, starts[1:])])
+        return keys[starts], result
+    if how == 'count':
+        return keys[starts], n.astype(float)
+    if how in ('min', 'max'):
+        f = np.fmin if how == 'min' else np.fmax
+        return keys[starts], f.reduceat(values, starts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = np.add.reduceat(np.where(present, values, 0), starts)
+        total[n == 0] = np.nan
+        if how == 'sum':
+            return keys[starts], total
+        mean = total / n
+        if how == 'avg':
+            return keys[starts], mean
+
+        lengths = np.diff(np.r_[starts, len(values)])
+        deviation = np.where(present, values - np.repeat(mean, lengths), 0)
+        ss = np.add.reduceat(deviation ** 2, starts)
+        if how in ('var_pop', 'stddev_pop'):
+            var = np.where(n > 0, ss / n, np.nan)
+        else:
+            var = np.where(n > 1, ss / (n - 1), np.nan)
+    return keys[starts], np.sqrt(var) if how.startswith('stddev') else var
+
+
+def _scalar(value, how):
+    ''' Returns an aggregate as a Python number, None for NaN '''
+    if np.isnan(value):
+        return None
+    return int(value) if how.lower() == 'count' else float(value)
+
+
+class Columns(object):
+    '''
+    Timestamp, code and value arrays of a run of rows.
+
+    The arrays are views of buffers with spare capacity: `append` copies
+    rows in, doubling the buffers when full, so loading n rows copies each
+    O(1) times, and dropping rows from either end only moves the view.
+    '''
+
+    def __init__(self, ts, codes, values):
+        self._ts, self._codes, self._values = ts, codes, values
+        self.lo, self.hi = 0, len(ts)
+        # End of the rows ever written; views handed out may reach it
+        self.written = self.hi
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    @property
+    def ts(self):
+        return self._ts[self.lo:self.hi]
+
+    @property
+    def codes(self):
+        return dict((c, a[self.lo:self.hi]) for c, a in self._codes.items())
+
+    @property
+    def values(self):
+        return dict((m, a[self.lo:self.hi]) for m, a in self._values.items())
+
+    @property
+    def nbytes(self):
+        return len(self) * (self._ts.itemsize +
+                            sum(a.itemsize for a in self._codes.values()) +
+                            sum(a.itemsize for a in self._values.values()))
+
+    def _resize(self, capacity):
+        def grow(a):
+            new = np.empty(capacity, dtype=a.dtype)
+            new[:len(self)] = a[self.lo:self.hi]
+            return new
+        self._ts = grow(self._ts)
+        self._codes = dict((c, grow(a)) for c, a in self._codes.items())
+        self._values = dict((m, grow(a)) for m, a in self._values.items())
+        self.lo, self.hi = 0, len(self)
+        self.written = self.hi
+
+    def append(self, ts, codes, values):
+        n = len(ts)
+        # Rows dropped from the end may still be read through older views,
+        # so they are not overwritten
+        if self.hi + n > len(self._ts) or self.hi < self.written:
+            self._resize(max(2 * (len(self) + n), 1024))
+        self._ts[self.hi:self.hi + n] = ts
+        for c, a in self._codes.items():
+            a[self.hi:self.hi + n] = codes[c]
+        for m, a in self._values.items():
+            a[self.hi:self.hi + n] = values[m]
+        self.hi += n
+        self.written = self.hi
+
+    def drop_first(self, n):
+        self.lo += min(n, len(self))
+        # Release the dropped rows once they are most of the buffer
+        if self.lo > len(self._ts) // 2 and self._ts.flags.writeable:
+            self._resize(max(2 * len(self), 1024))
+
+    def drop_from(self, us):
+        ''' Drops the rows at or after epoch microseconds `us` '''
+        self.hi = self.lo + int(np.searchsorted(self.ts, us, 'left'))
+
+    def window(self, lo, hi):
+        ''' Returns rows `lo` to `hi` (relative to the first held) as views '''
+        return Columns(self._ts, self._codes, self._values)._view(
+            self.lo + lo, self.lo + hi)
+
+    def _view(self, lo, hi):
+        self.lo, self.hi = lo, hi
+        return self
+
+    @classmethod
+    def concatenate(cls, parts):
+        ''' Returns the rows of `parts` as one `Columns`, copying them '''
+        first = parts[0]
+        return cls(np.concatenate([p.ts for p in parts]),
+                   dict((c, np.concatenate([p.codes[c] for p in parts]))
+                        for c in first._codes),
+                   dict((m, np.concatenate([p.values[m] for p in parts]))
+                        for m in first._values))
+
+
+class ColumnStore(object):
+    '''
+    Timestamp-sorted columns of one table.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    memory_mb : float, optional
+        Memory budget; the oldest rows beyond it are dropped.
+
+    '''
+
+    def __init__(self, table, memory_mb=None):
+        self.table = table
+        self.memory_mb = memory_mb
+        self.groupable = list(table_cols[table]['groupable'])
+        self.measures = [m for m in rollup.measures(table)
+                         if m not in self.groupable]
+        # Rows loaded at once (e.g. a memory-mapped snapshot), never
+        # written to, followed by the rows appended since
+        self.base = self._empty()
+        self.tail = self._empty()
+        # Per groupable: code -> value, and value -> code
+        self.categories = dict((col, []) for col in self.groupable)
+        self.index = dict((col, {}) for col in self.groupable)
+        self.watermark = None
+        # Rows at or before this were dropped to stay within budget
+        self.truncated_at = None
+        self.lock = threading.RLock()
+
+    def _empty(self):
+        return Columns(np.zeros(0, dtype=np.int64),
+                       dict((col, np.zeros(0, dtype=np.int32))
+                            for col in self.groupable),
+                       dict((m, np.zeros(0)) for m in self.measures))
+
+    @property
+    def nbytes(self):
+        return self.base.nbytes + self.tail.nbytes
+
+    def __len__(self):
+        return len(self.base) + len(self.tail)
+
+    def _encode(self, col, values):
+        index = self.index[col]
+        categories = self.categories[col]
+        for value in set(values):
+            if value is not None and value not in index:
+                index[value] = len(categories)
+                categories.append(value)
+        return np.array([-1 if v is None else index[v] for v in values],
+                        dtype=np.int32)
+
+    def encode_rows(self, rows):
+        ''' Returns a chunk of rows as (timestamps, codes, values) arrays '''
+        columns = list(zip(*rows))
+        ts = np.array(columns[0], dtype='M8[us]').astype(np.int64)
+        codes = dict((col, self._encode(col, columns[1 + i]))
+                     for i, col in enumerate(self.groupable))
+        offset = 1 + len(self.groupable)
+        values = dict((m, np.array(columns[offset + i], dtype=float))
+                      for i, m in enumerate(self.measures))
+        return ts, codes, values
+
+    def append(self, chunks, replace_from=None):
+        '''
+        Appends chunks of (timestamp, *groupable, *measures) rows, sorted by
+        timestamp and newer than every row held, trimming to the memory
+        budget after each chunk.
+
+        With `replace_from`, first drops the rows held at or after that
+        timestamp, which the chunks then replace.
+        '''
+        with self.lock:
+            if replace_from is not None:
+                self.tail.drop_from(to_us(replace_from))
+                if not len(self.tail):
+                    self.base.drop_from(to_us(replace_from))
+            for chunk in chunks:
+                if not len(chunk):
+                    continue
+                self.tail.append(*self.encode_rows(chunk))
+                self.watermark = chunk[-1][0]
+                self._trim()
+
+    def set_categories(self, categories):
+        ''' Sets the values the codes of each groupable index '''
+        with self.lock:
+            self.categories = dict((col, list(categories[col]))
+                                   for col in self.groupable)
+            self.index = dict(
+                (col, dict((v, i) for i, v in enumerate(self.categories[col])))
+                for col in self.groupable)
+
+    def load_arrays(self, ts, codes, values, categories):
+        '''
+        Replaces the store's rows with prepared arrays (e.g. memory-mapped
+        snapshot columns), which are only read, and the categories their
+        codes index.
+        '''
+        with self.lock:
+            self.base = Columns(
+                ts, dict((col, codes[col]) for col in self.groupable),
+                dict((m, values[m]) for m in self.measures))
+            self.tail = self._empty()
+            self.set_categories(categories)
+            self.watermark = to_datetimes(ts[-1:])[0] if len(ts) else None
+            self.truncated_at = None
+            self._trim()
+
+    def _trim(self):
+        if not self.memory_mb or not len(self):
+            return
+        per_row = self.nbytes / len(self)
+        keep = int(self.memory_mb * 2 ** 20 // per_row)
+        if keep >= len(self):
+            return
+        drop = len(self) - keep
+        from_base = min(drop, len(self.base))
+        self.base.drop_first(from_base)
+        self.tail.drop_first(drop - from_base)
+        first = self.base if len(self.base) else self.tail
+        self.truncated_at = int(first.ts[0])
+
+    def refresh(self, chunk_size=None):
+        '''
+        Loads the rows newer than the watermark, and reloads those within
+        `columnar.overlap` seconds before it; returns how many were read.
+        '''
+        chunk_size = chunk_size or columnar_conf.get('chunk_size', 100000)
+        overlap = columnar_conf.get('overlap') or 0
+        t = tables[self.table]
+        ts = getattr(t, table_cols[self.table]['timestamp'])
+        q = sqlalchemy.select(
+            [ts] + [getattr(t, c) for c in self.groupable + self.measures])\
+            .where(ts != None).order_by(ts)
+        watermark, cut = self.watermark, None
+        if watermark is not None and overlap:
+            cut = watermark - datetime.timedelta(seconds=overlap)
+            q = q.where(ts >= cut)
+        elif watermark is not None:
+            q = q.where(ts > watermark)
+
+        n = 0
+        # Reloaded rows are held until they are all read, then replace the
+        # rows held at once; newer rows are appended chunk by chunk
+        pending = []
+        # A server-side cursor needs a transaction, so not the read engine
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(q)
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                n += len(rows)
+                if cut is not None and rows[-1][0] <= watermark:
+                    pending.append(rows)
+                    continue
+                self.append(pending + [rows], replace_from=cut)
+                pending, cut = [], None
+        if cut is not None:
+            self.append(pending, replace_from=cut)
+        return n
+
+    def covers(self, columns, tstart=None):
+        ''' Whether the store holds `columns` for every row from `tstart` '''
+        held = set(self.groupable + self.measures +
+                   [table_cols[self.table]['timestamp']])
+        if not set(columns) <= held:
+            return False
+        if self.truncated_at is None:
+            return True
+        return tstart is not None and to_us(tstart) > self.truncated_at
+
+    def _window(self, tstart=None, tend=None):
+        '''
+        Returns the rows from `tstart` until before `tend` as `Columns`:
+        views when they lie in the base or the tail alone, else a copy.
+        '''
+        parts = []
+        for rows in (self.base, self.tail):
+            ts = rows.ts
+            lo = np.searchsorted(ts, to_us(tstart), 'left') if tstart else 0
+            hi = np.searchsorted(ts, to_us(tend), 'left') if tend else len(ts)
+            if hi > lo:
+                parts.append(rows.window(lo, hi))
+        if not parts:
+            return self.tail.window(0, 0)
+        return parts[0] if len(parts) == 1 else Columns.concatenate(parts)
+
+    def column(self, col, rows):
+        ''' Returns measure `col` of `rows`; the timestamp counts as 1 '''
+        if col == table_cols[self.table]['timestamp']:
+            return np.ones(len(rows))
+        return rows.values[col]
+
+    def get_arrays(self, response_col, target_col=None, target=None,
+                   start=None, end=None, bucket=None, how='avg'):
+        '''
+        See `agg.get`; returns (epoch microseconds, values with NaN for NULL)
+        arrays, always sorted.
+        '''
+        with self.lock:
+            rows = self._window(start, end)
+            ts = rows.ts
+            values = self.column(response_col, rows)
+            if target_col and target:
+                code = self.index[target_col].get(target, -2)
+                mask = rows.codes[target_col] == code
+                ts, values = ts[mask], values[mask]
+
+        if bucket:
+            ts, values = reduce_runs(bucket_keys(ts, bucket), values, how)
+        return ts, values
+
+    def get(self, response_col, target_col=None, target=None, start=None,
+            end=None, bucket=None, how='avg'):
+        ''' See `agg.get`; rows are always sorted '''
+        ts, values = self.get_arrays(response_col, target_col, target, start,
+                                     end, bucket, how)
+        return [(t, None if np.isnan(v) else float(v))
+                for t, v in zip(to_datetimes(ts), values)]
+
+    def _group_keys(self, xs, rows):
+        '''
+        Returns a combined key per row of the `xs` codes and a function
+        mapping a key back to the tuple of group values.
+        '''
+        # Shift by one so NULL (-1) becomes a group of its own
+        codes = [rows.codes[x].astype(np.int64) + 1 for x in xs]
+        sizes = [len(self.categories[x]) + 1 for x in xs]
+        keys = np.ravel_multi_index(codes, sizes) if codes else \
+            np.zeros(len(rows), dtype=np.int64)
+
+        def labels(key):
+            return tuple(None if c == 0 else self.categories[x][c - 1]
+                         for x, c in zip(xs, np.unravel_index(key, sizes)))
+        return keys, labels
+
+    def groupby(self, xs, ys, agg, tstart=None, tend=None):
+        ''' See `agg.groupby` '''
+        with self.lock:
+            rows = self._window(tstart, tend)
+            keys, labels = self._group_keys(xs, rows)
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            result = {}
+            for y in ys:
+                groups, values = reduce_runs(keys, self.column(y, rows)[order],
+                                             agg)
+                for key, value in zip(groups, values):
+                    result.setdefault(labels(key), {})[y] = \
+                        _scalar(value, agg)
+        return result
+
+    def groupdo(self, yn, aggs, tstart=None, tend=None):
+        ''' See `agg.groupdo` '''
+        with self.lock:
+            rows = self._window(tstart, tend)
+            values = self.column(yn, rows)
+        keys = np.zeros(len(values), dtype=np.int64)
+        result = []
+        for agg in aggs:
+            _, value = reduce_runs(keys, values, agg)
+            result.append(_scalar(value[0], agg) if len(value) else
+                          (0 if agg.lower() == 'count' else None))
+        return [tuple(result)]
+
+    def group_means(self, x, y, tstart=None, tend=None):
+        '''
+        Returns the groups of `x` with a non-NULL `y`, the mean of `y` in
+        each, and every non-NULL `y` in the window.
+        '''
+        with self.lock:
+            rows = self._window(tstart, tend)
+            keys, labels = self._group_keys([x], rows)
+            values = self.column(y, rows)
+        present = ~np.isnan(values)
+        keys, values = keys[present], values[present]
+        order = np.argsort(keys, kind='mergesort')
+        groups, means = reduce_runs(keys[order], values[order], 'avg')
+        return [labels(g)[0] for g in groups], means, values
+
+    def comparison_ts(self, target_col, groups, resp, bucket=None):
+        ''' See `agg.get_comparison_ts`; rows are always sorted '''
+        with self.lock:
+            rows = self._window()
+            # Lookup table over codes shifted by one for NULL
+            selected = np.zeros(len(self.categories[target_col]) + 1, bool)
+            selected[[self.index[target_col][g] + 1 for g in groups
+                      if g in self.index[target_col]]] = True
+            mask = selected[rows.codes[target_col] + 1]
+            ts = rows.ts[mask]
+            values = self.column(resp, rows)[mask]
+        if bucket == 'day':
+            ts = bucket_keys(ts, 'day')
+        ts, values = reduce_runs(ts, values, 'avg')
+        times = ts.astype('M8[us]').astype('M8[D]').astype(object) \
+            if bucket == 'day' else to_datetimes(ts)
+        return [(t, None if np.isnan(v) else float(v))
+                for t, v in zip(times, values)]
+
+    def stats(self):
+        return {'rows': len(self), 'bytes': self.nbytes,
+                'mapped_rows': len(self.base), 'tail_rows': len(self.tail),
+                'watermark': str(self.watermark),
+                'truncated_at': None if self.truncated_at is None else
+                str(to_datetimes([self.truncated_at])[0])}
+
+
+stores = {}
+
+
+def get_store(table):
+    ''' Returns the loaded store of `table`, or None '''
+    store = stores.get(table)
+    if store is None or store.watermark is None:
+        return None
+    return store
+
+
+def refresh_all(interval=None):
+    '''
+    Loads new rows into every table's store; with `interval`, keeps doing
+    so every `interval` seconds.
+    '''
+    while True:
+        for table in table_cols:
+            if table not in stores:
+                # Start from the on-disk snapshot when there is one
+                import snapshot
+                stores[table] = snapshot.load(table,
+                                              columnar_conf.get('memory_mb')) \
+                    or ColumnStore(table, columnar_conf.get('memory_mb'))
+            store = stores[table]
+            start = time.time()
+            try:
+                n = store.refresh()
+            except SQLAlchemyError:
+                logger.exception('Columnar refresh of {} failed'.format(table))
+                continue
+            finally:
+                session.remove()
+            if n:
+                logger.info('Loaded {} rows of {} in {:.1f}s ({} MB)'.format(
+                    n, table, time.time() - start, store.nbytes // 2 ** 20))
+
+        if not interval:
+            return
+        time.sleep(interval)
+
+
+def stats():
+    return dict((table, store.stats()) for table, store in stores.items())
+
+
+_refresh_thread = None
+
+
+def start():
+    '''
+    Starts refreshing the stores in the background, if enabled; called by
+    the processes that serve queries.
+    '''
+    global _refresh_thread
+    if not columnar_conf.get('enabled'):
+        return
+    if _refresh_thread is not None and _refresh_thread.is_alive():
+        return
+    _refresh_thread = threading.Thread(
+        target=refresh_all, args=(columnar_conf.get('refresh', 300),))
+    _refresh_thread.daemon = True
+    _refresh_thread.start()
@@ -0,0 +1,12 @@
+# coding: utf-8
+'''
+Tempus configuration.
+
+Read from `application.yml.conf`, or the file TEMPUS_CONF points at (e.g. a
+benchmark database's). Importing it touches no database, unlike initdb.
+'''
+import os
+import yaml
+
+with open(os.environ.get('TEMPUS_CONF', 'application.yml.conf')) as f:
+    conf = yaml.safe_load(f)
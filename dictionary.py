@@ -0,0 +1,262 @@
+# coding: utf-8
+'''
+Dictionaries of the groups of the configured tables.
+
+For every table and each of its `groupable` columns, a dictionary table in
+the `tempus_internal` schema holds one row per distinct value with
+
+    n           rows with that value
+    first_seen  earliest timestamp of those rows
+    last_seen   latest timestamp of those rows
+
+so listing, searching and ranking groups reads the dictionary instead of
+scanning the raw table. `tempus.py dictionary` builds them and later adds
+the rows past each dictionary's watermark, like the daily rollups; until
+then, queries merge those rows in from the raw table (see `current`).
+'''
+from __future__ import print_function
+from initdb import tables, table_cols, engine, read_engine
+from sqlalchemy import func, Table, Column, Index, BigInteger, DateTime, \
+    Text
+import logging
+import time
+import sqlalchemy
+import rollup
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+meta_internal = rollup.meta_internal
+
+SORTS = ('value', 'count')
+
+_dictionaries = {}
+_available = {}
+_watermarks = {}
+
+
+def dictionary_name(table, group_col):
+    ''' Returns the dictionary table name of a table's groupable column '''
+    return '_{}_{}_groups'.format(table, group_col)
+
+
+def get_dictionary_table(table, group_col):
+    ''' Returns the dictionary `Table` of a table's groupable column '''
+    key = (table, group_col)
+    if key not in _dictionaries:
+        name = dictionary_name(table, group_col)
+        _dictionaries[key] = Table(name, meta_internal,
+            Column('value', tables[table].__table__.c[group_col].type,
+                   primary_key=True, autoincrement=False),
+            Column('n', BigInteger, nullable=False),
+            Column('first_seen', DateTime),
+            Column('last_seen', DateTime),
+            Index('{}_n'.format(name), 'n'),
+        )
+    return _dictionaries[key]
+
+
+def _recheck():
+    # Internal tables are all looked for again at the rollups' interval
+    return rollup.rollup_conf.get('recheck', 60)
+
+
+def available(table, group_col):
+    '''
+    Returns whether the dictionary of `table` and `group_col` exists.
+
+    A missing dictionary is looked for again every `rollup.recheck`
+    seconds, so running processes pick up dictionaries built after they
+    started.
+    '''
+    key = (table, group_col)
+    found, checked = _available.get(key, (False, None))
+    if not found and (checked is None or time.time() - checked >= _recheck()):
+        found = engine.has_table(dictionary_name(table, group_col),
+                                 schema=meta_internal.schema)
+        _available[key] = (found, time.time())
+    return found
+
+
+def watermark(table, group_col):
+    '''
+    Returns the latest timestamp counted in the dictionary of `table` and
+    `group_col`, read again every `rollup.recheck` seconds.
+    '''
+    key = (table, group_col)
+    checked, value = _watermarks.get(key, (None, None))
+    if checked is None or time.time() - checked >= _recheck():
+        value = read_engine.execute(
+            sqlalchemy.select([rollup.watermarks.c.watermark])
+            .where(rollup.watermarks.c.name ==
+                   dictionary_name(table, group_col))).scalar()
+        _watermarks[key] = (time.time(), value)
+    return value
+
+
+def _select_groups(table, group_col, since=None, until=None):
+    ''' Returns a SELECT of dictionary rows from the raw rows '''
+    t = tables[table]
+    ts = getattr(t, table_cols[table]['timestamp'])
+    group = getattr(t, group_col)
+    q = sqlalchemy.select([group.label('value'), func.count().label('n'),
+                           func.min(ts).label('first_seen'),
+                           func.max(ts).label('last_seen')])\
+        .select_from(t.__table__).where(group != None)
+    if since is not None:
+        q = q.where(ts > since)
+    if until is not None:
+        q = q.where(ts <= until)
+    return q.group_by(group)
+
+
+def _create_search_index(conn, dictionary):
+    # Prefix searches lower-case the value (as text); text_pattern_ops lets
+    # LIKE 'prefix%' use the index whatever the collation
+    quote = engine.dialect.identifier_preparer.quote
+    conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} '
+                 '(lower(CAST(value AS TEXT)) text_pattern_ops)'.format(
+                     quote('{}_search'.format(dictionary.name)),
+                     engine.dialect.identifier_preparer.format_table(
+                         dictionary)))
+
+
+def refresh(table, group_col, full=False):
+    '''
+    Adds the rows of `table` past the dictionary's watermark to its
+    dictionary of `group_col`.
+
+    Counts only grow, so a refresh reads just the rows after the latest
+    timestamp seen and adds them to the groups already there; `full`
+    rebuilds the dictionary from scratch. Rows without a timestamp, and
+    rows inserted with a timestamp at or before the watermark, are only
+    counted by a full rebuild.
+
+    Returns
+    -------
+    int
+        Number of dictionary rows written.
+
+    '''
+    dictionary = get_dictionary_table(table, group_col)
+    name = dictionary.name
+    ts = getattr(tables[table], table_cols[table]['timestamp'])
+    columns = [c.name for c in dictionary.columns]
+
+    with engine.begin() as conn:
+        conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(
+            meta_internal.schema))
+        rollup.watermarks.create(conn, checkfirst=True)
+        dictionary.create(conn, checkfirst=True)
+        _create_search_index(conn, dictionary)
+
+        since = None if full else rollup.get_watermark(conn, name)
+        until = conn.execute(sqlalchemy.select([func.max(ts)])).scalar()
+
+        if since is None:
+            conn.execute(dictionary.delete())
+            written = conn.execute(dictionary.insert().from_select(
+                columns, _select_groups(table, group_col))).rowcount
+        elif until is None or until <= since:
+            written = 0
+        else:
+            new = _select_groups(table, group_col, since, until)\
+                .alias('new')
+            d = dictionary.c
+            written = conn.execute(dictionary.update()
+                .where(d.value == new.c.value)
+                .values(n=d.n + new.c.n,
+                        first_seen=func.least(d.first_seen,
+                                              new.c.first_seen),
+                        last_seen=func.greatest(d.last_seen,
+                                                new.c.last_seen))).rowcount
+            exists = sqlalchemy.exists().where(d.value == new.c.value)
+            written += conn.execute(dictionary.insert().from_select(
+                columns, sqlalchemy.select([new.c[c] for c in columns])
+                .where(~exists))).rowcount
+        if until is not None:
+            rollup.set_watermark(conn, name, until)
+
+    _available[(table, group_col)] = (True, time.time())
+    _watermarks[(table, group_col)] = (time.time(), until)
+    logger.info('Dictionary {}: {} rows through {}'.format(name, written,
+                                                           until))
+    return written
+
+
+def refresh_all(names=None, full=False):
+    ''' Refreshes the dictionaries of every groupable of the named tables '''
+    for table in names or table_cols:
+        for group_col in table_cols[table].get('groupable', []):
+            refresh(table, group_col, full=full)
+
+
+def _like_escape(text):
+    # '!' rather than a backslash, which dialects quote differently
+    return text.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+
+def search_query(source, prefix=None, contains=None, sort='value',
+                 limit=None, offset=None):
+    '''
+    Returns a SELECT of the rows of `source` (a dictionary table, or any
+    selectable with its columns) matching a case-insensitive `prefix`
+    and/or substring `contains`, ordered by value or by descending count.
+    '''
+    if sort not in SORTS:
+        raise ValueError('Unknown sort {}'.format(sort))
+    c = source.c
+    text = func.lower(sqlalchemy.cast(c.value, Text))
+    q = sqlalchemy.select([c.value, c.n, c.first_seen, c.last_seen])
+    if prefix:
+        q = q.where(text.like(_like_escape(prefix.lower()) + '%',
+                              escape='!'))
+    if contains:
+        q = q.where(text.like('%' + _like_escape(contains.lower()) + '%',
+                              escape='!'))
+    if sort == 'count':
+        q = q.order_by(c.n.desc(), c.value)
+    else:
+        q = q.order_by(c.value)
+    if limit is not None:
+        q = q.limit(limit)
+    if offset:
+        q = q.offset(offset)
+    return q
+
+
+def current(table, group_col):
+    '''
+    Returns the dictionary of `table` and `group_col` brought up to date.
+
+    The result has the dictionary's columns: its groups merged with those
+    of the raw rows past its watermark, adding their counts. Without a
+    watermark (the table was empty when built) every raw row is grouped.
+    '''
+    dictionary = get_dictionary_table(table, group_col)
+    mark = watermark(table, group_col)
+    if mark is None:
+        return _select_groups(table, group_col).alias(dictionary.name)
+    d = dictionary.c
+    merged = sqlalchemy.union_all(
+        sqlalchemy.select([d.value, d.n, d.first_seen, d.last_seen]),
+        _select_groups(table, group_col, since=mark)).alias('merged')
+    return sqlalchemy.select([
+        merged.c.value,
+        sqlalchemy.cast(func.sum(merged.c.n), BigInteger).label('n'),
+        func.min(merged.c.first_seen).label('first_seen'),
+        func.max(merged.c.last_seen).label('last_seen')])\
+        .group_by(merged.c.value).alias(dictionary.name)
+
+
+def source(table, group_col):
+    '''
+    Returns the up to date dictionary of `table` and `group_col` (see
+    `current`) when built, else an equivalent subquery of the raw table.
+    '''
+    if available(table, group_col):
+        return current(table, group_col)
+    logger.warning('No dictionary of {}.{}; scanning the table (run '
+                   '`tempus.py dictionary`)'.format(table, group_col))
+    return _select_groups(table, group_col).alias('groups')
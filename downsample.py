@@ -0,0 +1,93 @@
+# coding: utf-8
+'''
+Visual downsampling of time series for plotting.
+'''
+from __future__ import division
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    '''
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Keeps the first and last points and, from each of `threshold - 2` equal
+    buckets in between, the point forming the largest triangle with the
+    previously kept point and the average of the next bucket. This preserves
+    the visual shape of the series far better than striding.
+
+    Parameters
+    ----------
+    x : array_like
+        Increasing x coordinates (e.g. epoch seconds).
+    y : array_like
+        Values, aligned with `x`.
+    threshold : int
+        Number of points to keep, at least 3 (the first, the last and one
+        in between).
+
+    Returns
+    -------
+    numpy.ndarray
+        Indices of the kept points, increasing.
+
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    _check(threshold)
+    if threshold >= n:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    kept = np.empty(threshold, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+
+    return kept
+
+
+def _check(threshold):
+    if threshold < 3:
+        raise ValueError('Cannot downsample to fewer than 3 points')
+
+
+def lttb_rows(rows, threshold):
+    '''
+    Downsamples (timestamp, value) rows, sorted by timestamp, to at most
+    `threshold` rows. Rows with a missing value are dropped.
+    '''
+    _check(threshold)
+    rows = [row for row in rows if row[1] is not None]
+    if len(rows) <= threshold:
+        return rows
+
+    x = np.array([row[0] for row in rows], dtype='datetime64[us]')
+    y = np.array([row[1] for row in rows], dtype=float)
+    return [rows[i] for i in lttb(x.astype(np.int64), y, threshold)]
+
+
+def lttb_arrays(t, v, threshold):
+    '''
+    Downsamples sorted timestamp and value arrays to at most `threshold`
+    points. Points with a NaN value are dropped.
+    '''
+    _check(threshold)
+    keep = ~np.isnan(v)
+    t, v = t[keep], v[keep]
+    if len(t) <= threshold:
+        return t, v
+    index = lttb(t, v, threshold)
+    return t[index], v[index]
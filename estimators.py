@@ -0,0 +1,288 @@
+# coding: utf-8
+'''
+Statistical estimators that run inside the Tempus process.
+
+These mirror models from the `rlines` R package so that the API can answer
+without a round trip to OpenCPU.
+'''
+from __future__ import division
+import numpy as np
+from scipy import stats
+from scipy.special import expit
+
+
+def _summary(b, se, df):
+    ''' Returns {b, se, t, p} for an estimate with a two-sided t-test. '''
+    t = b / se
+    p = 2 * stats.t.sf(np.abs(t), df)
+    return {'b': float(b), 'se': float(se), 't': float(t), 'p': float(p)}
+
+
+def _summaries(b, se, df):
+    ''' `_summary` of arrays of estimates, computed at once '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = b / se
+    p = 2 * stats.t.sf(np.abs(t), df)
+    return [{'b': float(b_), 'se': float(se_), 't': float(t_), 'p': float(p_)}
+            for b_, se_, t_, p_ in zip(b, se, t, p)]
+
+
+def diffindiff(dates, target, comparison, event_date, logged=False,
+               normalize=False):
+    '''
+    Difference-in-difference estimate of `counts ~ post*group`.
+
+    Parameters
+    ----------
+    dates : array_like of datetime64
+        Daily dates shared by both series.
+    target : array_like
+        Target region counts, aligned with `dates`.
+    comparison : array_like
+        Comparison counts (sum over comparison regions), aligned with `dates`.
+    event_date : str
+        Date string, in the format YYYY-mm-dd. Observations strictly after it
+        are treated as post-event.
+    logged : bool, optional
+        Log transform (`log(1 + x)`) the counts before fitting.
+    normalize : bool, optional
+        Rescale the comparison series to the target's pre-event mean; the
+        comparison's pre-event mean must not be 0.
+
+    Returns
+    -------
+    dict
+        Same layout as `rlines::diffindiff_data`: `diff_in_diff`,
+        `target_diff` and `comparison_diff` map to {b, se, t, p}, and `data`,
+        `target` and `comparison` hold the (transformed) series as records.
+
+    Notes
+    -----
+    The model is saturated in `post` and `group`, so the OLS coefficients are
+    differences of the four cell means and the covariance matrix reduces to
+    the residual variance over the cell sizes. p-values use the same
+    `df - 1` degrees of freedom as rlines so results can be cross-checked.
+
+    '''
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    target, comparison, estimates = _diffindiff_columns(
+        dates, np.asarray(target, dtype=float)[:, None],
+        np.asarray(comparison, dtype=float)[:, None], event_date, logged,
+        normalize)
+    target, comparison = target[:, 0], comparison[:, 0]
+
+    day = np.datetime_as_string(dates)
+    return {
+        'diff_in_diff': estimates[0]['diff_in_diff'],
+        'target_diff': estimates[0]['target_diff'],
+        'comparison_diff': estimates[0]['comparison_diff'],
+        'data': [{'date': d, 'Comparison': float(c), 'Target': float(t)}
+                 for d, c, t in zip(day, comparison, target)],
+        'comparison': [{'date': d, 'counts': float(c)}
+                       for d, c in zip(day, comparison)],
+        'target': [{'date': d, 'counts': float(t)}
+                   for d, t in zip(day, target)],
+    }
+
+
+def _diffindiff_columns(dates, target, comparison, event_date, logged,
+                        normalize):
+    '''
+    Fits `diffindiff` to every column pair of the (dates x K) matrices
+    `target` and `comparison` at once.
+
+    Returns the transformed matrices and, per column, the three estimates.
+    '''
+    post = dates > np.datetime64(event_date, 'D')
+    pre = ~post
+    n_post, n_pre = post.sum(), pre.sum()
+    dof = 2 * len(dates) - 4
+    if not n_post or not n_pre or dof < 2:
+        raise ValueError('Need observations before and after {}'.format(
+            event_date))
+
+    if logged:
+        target = np.log1p(target)
+        comparison = np.log1p(comparison)
+
+    t_pre, t_post = target[pre].mean(axis=0), target[post].mean(axis=0)
+    if normalize:
+        c_pre = comparison[pre].mean(axis=0)
+        if (c_pre == 0).any():
+            raise ValueError('Cannot normalize a comparison with no counts'
+                             ' before {}'.format(event_date))
+        comparison = comparison * t_pre / c_pre
+    c_pre, c_post = comparison[pre].mean(axis=0), comparison[post].mean(axis=0)
+
+    post = post[:, None]
+    ssr = ((target - np.where(post, t_post, t_pre)) ** 2).sum(axis=0) + \
+        ((comparison - np.where(post, c_post, c_pre)) ** 2).sum(axis=0)
+    # Variance of a pre/post difference of means within one group
+    cell_var = ssr / dof * (1 / n_pre + 1 / n_post)
+
+    estimates = zip(
+        _summaries((t_post - t_pre) - (c_post - c_pre),
+                   np.sqrt(2 * cell_var), dof - 1),
+        _summaries(t_post - t_pre, np.sqrt(cell_var), dof - 1),
+        _summaries(c_post - c_pre, np.sqrt(cell_var), dof - 1))
+    return target, comparison, [
+        {'diff_in_diff': d, 'target_diff': t, 'comparison_diff': c}
+        for d, t, c in estimates]
+
+
+def diffindiff_many(dates, targets, comparisons, event_date, logged=False,
+                    normalize=False):
+    '''
+    `diffindiff` of many target and comparison series sharing an event date.
+
+    Parameters
+    ----------
+    dates : array_like of datetime64
+        Daily dates shared by all series.
+    targets : array_like
+        Target counts, one column per estimate.
+    comparisons : array_like
+        Comparison counts, aligned column by column with `targets`.
+    event_date, logged, normalize
+        See `diffindiff`.
+
+    Returns
+    -------
+    list of dict
+        Per column, `diff_in_diff`, `target_diff` and `comparison_diff`
+        mapping to {b, se, t, p}.
+
+    '''
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    return _diffindiff_columns(dates, np.asarray(targets, dtype=float),
+                               np.asarray(comparisons, dtype=float),
+                               event_date, logged, normalize)[2]
+
+
+def propensity_scores(X, treated, weights=None, ridge=1.0, tol=1e-8,
+                      max_iter=100):
+    '''
+    Fits a logistic regression of treatment on covariates.
+
+    Parameters
+    ----------
+    X : array_like
+        Covariate matrix, one row per unit.
+    treated : array_like of bool
+        Treatment indicator per unit.
+    weights : array_like, optional
+        Frequency weight per unit, e.g. the number of rows a group mean
+        summarizes (the default weighs units equally).
+    ridge : float, optional
+        L2 penalty on the standardized slopes. Keeps the fit finite when the
+        treated units are separable, as a single treated group often is.
+    tol : float, optional
+        Newton step size at which to stop.
+    max_iter : int, optional
+        Maximum number of Newton (IRLS) iterations.
+
+    Returns
+    -------
+    numpy.ndarray
+        Fitted propensity score per unit.
+
+    '''
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(treated, dtype=float)
+    w = np.ones(len(y)) if weights is None else np.asarray(weights, float)
+    # Rescale to unit mean weight so `ridge` does not depend on row counts
+    w = w * len(w) / w.sum()
+
+    mean = np.average(X, axis=0, weights=w)
+    std = np.sqrt(np.average((X - mean) ** 2, axis=0, weights=w))
+    std[std == 0] = 1
+    Z = np.column_stack([np.ones(len(y)), (X - mean) / std])
+
+    penalty = ridge * np.eye(Z.shape[1])
+    penalty[0, 0] = 0
+    beta = np.zeros(Z.shape[1])
+    for _ in range(max_iter):
+        p = expit(Z.dot(beta))
+        gradient = Z.T.dot(w * (y - p)) - penalty.dot(beta)
+        hessian = (Z.T * (w * p * (1 - p))).dot(Z) + penalty
+        step = np.linalg.solve(hessian, gradient)
+        beta += step
+        if np.abs(step).max() < tol:
+            break
+
+    return expit(Z.dot(beta))
+
+
+def causal_impact(dates, target, controls, event_date, logged=False, z=1.96):
+    '''
+    Causal effect of an event on a target series, from a counterfactual
+    predicted by control series.
+
+    Regresses the target on the controls before the event, predicts what the
+    target would have been afterwards, and attributes the difference to the
+    event.
+
+    Parameters
+    ----------
+    dates : array_like of datetime64
+        Daily dates shared by all series.
+    target : array_like
+        Target series, aligned with `dates`.
+    controls : array_like
+        Control series as columns, aligned with `dates`.
+    event_date : str
+        Date string, in the format YYYY-mm-dd. Observations strictly after it
+        are treated as post-event.
+    logged : bool, optional
+        Log transform (`log(1 + x)`) the series before fitting.
+    z : float, optional
+        Normal quantile of the prediction intervals (the default is 95%).
+
+    Returns
+    -------
+    dict
+        `average_effect` and `cumulative_effect` map to {b, se, t, p};
+        `relative_effect` is the average effect over the average prediction;
+        `series` holds the actual and predicted target with its interval as
+        records.
+
+    '''
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    y = np.asarray(target, dtype=float)
+    controls = np.asarray(controls, dtype=float).reshape(len(y), -1)
+    if logged:
+        y = np.log1p(y)
+        controls = np.log1p(controls)
+
+    post = dates > np.datetime64(event_date, 'D')
+    pre = ~post
+    X = np.column_stack([np.ones(len(y)), controls])
+    dof = pre.sum() - X.shape[1]
+    if not post.any() or dof < 1:
+        raise ValueError('Need more observations before and after {}'.format(
+            event_date))
+
+    beta = np.linalg.lstsq(X[pre], y[pre], rcond=-1)[0]
+    sigma2 = ((y[pre] - X[pre].dot(beta)) ** 2).sum() / dof
+    XtX_inv = np.linalg.pinv(X[pre].T.dot(X[pre]))
+
+    predicted = X.dot(beta)
+    # Prediction variance: noise plus uncertainty in the fitted coefficients
+    se = np.sqrt(sigma2 * (1 + (X.dot(XtX_inv) * X).sum(axis=1)))
+
+    effect = (y - predicted)[post]
+    n_post = post.sum()
+    total = X[post].sum(axis=0)
+    cumulative_se = np.sqrt(sigma2 * (n_post + total.dot(XtX_inv).dot(total)))
+
+    day = np.datetime_as_string(dates)
+    return {
+        'average_effect': _summary(effect.mean(), cumulative_se / n_post,
+                                   dof),
+        'cumulative_effect': _summary(effect.sum(), cumulative_se, dof),
+        'relative_effect': float(effect.mean() / predicted[post].mean())
+        if predicted[post].mean() else None,
+        'series': [{'date': d, 'actual': float(a), 'predicted': float(p),
+                    'lower': float(p - z * s), 'upper': float(p + z * s)}
+                   for d, a, p, s in zip(day, y, predicted, se)],
+    }
@@ -0,0 +1,147 @@
+# coding: utf-8
+'''
+Index advisor for the configured tables.
+
+Compares the primary key and indexes `initdb` reflects into `table_conf`
+with the access paths of the queries Tempus issues:
+
+    timestamp       time ranges of `agg.get` and `groupby`, and the first
+                    and last timestamp read by `initdb.get_time_range`
+    group_time      a group (`agg.get` targets) or set of groups
+                    (`get_comparison_ts`) over a time range
+    comparisons     per group covariate means of rows with non-NULL
+                    covariates (`get_comparisons`), answered from the index
+
+The timestamp index is a BRIN when the table's rows are stored in time
+order, which keeps it a few pages large, and a btree otherwise.
+`tempus.py indexes` lists the missing ones and creates them with
+`--create`; `/api/_indexes` lists them from a running API.
+'''
+from __future__ import print_function
+from initdb import table_cols, table_conf, engine, read_engine
+from sqlalchemy.exc import SQLAlchemyError
+import collections
+import hashlib
+import logging
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+# Rows at least this correlated with their physical order get a BRIN index
+BRIN_CORRELATION = 0.9
+
+# Longest identifier Postgres keeps
+MAX_NAME = 63
+
+Advice = collections.namedtuple('Advice', 'table kind columns method name')
+
+
+def index_name(table, kind, columns):
+    ''' Returns the name of an advised index, hashed to fit Postgres '''
+    name = '{}_{}_idx'.format(table, '_'.join(columns))
+    if len(name) > MAX_NAME:
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+        name = '{}_{}_{}_idx'.format(table[:MAX_NAME - 23], kind, digest)
+    return name
+
+
+def correlation(table, column):
+    '''
+    Returns the correlation between `column` and the physical order of the
+    rows, as last ANALYZEd, or None if there are no statistics.
+    '''
+    q = sqlalchemy.text(
+        'SELECT correlation FROM pg_stats'
+        ' WHERE schemaname = current_schema() AND tablename = :table'
+        ' AND attname = :column')
+    with read_engine.connect() as conn:
+        return conn.execute(q, table=table, column=column).scalar()
+
+
+def existing(table):
+    ''' Returns the column lists of `table`'s primary key and indexes '''
+    indexes = [list(ix['column_names'])
+               for ix in table_conf[table].get('indexes', [])]
+    if table_conf[table].get('PK'):
+        indexes.append(list(table_conf[table]['PK']))
+    return indexes
+
+
+def covered(columns, indexes):
+    ''' Whether an index leads with `columns`, so it answers their filters '''
+    return any(ix[:len(columns)] == columns for ix in indexes)
+
+
+def advise(table):
+    ''' Returns the `Advice` of every index the queries on `table` use '''
+    cols = table_cols[table]
+    ts = cols['timestamp']
+    covs = list(collections.OrderedDict.fromkeys(
+        c for c in [cols.get('price')] + cols.get('covariates', []) if c))
+
+    r = correlation(table, ts)
+    method = 'brin' if r is not None and abs(r) >= BRIN_CORRELATION \
+        else 'btree'
+    advice = [Advice(table, 'timestamp', [ts], method,
+                     index_name(table, 'timestamp', [ts]))]
+    for group_col in cols.get('groupable', []):
+        columns = [group_col, ts]
+        advice.append(Advice(table, 'group_time', columns, 'btree',
+                             index_name(table, 'group_time', columns)))
+        if covs:
+            columns = [group_col] + covs
+            advice.append(Advice(table, 'comparisons', columns, 'btree',
+                                 index_name(table, 'comparisons', columns)))
+    return advice
+
+
+def missing(table):
+    ''' Returns the `Advice` of `table` no existing index covers '''
+    indexes = existing(table)
+    return [a for a in advise(table) if not covered(a.columns, indexes)]
+
+
+def create(advice, concurrently=False):
+    '''
+    Creates an advised index and records it in `table_conf`.
+
+    With `concurrently`, the table stays writable while the index is built.
+    '''
+    quote = engine.dialect.identifier_preparer.quote
+    statement = 'CREATE INDEX {}IF NOT EXISTS {} ON {} USING {} ({})'.format(
+        'CONCURRENTLY ' if concurrently else '', quote(advice.name),
+        quote(advice.table), advice.method,
+        ', '.join(quote(c) for c in advice.columns))
+    logger.info(statement)
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        conn.execute(statement)
+        conn.execute('ANALYZE {}'.format(quote(advice.table)))
+    table_conf[advice.table].setdefault('indexes', []).append(
+        {'name': advice.name, 'column_names': advice.columns,
+         'unique': False})
+
+
+def report(names=None):
+    '''
+    Logs the indexes the configured tables (or `names`) lack.
+
+    Returns the missing `Advice`.
+    '''
+    result = []
+    for table in names or table_cols:
+        try:
+            advice = missing(table)
+        except SQLAlchemyError:
+            logger.exception('Index advice for {} failed'.format(table))
+            continue
+        for a in advice:
+            logger.warning('{} lacks a {} index on ({}) for {} queries; see'
+                           ' `tempus.py indexes`'.format(
+                               table, a.method, ', '.join(a.columns),
+                               a.kind))
+        result.extend(advice)
+    return result
@@ -1,13 +1,19 @@
 # coding: utf-8
-import yaml
 import json
+import hashlib
+import os
+import pickle
+import threading
+import time
 import sqlalchemy
-from sqlalchemy.orm import Session
-from sqlalchemy import func, MetaData
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import event, func, MetaData
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.engine import reflection
 from collections import defaultdict
 import logging
+from config import conf
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -16,52 +22,188 @@ logger.setLevel(logging.DEBUG)
 
 def get_time_range(table, timestamp):
     ts = getattr(tables[table], timestamp)
-    q = session.query(func.min(ts), func.max(ts))
-    resp = q.first()
+    # ORDER BY ... LIMIT 1 walks an index on the timestamp when there is one
+    first = sqlalchemy.select([ts]).where(ts != None).limit(1)
+    with read_engine.connect() as conn:
+        time_min = conn.execute(first.order_by(ts.asc())).scalar()
+        time_max = conn.execute(first.order_by(ts.desc())).scalar()
 
-    logger.debug(resp)
-    time_min, time_max = resp
+    logger.debug((time_min, time_max))
     return map(str, (time_min, time_max))
 
-# Initialize application by reading in configuration files
-with open('application.yml.conf') as f:
-    conf = yaml.safe_load(f)
+
+def refresh_time_ranges(interval=None):
+    '''
+    Fills in `_min_time` and `_max_time` of every configured table.
+
+    With `interval`, keeps refreshing them every `interval` seconds.
+    '''
+    while True:
+        for table in table_cols:
+            try:
+                min_time, max_time = get_time_range(
+                    table, table_cols[table]['timestamp'])
+            except SQLAlchemyError:
+                logger.exception('Time range of {} failed'.format(table))
+                continue
+            finally:
+                session.remove()
+            table_cols[table]['_min_time'] = min_time
+            table_cols[table]['_max_time'] = max_time
+
+        if not interval:
+            return
+        time.sleep(interval)
+
+
+def schema_fingerprint():
+    '''
+    Returns a hash of the column and index definitions Tempus reflects.
+
+    Only reads the catalogs, so it is cheap next to a full reflection.
+    '''
+    params = {'tables': list(conf['tables']),
+              'geography': list(conf['tempus_geography'])}
+    columns = sqlalchemy.text(
+        'SELECT table_schema, table_name, column_name, data_type, is_nullable'
+        ' FROM information_schema.columns'
+        ' WHERE (table_schema = current_schema()'
+        '        AND table_name = ANY(:tables))'
+        '    OR (table_schema = \'tempus_geography\''
+        '        AND table_name = ANY(:geography))'
+        '    OR table_schema = \'tempus_library\''
+        ' ORDER BY table_schema, table_name, ordinal_position')
+    indexes = sqlalchemy.text(
+        'SELECT schemaname, tablename, indexname, indexdef FROM pg_indexes'
+        ' WHERE schemaname = current_schema() AND tablename = ANY(:tables)'
+        ' ORDER BY schemaname, tablename, indexname')
+
+    digest = hashlib.sha1()
+    with read_engine.connect() as conn:
+        for q in (columns, indexes):
+            for row in conn.execute(q, **params):
+                digest.update(repr(tuple(row)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def reflect():
+    ''' Reflects the configured tables and their constraints '''
+    metadata = MetaData()
+    metadata.reflect(engine, only=list(conf['tables']))
+
+    metadata_geography = MetaData(schema='tempus_geography')
+    metadata_geography.reflect(engine, schema='tempus_geography',
+                               only=conf['tempus_geography'].keys())
+
+    metadata_library = MetaData(schema='tempus_library')
+    metadata_library.reflect(engine, schema='tempus_library')
+
+    insp = reflection.Inspector.from_engine(engine)
+    table_conf = defaultdict(dict)
+    for table in conf['tables']:
+        table_conf[table]['PK'] = \
+            insp.get_pk_constraint(table)['constrained_columns']
+        table_conf[table]['indexes'] = insp.get_indexes(table)
+
+    return metadata, metadata_geography, metadata_library, table_conf
+
+
+def load_reflection(path):
+    '''
+    Returns `reflect()` results, from the cache file at `path` when the
+    schema fingerprint still matches, otherwise fresh (and cached).
+    '''
+    fingerprint = schema_fingerprint()
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['fingerprint'] == fingerprint:
+            return cached['reflection']
+        logger.info('Schema changed, reflecting again')
+    except (IOError, OSError, EOFError, KeyError, pickle.UnpicklingError):
+        logger.info('No usable reflection cache at {}'.format(path))
+
+    reflected = reflect()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Write to a temporary file first so concurrent workers never read half
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump({'fingerprint': fingerprint, 'reflection': reflected}, f,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+    return reflected
+
+def pool_options(pool_conf):
+    ''' Maps the `pool` configuration section to `create_engine` options '''
+    options = {'size': 'pool_size', 'max_overflow': 'max_overflow',
+               'recycle': 'pool_recycle', 'timeout': 'pool_timeout'}
+    return dict((options[k], v) for k, v in (pool_conf or {}).items())
+
+
+def _read_only(dbapi_connection, connection_record):
+    # Analytic connections never write, and never hold a transaction open
+    dbapi_connection.autocommit = True
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SET default_transaction_read_only = on')
+    cursor.close()
+
 
 
 # Load configured tables into memory
-Base = automap_base()
 tables = {}
 table_cols = {}
-table_conf = defaultdict(dict)
 
 # Generate default base
-engine = sqlalchemy.create_engine(conf['db'])
-insp = reflection.Inspector.from_engine(engine)
-Base.prepare(engine, reflect=True)
-session = Session(engine)
+engine = sqlalchemy.create_engine(conf['db'],
+                                  **pool_options(conf.get('pool')))
 
-# Generate geography, library bases
-metadata_geography = MetaData(schema='tempus_geography')
-metadata_geography.reflect(engine, schema='tempus_geography',
-                           only=conf['tempus_geography'].keys())
+# Pool of autocommit, read-only connections for one-shot analytic queries
+read_engine = sqlalchemy.create_engine(conf['db'],
+                                       isolation_level='AUTOCOMMIT',
+                                       **pool_options(conf.get('pool')))
+event.listen(read_engine, 'connect', _read_only)
+
+# Thread-local sessions; the API removes each one when its request ends
+session = scoped_session(sessionmaker(bind=engine))
+
+metadata, metadata_geography, metadata_library, table_conf = \
+    load_reflection(conf.get('reflection_cache', '.tempus_cache/schema.pkl'))
 
-metadata_library = MetaData(schema='tempus_library')
-metadata_library.reflect(engine, schema='tempus_library')
+Base = automap_base(metadata=metadata)
+Base.prepare()
 
+# Generate geography, library bases
 Base_geo = automap_base(metadata=metadata_geography)
-Base_geo.prepare(engine, reflect=True)
+Base_geo.prepare()
 
 Base_lib = automap_base(metadata=metadata_library)
-Base_lib.prepare(engine, reflect=True)
+Base_lib.prepare()
 
 for table in conf['tables']:
     tables[table] = Base.classes[table]
 
     table_cols[table] = conf['tables'][table]
-    min_time, max_time = get_time_range(table, table_cols[table]['timestamp'])
-    table_cols[table]['_min_time'] = min_time
-    table_cols[table]['_max_time'] = max_time
+    # Filled in by `start_time_ranges`
+    table_cols[table]['_min_time'] = None
+    table_cols[table]['_max_time'] = None
+
+_time_ranges = None
+_time_ranges_lock = threading.Lock()
+
 
-    table_conf[table]['PK'] = \
-        insp.get_pk_constraint(table)['constrained_columns']
-    table_conf[table]['indexes'] = insp.get_indexes(table)
+def start_time_ranges():
+    '''
+    Starts refreshing the tables' time ranges in the background; called by
+    the API once serving, so other processes importing initdb do not.
+    '''
+    global _time_ranges
+    with _time_ranges_lock:
+        if _time_ranges is not None and _time_ranges.is_alive():
+            return
+        _time_ranges = threading.Thread(
+            target=refresh_time_ranges,
+            args=(conf.get('time_range_refresh'),))
+        _time_ranges.daemon = True
+        _time_ranges.start()
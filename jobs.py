@@ -0,0 +1,144 @@
+# coding: utf-8
+'''
+Queue of long-running analyses, served by local worker processes.
+
+Jobs live in a SQLite database on the API host, so no broker is needed: the
+API inserts a job and returns its id at once, `tempus.py worker` processes
+claim queued jobs, run them, and store the result (or error) with timings
+for clients to poll. Submitting a job identical to one still queued or
+running returns the existing job instead.
+
+The store itself is `jobstore`; this module binds job kinds to the agg
+functions and runs the workers.
+'''
+from initdb import conf, engine, read_engine, session
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import agg
+import columnar
+import jobstore
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+jobs_conf = conf.get('jobs') or {}
+
+# Job kind -> agg function run with the job's arguments
+KINDS = {
+    'comparison': agg.get_comparisons,
+    'diffindiff': agg.diffindiff,
+    'causalimpact': agg.causalimpact,
+}
+
+
+def connect(path=None):
+    ''' Returns a connection to the configured job store '''
+    return jobstore.connect(
+        path or jobs_conf.get('path', '.tempus_cache/jobs.sqlite'))
+
+
+def submit(kind, args, conn=None):
+    '''
+    Queues a job, unless an identical one is already queued or running.
+
+    Parameters
+    ----------
+    kind : str
+        One of `KINDS`.
+    args : dict
+        Keyword arguments of the job's agg function.
+
+    Returns
+    -------
+    str
+        Id of the queued (or identical in-flight) job.
+
+    '''
+    if kind not in KINDS:
+        raise ValueError('Unknown job kind {}'.format(kind))
+    return jobstore.submit(conn or connect(), kind, args)
+
+
+def get(job_id, conn=None):
+    '''
+    Returns a job's status, timings and, once done, its result; None for
+    an unknown id.
+    '''
+    return jobstore.get(conn or connect(), job_id)
+
+
+def run(conn, job):
+    ''' Runs a claimed job and stores its result or error '''
+    kind = job['kind']
+
+    def call(**args):
+        with metrics.serving('job:' + kind):
+            return KINDS[kind](**args)
+
+    try:
+        jobstore.run(conn, job, call)
+    finally:
+        # Like a request, a job gets a fresh session
+        session.remove()
+
+
+def work(poll=None):
+    ''' Claims and runs jobs until interrupted '''
+    # Connections inherited from the parent must not be shared across forks
+    engine.dispose()
+    read_engine.dispose()
+    # Threads do not survive the fork; snapshot-backed stores start mapped
+    columnar.start()
+    metrics.start()
+    poll = poll or jobs_conf.get('poll', 0.5)
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    conn = connect()
+    while True:
+        job = jobstore.claim(conn, worker)
+        if job is None:
+            time.sleep(poll)
+            continue
+        run(conn, job)
+
+
+def requeue_running(conn=None):
+    ''' Queues again the jobs left running by dead workers on this host '''
+    return jobstore.requeue_running(conn or connect(), socket.gethostname())
+
+
+def serve(workers=None):
+    '''
+    Runs `workers` worker processes (the default is the `jobs` configuration,
+    or one per core) until interrupted.
+    '''
+    workers = workers or jobs_conf.get('workers') or \
+        multiprocessing.cpu_count()
+    requeue_running()
+    purge()
+    processes = [multiprocessing.Process(target=work) for _ in range(workers)]
+    for p in processes:
+        p.daemon = True
+        p.start()
+    logger.info('Started {} job workers'.format(workers))
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.terminate()
+
+
+def job_metrics(conn=None):
+    ''' Returns job counts and timings per kind, see `jobstore` '''
+    return jobstore.job_metrics(conn or connect())
+
+
+def purge(older_than=None, conn=None):
+    ''' Deletes finished jobs older than `older_than` seconds '''
+    return jobstore.purge(conn or connect(),
+                          older_than or jobs_conf.get('ttl', 7 * 24 * 3600))
@@ -0,0 +1,196 @@
+# coding: utf-8
+'''
+SQLite store of the job queue.
+
+Holds the jobs and their results, and moves them through queued, running
+and done or failed. It knows nothing of the analyses themselves: `jobs`
+binds kinds to agg functions and runs the workers. Only the standard
+library is needed, so the queue works without a Tempus database.
+'''
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+import serialize
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    args TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    worker TEXT,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted);
+CREATE INDEX IF NOT EXISTS jobs_digest ON jobs (digest, status);
+'''
+
+
+def connect(path):
+    ''' Returns a connection to the job store at `path`, creating it '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Autocommit; claims take the write lock explicitly
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def job_digest(kind, args):
+    ''' Returns a digest identifying identical jobs '''
+    payload = json.dumps([kind, args], sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def submit(conn, kind, args):
+    '''
+    Queues a job, unless an identical one is already queued or running.
+
+    Returns
+    -------
+    str
+        Id of the queued (or identical in-flight) job.
+
+    '''
+    digest = job_digest(kind, args)
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE digest = ?"
+            " AND status IN ('queued', 'running')", (digest,)).fetchone()
+        if row is not None:
+            job_id = row['id']
+        else:
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, args, digest, status, submitted)"
+                " VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, kind, json.dumps(args), digest, time.time()))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job_id
+
+
+def get(conn, job_id):
+    '''
+    Returns a job's status, timings and, once done, its result; None for
+    an unknown id.
+    '''
+    row = conn.execute('SELECT * FROM jobs WHERE id = ?',
+                       (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    job = {'id': row['id'], 'kind': row['kind'],
+           'args': json.loads(row['args']), 'status': row['status'],
+           'submitted': row['submitted'], 'started': row['started'],
+           'finished': row['finished'],
+           'wait_seconds': _elapsed(row['submitted'], row['started']),
+           'run_seconds': _elapsed(row['started'], row['finished'])}
+    if row['status'] == 'done':
+        job['result'] = json.loads(row['result'])
+    elif row['status'] == 'failed':
+        job['error'] = row['error']
+    return job
+
+
+def _elapsed(start, end):
+    if start is None:
+        return None
+    return (end or time.time()) - start
+
+
+def claim(conn, worker):
+    ''' Marks the oldest queued job as running and returns it, or None '''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            "SELECT id, kind, args FROM jobs WHERE status = 'queued'"
+            " ORDER BY submitted LIMIT 1").fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ?"
+                " WHERE id = ?", (worker, time.time(), row['id']))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return row
+
+
+def run(conn, job, f):
+    '''
+    Runs a claimed job, calling `f` with the job's arguments, and stores
+    its result or error.
+    '''
+    try:
+        result = f(**json.loads(job['args']))
+        conn.execute(
+            "UPDATE jobs SET status = 'done', result = ?, finished = ?"
+            " WHERE id = ?",
+            (json.dumps(result, default=serialize.json_default), time.time(),
+             job['id']))
+    except Exception as e:
+        logger.exception('Job {} failed'.format(job['id']))
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished = ?"
+            " WHERE id = ?",
+            ('{}: {}'.format(type(e).__name__, e), time.time(), job['id']))
+
+
+def requeue_running(conn, hostname):
+    ''' Queues again the jobs left running by workers on `hostname` '''
+    n = conn.execute(
+        "UPDATE jobs SET status = 'queued', worker = NULL, started = NULL"
+        " WHERE status = 'running' AND worker LIKE ?",
+        (hostname + ':%',)).rowcount
+    if n:
+        logger.info('Requeued {} interrupted jobs'.format(n))
+    return n
+
+
+def job_metrics(conn):
+    '''
+    Returns per kind: job counts by status, and the mean and maximum queue
+    wait and run time in seconds of finished jobs.
+    '''
+    result = {}
+    for row in conn.execute(
+            'SELECT kind, status, COUNT(*) AS n FROM jobs'
+            ' GROUP BY kind, status'):
+        result.setdefault(row['kind'], {})[row['status']] = row['n']
+    for row in conn.execute(
+            'SELECT kind, AVG(started - submitted) AS wait_mean,'
+            ' MAX(started - submitted) AS wait_max,'
+            ' AVG(finished - started) AS run_mean,'
+            ' MAX(finished - started) AS run_max'
+            ' FROM jobs WHERE finished IS NOT NULL GROUP BY kind'):
+        result[row['kind']].update(
+            (key, row[key])
+            for key in ('wait_mean', 'wait_max', 'run_mean', 'run_max'))
+    return result
+
+
+def purge(conn, older_than):
+    ''' Deletes finished jobs older than `older_than` seconds '''
+    return conn.execute(
+        "DELETE FROM jobs WHERE status IN ('done', 'failed')"
+        " AND finished < ?", (time.time() - older_than,)).rowcount
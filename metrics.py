@@ -0,0 +1,202 @@
+# coding: utf-8
+'''
+Latency histograms of API requests and of the phases they spend time in.
+
+Every SQL statement either engine runs is timed by SQLAlchemy cursor event
+listeners; agg and the API time their other phases (dataframe transforms,
+computation, serialization, remote calls) with `phase`. Each observation is
+labeled with the endpoint (or job kind) being served, so the histograms
+served by `/api/_metrics` in Prometheus text format show where the time of
+each endpoint goes.
+
+SELECT statements slower than `metrics.slow_query_ms` are explained on a
+background thread, and the most recent plans are kept for
+`/api/_metrics/slow`. Plain EXPLAIN only plans the statement; with
+`metrics.explain_analyze` it runs again, for actual row counts and timings,
+which doubles the cost (and any side effects) of every slow query.
+'''
+from initdb import conf, engine, read_engine, session
+from sqlalchemy import event
+import bisect
+import collections
+import contextlib
+import logging
+import Queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+metrics_conf = conf.get('metrics') or {}
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# What the current thread is serving
+context = threading.local()
+
+
+class Histogram(object):
+    ''' Thread-safe Prometheus histogram with labels '''
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (+Inf last), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *values):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = \
+                    [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += seconds
+
+    def _labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                         .replace('"', '\\"'))
+                        for k, v in pairs)
+
+    def exposition(self):
+        ''' Returns the histogram in Prometheus text format '''
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((k, (list(v[0]), v[1]))
+                            for k, v in self._series.items())
+        for values, (counts, total) in series:
+            cumulative = 0
+            for le, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name, self._labels(values, [('le', le)]),
+                    cumulative))
+            lines.append('{}_sum{{{}}} {!r}'.format(
+                self.name, self._labels(values), total))
+            lines.append('{}_count{{{}}} {}'.format(
+                self.name, self._labels(values), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+request_seconds = Histogram('tempus_request_seconds',
+                            'Time to serve API requests.',
+                            ['endpoint', 'status'])
+phase_seconds = Histogram('tempus_phase_seconds',
+                          'Time spent in each phase of serving an endpoint.',
+                          ['endpoint', 'phase'])
+
+HISTOGRAMS = (request_seconds, phase_seconds)
+
+
+def endpoint():
+    ''' Returns what the current thread is serving '''
+    return getattr(context, 'endpoint', None) or 'none'
+
+
+@contextlib.contextmanager
+def serving(name):
+    ''' Labels the observations of the enclosed block with `name` '''
+    previous = getattr(context, 'endpoint', None)
+    context.endpoint = name
+    try:
+        yield
+    finally:
+        context.endpoint = previous
+
+
+@contextlib.contextmanager
+def phase(name):
+    ''' Times the enclosed block as phase `name` of the current endpoint '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        phase_seconds.observe(time.time() - start, endpoint(), name)
+
+
+# Most recent slow queries, with their plans once captured
+slow_queries = collections.deque(maxlen=metrics_conf.get('slow_queries', 100))
+_explain_queue = Queue.Queue(maxsize=100)
+_explain_thread = None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters,
+                           execution_context, executemany):
+    conn.info['query_start'] = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters,
+                          execution_context, executemany):
+    seconds = time.time() - conn.info.pop('query_start', time.time())
+    phase_seconds.observe(seconds, endpoint(), 'sql')
+
+    threshold = metrics_conf.get('slow_query_ms')
+    if threshold is None or seconds * 1000 < threshold:
+        return
+    query = {'statement': statement, 'parameters': repr(parameters),
+             'seconds': seconds, 'endpoint': endpoint(), 'at': time.time(),
+             'plan': None}
+    slow_queries.append(query)
+    # Only reads are explained; the read-only engine refuses anything else
+    if not executemany and \
+            statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        try:
+            _explain_queue.put_nowait((query, statement, parameters))
+        except Queue.Full:
+            pass
+
+
+def _explain_worker():
+    explain = 'EXPLAIN ANALYZE ' if metrics_conf.get('explain_analyze') \
+        else 'EXPLAIN '
+    while True:
+        query, statement, parameters = _explain_queue.get()
+        try:
+            with read_engine.connect() as conn:
+                cursor = conn.connection.cursor()
+                cursor.execute(explain + statement, parameters)
+                query['plan'] = '\n'.join(row[0] for row in cursor.fetchall())
+                cursor.close()
+        except Exception:
+            logger.exception('EXPLAIN of a slow query failed')
+        finally:
+            session.remove()
+
+
+def slow():
+    ''' Returns the recorded slow queries, slowest first '''
+    return sorted(slow_queries, key=lambda q: -q['seconds'])
+
+
+def exposition():
+    ''' Returns every histogram in Prometheus text format '''
+    return ''.join(h.exposition() for h in HISTOGRAMS)
+
+
+def start():
+    ''' Listens to the cursor events of both engines '''
+    global _explain_thread
+    if not metrics_conf.get('enabled', True):
+        return
+    for e in (engine, read_engine):
+        if not event.contains(e, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(e, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(e, 'after_cursor_execute', _after_cursor_execute)
+    if metrics_conf.get('slow_query_ms') is not None and \
+            (_explain_thread is None or not _explain_thread.is_alive()):
+        _explain_thread = threading.Thread(target=_explain_worker)
+        _explain_thread.daemon = True
+        _explain_thread.start()
+
+
+start()
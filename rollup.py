@@ -0,0 +1,332 @@
+# coding: utf-8
+'''
+Daily rollups of the configured tables.
+
+For every table in the Tempus configuration and each of its `groupable`
+columns, a rollup table in the `tempus_internal` schema holds one row per
+(day, group) with the number of rows and the count, sum, sum of squares,
+minimum and maximum of the price column and of every covariate. Aggregates
+whose grain is a day or coarser can be answered from these instead of the
+raw table.
+
+Rows newer than a rollup's watermark are not lost until the next refresh:
+`find` returns the rollup's complete days together with the days since its
+watermark aggregated from the raw rows.
+'''
+from __future__ import print_function
+from initdb import conf, tables, table_cols, engine, read_engine
+from sqlalchemy import func, MetaData, Table, Column, Index, Date, DateTime, \
+    BigInteger, Float, String
+import collections
+import datetime
+import logging
+import sqlalchemy
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+rollup_conf = conf.get('rollup') or {}
+
+meta_internal = MetaData(schema='tempus_internal')
+
+watermarks = Table('watermarks', meta_internal,
+    Column('name', String, primary_key=True),
+    Column('watermark', DateTime, nullable=False)
+)
+
+STATS = ('n', 'sum', 'sumsq', 'min', 'max')
+
+_rollups = {}
+_available = {}
+# (table, group_col) -> (time checked, watermark)
+_watermarks = {}
+
+
+def rollup_name(table, group_col):
+    ''' Returns corresponding rollup table name '''
+    return '_{}_{}_daily'.format(table, group_col)
+
+
+def measures(table):
+    ''' Returns the columns summarized in the rollups of `table` '''
+    cols = table_cols[table]
+    return list(collections.OrderedDict.fromkeys(
+        [cols['price']] + cols['covariates']))
+
+
+def stat_col(measure, stat):
+    return '{}_{}'.format(measure, stat)
+
+
+def get_rollup_table(table, group_col):
+    ''' Returns the rollup `Table` for a table and one of its groupables '''
+    key = (table, group_col)
+    if key not in _rollups:
+        group_type = tables[table].__table__.c[group_col].type
+        name = rollup_name(table, group_col)
+        columns = [
+            Column('day', Date, nullable=False),
+            Column(group_col, group_type),
+            Column('rows', BigInteger, nullable=False),
+        ]
+        for m in measures(table):
+            columns.append(Column(stat_col(m, 'n'), BigInteger))
+            columns.extend(Column(stat_col(m, stat), Float)
+                           for stat in STATS[1:])
+
+        _rollups[key] = Table(name, meta_internal, *columns + [
+            Index('{}_day'.format(name), 'day'),
+            Index('{}_group_day'.format(name), group_col, 'day'),
+        ])
+    return _rollups[key]
+
+
+def _recheck():
+    return rollup_conf.get('recheck', 60)
+
+
+def available(table, group_col):
+    '''
+    Returns whether the rollup for `table` and `group_col` exists.
+
+    A missing rollup is looked for again every `rollup.recheck` seconds, so
+    running processes pick up rollups built after they started.
+    '''
+    key = (table, group_col)
+    found, checked = _available.get(key, (False, None))
+    if not found and (checked is None or time.time() - checked >= _recheck()):
+        found = engine.has_table(rollup_name(table, group_col),
+                                 schema=meta_internal.schema)
+        _available[key] = (found, time.time())
+    return found
+
+
+def watermark(table, group_col):
+    '''
+    Returns the latest timestamp folded into the rollup for `table` and
+    `group_col`, read again every `rollup.recheck` seconds.
+    '''
+    key = (table, group_col)
+    checked, value = _watermarks.get(key, (None, None))
+    if checked is None or time.time() - checked >= _recheck():
+        value = read_engine.execute(
+            sqlalchemy.select([watermarks.c.watermark])
+            .where(watermarks.c.name == rollup_name(table, group_col)))\
+            .scalar()
+        _watermarks[key] = (time.time(), value)
+    return value
+
+
+def current(table, group_col):
+    '''
+    Returns the rollup for `table` and `group_col` brought up to date, or
+    None without a watermark.
+
+    The result has the rollup's columns: its rows before the watermark's
+    day (which may have been partial when it was rolled up), followed by
+    that day and every later one aggregated from the raw rows.
+    '''
+    mark = watermark(table, group_col)
+    if mark is None:
+        return None
+    r = get_rollup_table(table, group_col)
+    day = mark.date()
+    return sqlalchemy.union_all(
+        sqlalchemy.select([r]).where(r.c.day < day),
+        _select_daily(table, group_col, since=day)).alias(r.name)
+
+
+def find(table, group_col=None):
+    '''
+    Returns an available, up to date rollup of `table` (see `current`), or
+    None.
+
+    With `group_col`, only the rollup grouped by that column qualifies;
+    otherwise any rollup can be summed over its groups.
+    '''
+    candidates = [group_col] if group_col else \
+        table_cols[table].get('groupable', [])
+    for col in candidates:
+        if col in table_cols[table].get('groupable', []) and \
+                available(table, col):
+            r = current(table, col)
+            if r is not None:
+                return r
+    return None
+
+
+def _day(value):
+    ''' Returns `value` as a date if it falls on a day boundary, else None '''
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        try:
+            value = datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return None
+    if isinstance(value, datetime.datetime):
+        if value.time() != datetime.time(0):
+            return None
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return None
+
+
+def covers(table, ys=(), tstart=None, tend=None):
+    '''
+    Returns whether a query can be answered from the rollups of `table`.
+
+    The responses must all be rollup measures, and time bounds, if any,
+    must fall on day boundaries.
+    '''
+    if any(y not in measures(table) for y in ys):
+        return False
+    for bound in (tstart, tend):
+        if bound is not None and _day(bound) is None:
+            return False
+    return True
+
+
+def day_filters(rollup, tstart=None, tend=None):
+    '''
+    Returns filter conditions on the rollup `day` column.
+
+    Bounds resolve to whole days: `tstart` includes its own day, and `tend`
+    excludes its own day.
+    '''
+    conds = []
+    if tstart is not None:
+        conds.append(rollup.c.day >= _day(tstart))
+    if tend is not None:
+        conds.append(rollup.c.day < _day(tend))
+    return conds
+
+
+def aggregate(rollup, y, agg):
+    '''
+    Returns an expression that computes `agg` of `y` over rollup rows.
+
+    Returns None for aggregation functions that cannot be derived from the
+    stored statistics.
+    '''
+    c = lambda stat: rollup.c[stat_col(y, stat)]
+    n = func.sum(c('n'))
+    total = func.sum(c('sum'))
+    ss = func.sum(c('sumsq')) - total * total / func.nullif(n, 0)
+
+    agg = agg.upper()
+    if agg == 'COUNT':
+        return n
+    if agg == 'SUM':
+        return total
+    if agg == 'AVG':
+        return total / func.nullif(n, 0)
+    if agg == 'MIN':
+        return func.min(c('min'))
+    if agg == 'MAX':
+        return func.max(c('max'))
+    if agg in ('VARIANCE', 'VAR_SAMP'):
+        return ss / func.nullif(n - 1, 0)
+    if agg == 'VAR_POP':
+        return ss / func.nullif(n, 0)
+    if agg in ('STDDEV', 'STDDEV_SAMP'):
+        return func.sqrt(func.greatest(ss, 0) / func.nullif(n - 1, 0))
+    if agg == 'STDDEV_POP':
+        return func.sqrt(func.greatest(ss, 0) / func.nullif(n, 0))
+    return None
+
+
+def _select_daily(table, group_col, since=None, until=None):
+    ''' Returns a SELECT that aggregates raw rows into rollup rows '''
+    t = tables[table]
+    ts = getattr(t, table_cols[table]['timestamp'])
+    group = getattr(t, group_col)
+    day = sqlalchemy.cast(ts, Date)
+
+    columns = [day.label('day'), group.label(group_col),
+               func.count().label('rows')]
+    for m in measures(table):
+        y = getattr(t, m)
+        columns.extend([
+            func.count(y).label(stat_col(m, 'n')),
+            func.sum(y).label(stat_col(m, 'sum')),
+            func.sum(y * y).label(stat_col(m, 'sumsq')),
+            func.min(y).label(stat_col(m, 'min')),
+            func.max(y).label(stat_col(m, 'max')),
+        ])
+
+    q = sqlalchemy.select(columns).select_from(t.__table__)\
+        .where(ts != None)
+    if since is not None:
+        q = q.where(ts >= since)
+    if until is not None:
+        q = q.where(ts <= until)
+    return q.group_by(day, group)
+
+
+def get_watermark(conn, name):
+    return conn.execute(sqlalchemy.select([watermarks.c.watermark])
+                        .where(watermarks.c.name == name)).scalar()
+
+
+def set_watermark(conn, name, value):
+    conn.execute(watermarks.delete().where(watermarks.c.name == name))
+    conn.execute(watermarks.insert().values(name=name, watermark=value))
+
+
+def refresh(table, group_col, full=False):
+    '''
+    Folds new rows of `table` into its rollup by `group_col`.
+
+    The rollup remembers the latest timestamp it has seen. A refresh
+    recomputes that timestamp's day, which may have been partial, and adds
+    every later day; `full` rebuilds the rollup from scratch. Rows inserted
+    with a timestamp before the watermark's day are only picked up by a full
+    rebuild.
+
+    Returns
+    -------
+    int
+        Number of rollup rows written.
+
+    '''
+    rollup = get_rollup_table(table, group_col)
+    name = rollup.name
+    ts = getattr(tables[table], table_cols[table]['timestamp'])
+
+    with engine.begin() as conn:
+        conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(
+            meta_internal.schema))
+        watermarks.create(conn, checkfirst=True)
+        rollup.create(conn, checkfirst=True)
+
+        since = None if full else get_watermark(conn, name)
+        until = conn.execute(sqlalchemy.select([func.max(ts)])).scalar()
+        if until is None:
+            return 0
+
+        if since is None:
+            conn.execute(rollup.delete())
+        else:
+            since = since.date()
+            conn.execute(rollup.delete().where(rollup.c.day >= since))
+
+        q = _select_daily(table, group_col, since, until)
+        written = conn.execute(rollup.insert().from_select(
+            [c.name for c in rollup.columns], q)).rowcount
+        set_watermark(conn, name, until)
+
+    _available[(table, group_col)] = (True, time.time())
+    _watermarks[(table, group_col)] = (time.time(), until)
+    logger.info('Rollup {}: {} rows through {}'.format(name, written, until))
+    return written
+
+
+def refresh_all(names=None, full=False):
+    ''' Refreshes the rollups of every groupable of the named tables '''
+    for table in names or table_cols:
+        for group_col in table_cols[table].get('groupable', []):
+            refresh(table, group_col, full=full)
@@ -0,0 +1,179 @@
+# coding: utf-8
+'''
+Encoders for (timestamp, value) results.
+
+The streaming encoders emit the response in chunks, so a large series never
+has to be held in memory as a whole. The columnar encoders turn a series
+already held as NumPy arrays into `{"t": [epoch ms, ...], "v": [...]}` JSON,
+or into MessagePack or an Arrow IPC stream when those packages are installed.
+'''
+import collections
+import csv
+import datetime
+import decimal
+import io
+import json
+import zlib
+import numpy as np
+
+# Optional, faster or binary encoders
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def json_default(obj):
+    ''' `json.dumps` fallback for the types SQL results carry '''
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return str(obj)
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def _chunks(rows, chunk_size):
+    ''' Groups an iterable of rows into lists of at most `chunk_size` '''
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_json(rows, key='result', chunk_size=1000):
+    '''
+    Yields `{key: [[timestamp, value], ...]}` as JSON text, in pieces of
+    `chunk_size` rows.
+    '''
+    yield '{{{}: ['.format(json.dumps(key))
+    separator = ''
+    for chunk in _chunks(rows, chunk_size):
+        yield separator + ', '.join(
+            json.dumps((str(dt), v), default=json_default) for dt, v in chunk)
+        separator = ', '
+    yield ']}'
+
+
+def iter_ndjson(rows, chunk_size=1000):
+    ''' Yields one `[timestamp, value]` JSON array per line '''
+    for chunk in _chunks(rows, chunk_size):
+        yield ''.join(json.dumps((str(dt), v), default=json_default) + '\n'
+                      for dt, v in chunk)
+
+
+def iter_csv(rows, header=('timestamp', 'value'), chunk_size=1000):
+    ''' Yields CSV text with a header row '''
+    buf = io.BytesIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    for chunk in _chunks(rows, chunk_size):
+        writer.writerows((str(dt), v) for dt, v in chunk)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+# Streaming formats selectable with the `format` query argument
+FORMATS = {
+    'json': ('application/json', iter_json),
+    'ndjson': ('application/x-ndjson', iter_ndjson),
+    'csv': ('text/csv', iter_csv),
+}
+
+
+def dumps(obj):
+    '''
+    Encodes plain JSON types (no Decimals or datetimes) with the C encoder
+    of ujson when it is installed.
+    '''
+    if ujson is not None:
+        return ujson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def nullable(v):
+    ''' Returns a float array as a list, with None for NaN '''
+    missing = np.isnan(v)
+    if not missing.any():
+        return v.tolist()
+    v = v.astype(object)
+    v[missing] = None
+    return v.tolist()
+
+
+def row_arrays(rows):
+    '''
+    Returns (timestamp, value) rows as epoch millisecond and float arrays,
+    with NaN for NULL values.
+    '''
+    t = np.array([row[0] for row in rows], dtype='M8[ms]').astype(np.int64)
+    v = np.array([row[1] for row in rows], dtype=float)
+    return t, v
+
+
+def columns_json(t, v, **extra):
+    '''
+    Returns `{"t": [...], "v": [...], **extra}` JSON of epoch millisecond
+    timestamps and float values.
+    '''
+    payload = dict(extra, t=np.asarray(t, dtype=np.int64).tolist(),
+                   v=nullable(np.asarray(v, dtype=float)))
+    return dumps(payload)
+
+
+def columns_msgpack(t, v, **extra):
+    payload = dict(extra, t=np.asarray(t, dtype=np.int64).tolist(),
+                   v=nullable(np.asarray(v, dtype=float)))
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def columns_arrow(t, v, **extra):
+    ''' Returns an Arrow IPC stream of one record batch with `t` and `v` '''
+    v = np.asarray(v, dtype=float)
+    batch = pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(np.asarray(t, dtype=np.int64),
+                       type=pyarrow.timestamp('ms')),
+         pyarrow.array(v, mask=np.isnan(v))], ['t', 'v'])
+    if extra:
+        batch = batch.replace_schema_metadata(
+            {'tempus': json.dumps(extra, default=json_default)})
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, batch.schema)
+    writer.write_batch(batch)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def column_formats():
+    '''
+    Returns {mimetype: encoder} of the columnar encodings available, JSON
+    first.
+    '''
+    formats = [('application/json', columns_json)]
+    if msgpack is not None:
+        formats.append(('application/x-msgpack', columns_msgpack))
+    if pyarrow is not None:
+        formats.append(('application/vnd.apache.arrow.stream',
+                        columns_arrow))
+    return collections.OrderedDict(formats)
+
+
+def compress(data, encoding, level=6):
+    ''' Returns `data` compressed for Content-Encoding gzip or deflate '''
+    # wbits 31 writes the gzip container, 15 the zlib one HTTP calls deflate
+    compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                  31 if encoding == 'gzip' else 15)
+    return compressor.compress(data) + compressor.flush()
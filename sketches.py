@@ -0,0 +1,300 @@
+# coding: utf-8
+'''
+Daily sketches of the configured tables, for approximate answers.
+
+For every table and each of its `groupable` columns, a sketch table in the
+`tempus_internal` schema holds one row per (day, group) with
+
+    <col>_hll   a HyperLogLog sketch of the distinct values of each other
+                groupable column
+    <m>_dd      a DDSketch of the values of the price and every covariate
+
+and one more sketch table holds the same per day over all groups. Sketches
+of any days merge without loss of accuracy, so distinct counts and
+percentiles over any window of days are answered without reading raw rows.
+
+    HyperLogLog     2 ** precision registers; relative standard error
+                    1.04 / sqrt(2 ** precision)
+    DDSketch        logarithmic buckets; every quantile is within
+                    `accuracy` of the true value, relatively
+
+The sketches themselves are in `util.sketch`, which needs no database.
+`tempus.py sketches` builds them and later folds in new days, like the
+daily rollups.
+'''
+from __future__ import division, print_function
+from initdb import conf, tables, table_cols, engine
+from util.sketch import hash64, HyperLogLog, DDSketch
+from sqlalchemy import MetaData, Table, Column, Index, Date, LargeBinary, \
+    func
+import collections
+import datetime
+import logging
+import time
+import numpy as np
+import sqlalchemy
+import rollup
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+sketches_conf = conf.get('sketches') or {}
+
+meta_internal = rollup.meta_internal
+
+_sketches = {}
+_available = {}
+
+
+def sketch_name(table, group_col=None):
+    ''' Returns the sketch table name of `table`, per group of `group_col` '''
+    if group_col is None:
+        return '_{}_sketches'.format(table)
+    return '_{}_{}_sketches'.format(table, group_col)
+
+
+def hll_col(col):
+    return '{}_hll'.format(col)
+
+
+def dd_col(measure):
+    return '{}_dd'.format(measure)
+
+
+def distinct_columns(table, group_col=None):
+    ''' Returns the groupables counted distinctly per group of `group_col` '''
+    return [c for c in table_cols[table].get('groupable', [])
+            if c != group_col]
+
+
+def get_sketch_table(table, group_col=None):
+    ''' Returns the sketch `Table` of `table`, per group of `group_col` '''
+    key = (table, group_col)
+    if key not in _sketches:
+        name = sketch_name(table, group_col)
+        columns = [Column('day', Date, nullable=False)]
+        indexes = [Index('{}_day'.format(name), 'day')]
+        if group_col is not None:
+            columns.append(Column(
+                group_col, tables[table].__table__.c[group_col].type))
+            indexes.append(Index('{}_group_day'.format(name), group_col,
+                                 'day'))
+        columns += [Column(hll_col(c), LargeBinary)
+                    for c in distinct_columns(table, group_col)]
+        columns += [Column(dd_col(m), LargeBinary)
+                    for m in rollup.measures(table)]
+        _sketches[key] = Table(name, meta_internal, *columns + indexes)
+    return _sketches[key]
+
+
+def available(table, group_col=None):
+    '''
+    Returns whether the sketch table of `table` and `group_col` exists.
+
+    A missing one is looked for again every `rollup.recheck` seconds, like
+    the rollups, so running processes pick up sketches built after they
+    started.
+    '''
+    key = (table, group_col)
+    found, checked = _available.get(key, (False, None))
+    if not found and (checked is None or time.time() - checked >=
+                      rollup.rollup_conf.get('recheck', 60)):
+        found = engine.has_table(sketch_name(table, group_col),
+                                 schema=meta_internal.schema)
+        _available[key] = (found, time.time())
+    return found
+
+
+class DayBuilder(object):
+    ''' Sketches of one day's rows, per group '''
+
+    def __init__(self, table, group_col, precision, accuracy):
+        self.distinct = distinct_columns(table, group_col)
+        self.measures = rollup.measures(table)
+        self.precision = precision
+        self.accuracy = accuracy
+        self.groups = collections.OrderedDict()
+
+    def _sketches(self, group):
+        if group not in self.groups:
+            self.groups[group] = (
+                dict((c, HyperLogLog(self.precision)) for c in self.distinct),
+                dict((m, DDSketch(self.accuracy)) for m in self.measures))
+        return self.groups[group]
+
+    def add(self, groups, columns):
+        '''
+        Adds rows: `groups` holds each row's group, `columns` each distinct
+        column's and measure's values.
+        '''
+        # Sort rows by group once; each group is then a contiguous run
+        groups = np.asarray(groups, dtype=object)
+        keys, inverse = np.unique(groups, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+
+        positions = {}
+        for c in self.distinct:
+            values = np.asarray(columns[c], dtype=object)[order]
+            present = np.array([v is not None for v in values], dtype=bool)
+            hashes = np.zeros(len(values), dtype=np.uint64)
+            hashes[present] = hash64(values[present])
+            positions[c] = HyperLogLog.positions(hashes, self.precision) + \
+                (present,)
+        values = dict((m, np.array(columns[m], dtype=float)[order])
+                      for m in self.measures)
+
+        for i, key in enumerate(keys):
+            lo, hi = bounds[i], bounds[i + 1]
+            hlls, dds = self._sketches(key)
+            for c in self.distinct:
+                index, rank, present = positions[c]
+                keep = present[lo:hi]
+                np.maximum.at(hlls[c].registers, index[lo:hi][keep],
+                              rank[lo:hi][keep])
+            for m in self.measures:
+                dds[m].add(values[m][lo:hi])
+
+    def rows(self, day, group_col):
+        ''' Returns the sketch table rows of the day '''
+        for group, (hlls, dds) in self.groups.items():
+            row = {'day': day}
+            if group_col is not None:
+                row[group_col] = group
+            row.update((hll_col(c), hlls[c].to_bytes()) for c in hlls)
+            row.update((dd_col(m), dds[m].to_bytes()) for m in dds)
+            yield row
+
+
+def refresh(table, group_col=None, full=False, chunk_size=None):
+    '''
+    Folds new days of `table` into its sketches per `group_col` (or over
+    all groups).
+
+    As with the rollups, the sketch table remembers the latest timestamp it
+    has seen; a refresh recomputes that day and adds every later one, and
+    `full` rebuilds it from scratch.
+
+    Returns
+    -------
+    int
+        Number of sketch rows written.
+
+    '''
+    chunk_size = chunk_size or sketches_conf.get('chunk_size', 100000)
+    precision = sketches_conf.get('precision', 12)
+    accuracy = sketches_conf.get('accuracy', 0.01)
+    sketch = get_sketch_table(table, group_col)
+    name = sketch.name
+
+    t = tables[table]
+    ts = getattr(t, table_cols[table]['timestamp'])
+    distinct = distinct_columns(table, group_col)
+    measures = rollup.measures(table)
+    day = sqlalchemy.cast(ts, Date)
+    columns = [day, getattr(t, group_col) if group_col else
+               sqlalchemy.literal(None)]
+    columns += [getattr(t, c) for c in distinct + measures]
+
+    written = 0
+    with engine.begin() as conn:
+        conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(
+            meta_internal.schema))
+        rollup.watermarks.create(conn, checkfirst=True)
+        sketch.create(conn, checkfirst=True)
+
+        since = None if full else rollup.get_watermark(conn, name)
+        until = conn.execute(sqlalchemy.select([func.max(ts)])).scalar()
+        if until is None:
+            return 0
+        if since is None:
+            conn.execute(sketch.delete())
+        else:
+            since = since.date()
+            conn.execute(sketch.delete().where(sketch.c.day >= since))
+
+        q = sqlalchemy.select(columns).where(ts != None).where(ts <= until)\
+            .order_by(day)
+        if since is not None:
+            q = q.where(ts >= since)
+
+        builder, current = None, None
+
+        def flush():
+            rows = list(builder.rows(current, group_col))
+            if rows:
+                conn.execute(sketch.insert(), rows)
+            return len(rows)
+
+        # A second connection streams the rows while this one writes
+        with engine.connect() as reader:
+            result = reader.execution_options(stream_results=True)\
+                .execute(q)
+            while True:
+                chunk = result.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                days = [row[0] for row in chunk]
+                bounds = [0] + [i for i in range(1, len(days))
+                                if days[i] != days[i - 1]] + [len(days)]
+                for lo, hi in zip(bounds[:-1], bounds[1:]):
+                    if days[lo] != current:
+                        if builder is not None:
+                            written += flush()
+                        builder = DayBuilder(table, group_col, precision,
+                                             accuracy)
+                        current = days[lo]
+                    rows = chunk[lo:hi]
+                    builder.add([row[1] for row in rows], dict(
+                        (c, [row[2 + i] for row in rows])
+                        for i, c in enumerate(distinct + measures)))
+        if builder is not None:
+            written += flush()
+        rollup.set_watermark(conn, name, until)
+
+    _available[(table, group_col)] = (True, time.time())
+    logger.info('Sketches {}: {} rows through {}'.format(name, written, until))
+    return written
+
+
+def refresh_all(names=None, full=False):
+    ''' Refreshes the sketches of the named tables, per groupable and overall '''
+    for table in names or table_cols:
+        for group_col in [None] + table_cols[table].get('groupable', []):
+            refresh(table, group_col, full=full)
+
+
+def load(table, group_col, column, start=None, end=None, groups=None):
+    '''
+    Returns {group: merged sketch} of sketch column `column` (see `hll_col`
+    and `dd_col`) over the days from `start` (inclusive) to `end`
+    (exclusive); without `group_col` the only group is None.
+    '''
+    sketch = get_sketch_table(table, group_col)
+    group = sketch.c[group_col] if group_col else sqlalchemy.literal(None)
+    q = sqlalchemy.select([group, sketch.c[column]])\
+        .where(sketch.c[column] != None)
+    for cond in rollup.day_filters(sketch, _to_day(start), _to_day(end)):
+        q = q.where(cond)
+    if groups is not None and group_col is not None:
+        q = q.where(sketch.c[group_col].in_(groups))
+
+    decode = HyperLogLog.from_bytes if column.endswith('_hll') \
+        else DDSketch.from_bytes
+    merged = {}
+    with engine.connect() as conn:
+        for key, data in conn.execute(q):
+            s = decode(data)
+            if key in merged:
+                merged[key].merge(s)
+            else:
+                merged[key] = s
+    return merged
+
+
+def _to_day(value):
+    ''' Returns a timestamp or date (or its string) as a date '''
+    if value is None:
+        return None
+    return datetime.datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
@@ -0,0 +1,252 @@
+# coding: utf-8
+'''
+On-disk columnar snapshots of the configured tables.
+
+`tempus.py snapshot` exports each table's timestamp, groupable and covariate
+columns, one directory of `.npy` column files per month of the timestamp:
+
+    <path>/<table>/manifest.json        columns, partitions, row counts
+    <path>/<table>/dictionary.json      groupable values, indexed by code
+    <path>/<table>/2014-01/timestamp.npy
+    <path>/<table>/2014-01/msaname.npy  ...
+    <path>/<table>/_columns/...         all partitions, concatenated
+
+Later exports only re-read the last month from Postgres and append new
+months. The concatenated columns are memory-mapped by `load`, so every
+process starting from a snapshot shares the same pages of the OS cache
+instead of querying the database. The store never writes to them: rows
+loaded later are kept apart in memory (see `columnar`).
+'''
+from __future__ import division
+from initdb import conf, tables, table_cols, engine
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import sqlalchemy
+import columnar
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+snapshot_conf = conf.get('snapshot') or {}
+
+COLUMNS_DIR = '_columns'
+
+
+def table_dir(table):
+    return os.path.join(snapshot_conf.get('path', '.tempus_cache/snapshots'),
+                        table)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_json(path, obj):
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _replace_dir(tmp, path):
+    ''' Moves directory `tmp` to `path`, replacing what was there '''
+    old = '{}.old.{}'.format(path, os.getpid())
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def read_manifest(table):
+    '''
+    Returns the manifest of `table`'s snapshot, or None if there is none or
+    it was taken with different configured columns.
+    '''
+    manifest = _read_json(os.path.join(table_dir(table), 'manifest.json'))
+    store = columnar.ColumnStore(table)
+    if manifest is None or manifest.get('groupable') != store.groupable or \
+            manifest.get('measures') != store.measures:
+        return None
+    return manifest
+
+
+def month_of(us):
+    ''' Returns the 'YYYY-MM' month of epoch microsecond timestamps '''
+    return np.datetime_as_string(
+        np.asarray(us, dtype=np.int64).astype('M8[us]').astype('M8[M]'))
+
+
+def _write_partition(store, month, parts):
+    '''
+    Writes encoded (ts, codes, values) chunks of one month as a partition.
+
+    Returns the partition's manifest entry.
+    '''
+    directory = os.path.join(table_dir(store.table), month)
+    tmp = '{}.tmp.{}'.format(directory, os.getpid())
+    os.makedirs(tmp)
+
+    ts = np.concatenate([p[0] for p in parts])
+    np.save(os.path.join(tmp, 'timestamp.npy'), ts)
+    for col in store.groupable:
+        np.save(os.path.join(tmp, col + '.npy'),
+                np.concatenate([p[1][col] for p in parts]))
+    for m in store.measures:
+        np.save(os.path.join(tmp, m + '.npy'),
+                np.concatenate([p[2][m] for p in parts]))
+    _replace_dir(tmp, directory)
+
+    first, last = columnar.to_datetimes([ts[0], ts[-1]])
+    return {'rows': len(ts), 'first': str(first), 'last': str(last)}
+
+
+def export(table, full=False, chunk_size=None):
+    '''
+    Writes `table`'s snapshot, or brings it up to date.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name.
+    full : bool, optional
+        Rewrite every partition instead of only the last month and newer.
+    chunk_size : int, optional
+        Rows fetched at a time (the default is the `columnar` setting).
+
+    Returns
+    -------
+    int
+        Rows read from Postgres.
+
+    '''
+    chunk_size = chunk_size or \
+        columnar.columnar_conf.get('chunk_size', 100000)
+    manifest = None if full else read_manifest(table)
+    dictionary = _read_json(os.path.join(table_dir(table), 'dictionary.json'))
+    store = columnar.ColumnStore(table)
+    if manifest is None or dictionary is None:
+        manifest = {'groupable': store.groupable, 'measures': store.measures,
+                    'partitions': {}}
+        if os.path.isdir(table_dir(table)):
+            shutil.rmtree(table_dir(table))
+        os.makedirs(table_dir(table))
+    else:
+        # Keep codes stable: new values get codes after the existing ones
+        store.set_categories(dictionary)
+
+    t = tables[table]
+    ts = getattr(t, table_cols[table]['timestamp'])
+    q = sqlalchemy.select(
+        [ts] + [getattr(t, c) for c in store.groupable + store.measures])\
+        .where(ts != None).order_by(ts)
+    if manifest['partitions']:
+        # The last month may have grown since; earlier ones are final
+        last = max(manifest['partitions'])
+        q = q.where(ts >= np.datetime64(last, 'M').astype(object))
+
+    n = 0
+    month, parts = None, []
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(q)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            n += len(rows)
+            chunk_ts, codes, values = store.encode_rows(rows)
+            months = month_of(chunk_ts)
+            bounds = np.r_[0, np.flatnonzero(months[1:] != months[:-1]) + 1,
+                           len(months)]
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                if months[lo] != month and parts:
+                    manifest['partitions'][month] = _write_partition(
+                        store, month, parts)
+                    parts = []
+                month = str(months[lo])
+                parts.append((chunk_ts[lo:hi],
+                              dict((c, a[lo:hi]) for c, a in codes.items()),
+                              dict((m, a[lo:hi]) for m, a in values.items())))
+    if parts:
+        manifest['partitions'][month] = _write_partition(store, month, parts)
+
+    _write_json(os.path.join(table_dir(table), 'dictionary.json'),
+                store.categories)
+    compact(table, manifest)
+    _write_json(os.path.join(table_dir(table), 'manifest.json'), manifest)
+    logger.info('Snapshot of {}: {} rows read, {} partitions'.format(
+        table, n, len(manifest['partitions'])))
+    return n
+
+
+def compact(table, manifest):
+    '''
+    Concatenates the partitions of `table` into the column files `load`
+    maps, without holding a whole column in memory.
+    '''
+    months = sorted(manifest['partitions'])
+    total = sum(manifest['partitions'][m]['rows'] for m in months)
+    directory = os.path.join(table_dir(table), COLUMNS_DIR)
+    tmp = '{}.tmp.{}'.format(directory, os.getpid())
+    os.makedirs(tmp)
+
+    for col in ['timestamp'] + manifest['groupable'] + manifest['measures']:
+        out = None
+        offset = 0
+        for month in months:
+            part = np.load(os.path.join(table_dir(table), month, col + '.npy'),
+                           mmap_mode='r')
+            if out is None:
+                out = np.lib.format.open_memmap(
+                    os.path.join(tmp, col + '.npy'), mode='w+',
+                    dtype=part.dtype, shape=(total,))
+            out[offset:offset + len(part)] = part
+            offset += len(part)
+        if out is not None:
+            out.flush()
+            del out
+    _replace_dir(tmp, directory)
+
+
+def load(table, memory_mb=None):
+    '''
+    Returns a `columnar.ColumnStore` of `table` backed by its memory-mapped
+    snapshot, or None if there is no usable snapshot.
+
+    The store's watermark is the snapshot's last timestamp, so refreshing it
+    only reads rows added since the snapshot was taken.
+    '''
+    manifest = read_manifest(table)
+    if manifest is None or not manifest['partitions']:
+        return None
+    directory = os.path.join(table_dir(table), COLUMNS_DIR)
+    dictionary = _read_json(os.path.join(table_dir(table), 'dictionary.json'))
+
+    def column(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+    try:
+        store = columnar.ColumnStore(table, memory_mb)
+        store.load_arrays(column('timestamp'),
+                          dict((c, column(c)) for c in store.groupable),
+                          dict((m, column(m)) for m in store.measures),
+                          dictionary)
+    except (IOError, OSError, TypeError, KeyError):
+        logger.exception('Snapshot of {} is unreadable'.format(table))
+        return None
+    logger.info('Mapped {} rows of {} from its snapshot'.format(len(store),
+                                                                table))
+    return store
+
+
+def export_all(names=None, full=False):
+    ''' Exports the snapshots of `names` (the default is every table) '''
+    for table in names or table_cols:
+        export(table, full=full)
@@ -1,5 +1,6 @@
 import argparse
-from util.load import _init_once
+from util.load import _dictionary, _indexes, _init_once, _link, _rollup, \
+    _sketches, _snapshot, _worker
 parser = argparse.ArgumentParser(description='''Tempus: Make sense of geospatial
 temporal economic data''')
 
@@ -8,5 +9,69 @@ parser_init = subparsers.add_parser('init',
                                     help='Initialize Tempus from conf file.')
 
 parser_init.set_defaults(func=_init_once)
+
+parser_dictionary = subparsers.add_parser('dictionary',
+                                          help='Add new rows to the group '
+                                               'dictionaries.')
+parser_dictionary.add_argument('tables', nargs='*',
+                               help='Tables to list groups of (default: all).')
+parser_dictionary.add_argument('--full', action='store_true',
+                               help='Rebuild instead of refreshing.')
+parser_dictionary.set_defaults(func=_dictionary)
+
+parser_indexes = subparsers.add_parser('indexes',
+                                       help='Advise or create indexes.')
+parser_indexes.add_argument('tables', nargs='*',
+                            help='Tables to check (default: all).')
+parser_indexes.add_argument('--create', action='store_true',
+                            help='Create the missing indexes.')
+parser_indexes.add_argument('--concurrently', action='store_true',
+                            help='Create them without blocking writes.')
+parser_indexes.set_defaults(func=_indexes)
+
+parser_link = subparsers.add_parser('link',
+                                    help='Link coordinates to geographies.')
+parser_link.add_argument('tables', nargs='*',
+                         help='Tables to link (default: all with '
+                              'geo_linkages).')
+parser_link.add_argument('--method', choices=['kdtree', 'postgis'],
+                         default='kdtree',
+                         help='Nearest point search (default: kdtree).')
+parser_link.add_argument('--full', action='store_true',
+                         help='Relink every row instead of unlinked rows.')
+parser_link.add_argument('--chunk-size', type=int, default=100000,
+                         help='Rows read and written at a time.')
+parser_link.set_defaults(func=_link)
+
+parser_rollup = subparsers.add_parser('rollup',
+                                      help='Fold new rows into daily rollups.')
+parser_rollup.add_argument('tables', nargs='*',
+                           help='Tables to roll up (default: all).')
+parser_rollup.add_argument('--full', action='store_true',
+                           help='Rebuild instead of refreshing.')
+parser_rollup.set_defaults(func=_rollup)
+
+parser_sketches = subparsers.add_parser('sketches',
+                                        help='Fold new days into sketches.')
+parser_sketches.add_argument('tables', nargs='*',
+                             help='Tables to sketch (default: all).')
+parser_sketches.add_argument('--full', action='store_true',
+                             help='Rebuild instead of refreshing.')
+parser_sketches.set_defaults(func=_sketches)
+
+parser_snapshot = subparsers.add_parser('snapshot',
+                                        help='Export tables to column files.')
+parser_snapshot.add_argument('tables', nargs='*',
+                             help='Tables to export (default: all).')
+parser_snapshot.add_argument('--full', action='store_true',
+                             help='Rewrite instead of appending new months.')
+parser_snapshot.set_defaults(func=_snapshot)
+
+parser_worker = subparsers.add_parser('worker',
+                                      help='Run queued analysis jobs.')
+parser_worker.add_argument('-n', '--workers', type=int,
+                           help='Worker processes (default: from conf).')
+parser_worker.set_defaults(func=_worker)
+
 args = parser.parse_args()
 args.func(args)
@@ -0,0 +1,79 @@
+# coding: utf-8
+'''
+Tests of the ARIMA fits and forecasts.
+'''
+from __future__ import division
+import unittest
+import numpy as np
+import arima
+
+
+class ArimaTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        # AR(1) around a level, plus a trend once integrated
+        e = rng.normal(size=400)
+        w = np.zeros(400)
+        for t in range(1, 400):
+            w[t] = 0.2 + 0.6 * w[t - 1] + e[t]
+        self.w = w
+        self.y = np.cumsum(w)
+
+    def test_fit(self):
+        params = arima.fit(self.w, d=0, max_p=3)
+        self.assertEqual(params['p'], 1)
+        self.assertAlmostEqual(params['coef'][0], 0.6, delta=0.1)
+        self.assertAlmostEqual(params['sigma2'], 1, delta=0.2)
+        self.assertEqual(params['tail'], [self.w[-1]])
+
+        params = arima.fit(self.y, d=1, max_p=3)
+        self.assertEqual(params['p'], 1)
+        self.assertEqual(len(params['tail']), 2)
+
+    def test_too_short(self):
+        self.assertIsNone(arima.fit([1.0], d=1))
+        self.assertIsNone(arima.fit([np.nan, np.nan]))
+
+    def test_fill_gaps(self):
+        np.testing.assert_allclose(
+            arima.fill_gaps([np.nan, 1, np.nan, 3, np.nan]), [1, 2, 3])
+
+    def test_predict(self):
+        params = arima.fit(self.w, d=0, max_p=3)
+        mean, lower, upper = arima.predict(params, 50)
+        self.assertEqual(len(mean), 50)
+        a, c = params['coef'][0], params['intercept']
+        self.assertAlmostEqual(mean[0], c + a * self.w[-1])
+        # Converges to the process mean, with widening intervals
+        self.assertAlmostEqual(mean[-1], c / (1 - a), places=6)
+        width = upper - lower
+        self.assertTrue((np.diff(width) >= 0).all())
+        self.assertAlmostEqual(width[0], 2 * 1.96 * np.sqrt(params['sigma2']))
+
+    def test_predict_integrated(self):
+        params = arima.fit(self.y, d=1, max_p=3)
+        mean, lower, upper = arima.predict(params, 10)
+        self.assertTrue((lower < mean).all() and (mean < upper).all())
+        # The forecast keeps the drift of the differences
+        self.assertGreater(mean[-1], self.y[-1])
+
+    def test_predict_no_steps(self):
+        params = arima.fit(self.w, d=0, max_p=3)
+        for forecast in arima.predict(params, 0):
+            self.assertEqual(len(forecast), 0)
+        self.assertRaises(ValueError, arima.predict, params, -1)
+
+    def test_fit_many(self):
+        Y = np.column_stack([self.w, self.w[::-1], np.r_[np.nan, 1.0]
+                             .repeat(200)])
+        params = arima.fit_many(['a', 'b', 'c'], Y, d=0, max_p=3, threads=2)
+        self.assertEqual(params[0], arima.fit(self.w, d=0, max_p=3))
+        self.assertEqual(params[1], arima.fit(self.w[::-1], d=0, max_p=3))
+        # Cached on the series, so a refit returns the same parameters
+        self.assertEqual(arima.fit_many(['a'], Y[:, :1], d=0, max_p=3),
+                         params[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# coding: utf-8
+'''
+Tests of the change point detectors.
+'''
+from __future__ import division
+import unittest
+import numpy as np
+import changepoint
+
+
+def optimal_cost(y, penalty, min_size):
+    ''' Penalized cost of the optimal segmentation, by O(n^2) dynamic
+    programming without pruning '''
+    n = len(y)
+    S1, S2 = changepoint._sums(y)
+    F = [-penalty] + [np.inf] * n
+    for t in range(min_size, n + 1):
+        F[t] = min(F[s] + changepoint._cost(S1, S2, s, t) + penalty
+                   for s in range(0, t - min_size + 1)
+                   if s == 0 or s >= min_size)
+    return F[n]
+
+
+def segmentation_cost(y, changes, penalty):
+    S1, S2 = changepoint._sums(y)
+    bounds = [0] + list(changes) + [len(y)]
+    return sum(changepoint._cost(S1, S2, s, t)
+               for s, t in zip(bounds[:-1], bounds[1:])) + \
+        penalty * len(changes)
+
+
+class ChangepointTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.y = np.r_[np.zeros(60), np.full(50, 5.0), np.full(40, 1.0)] + \
+            rng.normal(scale=0.5, size=150)
+
+    def test_pelt(self):
+        self.assertEqual(changepoint.pelt(self.y), [60, 110])
+
+    def test_pelt_is_optimal(self):
+        rng = np.random.RandomState(3)
+        y = np.repeat(rng.normal(scale=3, size=6), 8) + \
+            rng.normal(size=48)
+        for min_size in 1, 2, 5:
+            changes = changepoint.pelt(y, penalty=4.0, min_size=min_size)
+            self.assertAlmostEqual(segmentation_cost(y, changes, 4.0),
+                                   optimal_cost(y, 4.0, min_size))
+            gaps = np.diff([0] + changes + [len(y)])
+            self.assertTrue((gaps >= min_size).all())
+
+    def test_binseg(self):
+        self.assertEqual(changepoint.binseg(self.y), [60, 110])
+        self.assertEqual(changepoint.binseg(self.y, max_changes=1), [60])
+
+    def test_no_change(self):
+        y = np.random.RandomState(4).normal(size=200)
+        self.assertEqual(changepoint.pelt(y), [])
+        self.assertEqual(changepoint.binseg(y), [])
+        self.assertEqual(changepoint.amoc(y[:, None]), [[]])
+
+    def test_short(self):
+        self.assertEqual(changepoint.pelt([1.0, 2.0, 3.0]), [])
+        self.assertEqual(changepoint.amoc(np.ones((3, 2))), [[], []])
+
+    def test_amoc(self):
+        Y = np.column_stack([self.y[:110], self.y[109::-1], self.y[:110] * 0])
+        self.assertEqual(changepoint.amoc(Y, penalty=10.0),
+                         [[60], [50], []])
+
+    def test_interpolate(self):
+        np.testing.assert_allclose(
+            changepoint.interpolate([np.nan, 1, np.nan, 3, np.nan]),
+            [1, 1, 2, 3, 3])
+        np.testing.assert_allclose(
+            changepoint.interpolate([np.nan, np.nan]), [0, 0])
+
+    def test_detect_many(self):
+        Y = np.column_stack([self.y, self.y[::-1]])
+        Y[5, 0] = np.nan
+        expected = [changepoint.pelt(changepoint.interpolate(Y[:, i]))
+                    for i in range(2)]
+        self.assertEqual(changepoint.detect_many(Y, threads=2), expected)
+        self.assertEqual(changepoint.detect_many(Y, 'binseg', threads=2),
+                         [changepoint.binseg(changepoint.interpolate(
+                             Y[:, i])) for i in range(2)])
+        self.assertRaises(ValueError, changepoint.detect_many, Y, 'other')
+
+    def test_min_size(self):
+        Y = self.y[:, None]
+        for method in changepoint.METHODS:
+            for min_size in 0, -1:
+                self.assertRaises(ValueError, changepoint.detect_many, Y,
+                                  method, min_size=min_size)
+        for detect in changepoint.pelt, changepoint.binseg:
+            self.assertRaises(ValueError, detect, self.y, min_size=0)
+        self.assertRaises(ValueError, changepoint.amoc, Y, min_size=0)
+        self.assertEqual(changepoint.detect_many(Y, 'binseg', min_size=1),
+                         [changepoint.binseg(self.y, min_size=1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
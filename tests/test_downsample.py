@@ -0,0 +1,74 @@
+# coding: utf-8
+'''
+Tests of the LTTB downsampling.
+'''
+from __future__ import division
+import datetime
+import unittest
+import numpy as np
+import downsample
+
+
+class LttbTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        self.x = np.arange(1000, dtype=float)
+        self.y = np.cumsum(rng.normal(size=1000))
+
+    def test_kept(self):
+        kept = downsample.lttb(self.x, self.y, 50)
+        self.assertEqual(len(kept), 50)
+        self.assertEqual(kept[0], 0)
+        self.assertEqual(kept[-1], 999)
+        self.assertTrue((np.diff(kept) > 0).all())
+
+    def test_one_per_bucket(self):
+        kept = downsample.lttb(self.x, self.y, 12)
+        edges = np.linspace(1, 999, 11).astype(int)
+        for i, k in enumerate(kept[1:-1]):
+            self.assertTrue(edges[i] <= k < edges[i + 1])
+
+    def test_keeps_spikes(self):
+        y = np.zeros(1000)
+        y[123], y[777] = 100, -100
+        kept = downsample.lttb(self.x, y, 10)
+        self.assertIn(123, kept)
+        self.assertIn(777, kept)
+
+    def test_fewer_points(self):
+        np.testing.assert_array_equal(downsample.lttb([0, 1, 2], [1, 2, 3],
+                                                      5), [0, 1, 2])
+
+    def test_threshold_below_three(self):
+        for threshold in 0, 1, 2:
+            self.assertRaises(ValueError, downsample.lttb, self.x, self.y,
+                              threshold)
+            self.assertRaises(ValueError, downsample.lttb_rows, [],
+                              threshold)
+            self.assertRaises(ValueError, downsample.lttb_arrays, self.x,
+                              self.y, threshold)
+
+    def test_rows(self):
+        start = datetime.datetime(2014, 1, 1)
+        rows = [(start + datetime.timedelta(hours=i), float(v))
+                for i, v in enumerate(self.y)]
+        rows[10] = (rows[10][0], None)
+        kept = downsample.lttb_rows(rows, 100)
+        self.assertEqual(len(kept), 100)
+        self.assertEqual(kept[0], rows[0])
+        self.assertEqual(kept[-1], rows[-1])
+        self.assertNotIn(rows[10], kept)
+
+    def test_arrays(self):
+        y = self.y.copy()
+        y[::2] = np.nan
+        t, v = downsample.lttb_arrays(self.x, y, 600)
+        np.testing.assert_array_equal(t, self.x[1::2])
+        t, v = downsample.lttb_arrays(self.x, y, 100)
+        self.assertEqual(len(t), 100)
+        self.assertFalse(np.isnan(v).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+# coding: utf-8
+'''
+Tests of the in-process estimators against the models they mirror.
+'''
+from __future__ import division
+import unittest
+import numpy as np
+from scipy import stats
+import estimators
+
+
+def rlines_diffindiff(dates, target, comparison, event_date, logged=False,
+                      normalize=False):
+    '''
+    `rlines::diffindiff_data` spelled out: OLS of `counts ~ post*group` with
+    Comparison as the base group, and the target and comparison changes as
+    contrasts of the coefficients.
+    '''
+    target = np.asarray(target, dtype=float)
+    comparison = np.asarray(comparison, dtype=float)
+    post = (dates > np.datetime64(event_date, 'D')).astype(float)
+    if logged:
+        target, comparison = np.log1p(target), np.log1p(comparison)
+    if normalize:
+        comparison = comparison * target[post == 0].mean() / \
+            comparison[post == 0].mean()
+
+    counts = np.r_[comparison, target]
+    post = np.r_[post, post]
+    group = np.r_[np.zeros(len(target)), np.ones(len(target))]
+    X = np.column_stack([np.ones(len(counts)), post, group, post * group])
+    coef = np.linalg.lstsq(X, counts)[0]
+    df = len(counts) - X.shape[1]
+    sigma2 = ((counts - X.dot(coef)) ** 2).sum() / df
+    vcov = sigma2 * np.linalg.inv(X.T.dot(X))
+
+    def contrast(vec):
+        vec = np.asarray(vec, dtype=float)
+        b = vec.dot(coef)
+        se = np.sqrt(vec.dot(vcov).dot(vec))
+        t = b / se
+        return {'b': b, 'se': se, 't': t,
+                'p': 2 * stats.t.sf(abs(t), df - 1)}
+
+    return {'diff_in_diff': contrast([0, 0, 0, 1]),
+            'target_diff': contrast([0, 1, 0, 1]),
+            'comparison_diff': contrast([0, 1, 0, 0])}
+
+
+class DiffInDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.dates = np.arange('2014-01-01', '2014-03-01',
+                               dtype='datetime64[D]')
+        n = len(self.dates)
+        self.event = '2014-02-01'
+        post = self.dates > np.datetime64(self.event)
+        self.target = rng.poisson(40 + 15 * post)
+        self.comparison = rng.poisson(200 + 10 * post, n)
+
+    def assertMatchesRlines(self, **kwargs):
+        result = estimators.diffindiff(self.dates, self.target,
+                                       self.comparison, self.event, **kwargs)
+        expected = rlines_diffindiff(self.dates, self.target,
+                                     self.comparison, self.event, **kwargs)
+        for name in expected:
+            for stat in 'b', 'se', 't', 'p':
+                self.assertAlmostEqual(result[name][stat],
+                                       expected[name][stat], places=8,
+                                       msg='{} {}'.format(name, stat))
+
+    def test_matches_rlines(self):
+        self.assertMatchesRlines()
+
+    def test_logged(self):
+        self.assertMatchesRlines(logged=True)
+
+    def test_normalize(self):
+        self.assertMatchesRlines(normalize=True)
+
+    def test_series(self):
+        result = estimators.diffindiff(self.dates, self.target,
+                                       self.comparison, self.event)
+        self.assertEqual(len(result['data']), len(self.dates))
+        self.assertEqual(result['target'][0],
+                         {'date': '2014-01-01',
+                          'counts': float(self.target[0])})
+        self.assertEqual(result['data'][-1]['Comparison'],
+                         float(self.comparison[-1]))
+
+    def test_many_matches_single(self):
+        targets = np.column_stack([self.target, self.target[::-1]])
+        comparisons = np.column_stack([self.comparison, self.comparison])
+        many = estimators.diffindiff_many(self.dates, targets, comparisons,
+                                          self.event, logged=True)
+        for i, estimates in enumerate(many):
+            single = estimators.diffindiff(self.dates, targets[:, i],
+                                           comparisons[:, i], self.event,
+                                           logged=True)
+            for name in estimates:
+                self.assertAlmostEqual(estimates[name]['b'],
+                                       single[name]['b'])
+                self.assertAlmostEqual(estimates[name]['se'],
+                                       single[name]['se'])
+
+    def test_normalize_without_comparison_counts(self):
+        comparison = np.where(self.dates > np.datetime64(self.event),
+                              self.comparison, 0)
+        self.assertRaises(ValueError, estimators.diffindiff, self.dates,
+                          self.target, comparison, self.event,
+                          normalize=True)
+        estimates = estimators.diffindiff(self.dates, self.target,
+                                          comparison, self.event)
+        self.assertTrue(np.isfinite(estimates['diff_in_diff']['b']))
+
+    def test_needs_both_periods(self):
+        self.assertRaises(ValueError, estimators.diffindiff, self.dates,
+                          self.target, self.comparison, '2015-01-01')
+
+
+class PropensityScoresTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.X = rng.normal(size=(500, 3))
+        logit = 0.5 + self.X.dot([1.0, -2.0, 0.0])
+        self.treated = rng.uniform(size=500) < 1 / (1 + np.exp(-logit))
+
+    def test_score_equations(self):
+        # Without a penalty the fit is the maximum likelihood one, where the
+        # residuals are orthogonal to the intercept and every covariate
+        p = estimators.propensity_scores(self.X, self.treated, ridge=0)
+        residuals = self.treated - p
+        self.assertAlmostEqual(residuals.sum(), 0, places=6)
+        np.testing.assert_allclose(self.X.T.dot(residuals), 0, atol=1e-6)
+
+    def test_frequency_weights(self):
+        # Integer weights fit the same model as repeating the rows
+        weights = np.arange(len(self.X)) % 3 + 1
+        weighted = estimators.propensity_scores(self.X, self.treated,
+                                                weights=weights, ridge=0)
+        repeated = estimators.propensity_scores(
+            np.repeat(self.X, weights, axis=0),
+            np.repeat(self.treated, weights), ridge=0)
+        np.testing.assert_allclose(
+            weighted, repeated[np.cumsum(weights) - 1], rtol=1e-6)
+
+    def test_separable(self):
+        # A single treated unit is separable; the ridge keeps scores finite
+        X = np.arange(10, dtype=float)[:, None]
+        treated = np.arange(10) == 9
+        p = estimators.propensity_scores(X, treated)
+        self.assertTrue(np.isfinite(p).all())
+        self.assertTrue((p > 0).all() and (p < 1).all())
+        self.assertEqual(np.argmax(p), 9)
+
+    def test_constant_covariate(self):
+        X = np.column_stack([self.X[:, 0], np.ones(len(self.X))])
+        p = estimators.propensity_scores(X, self.treated)
+        self.assertTrue(np.isfinite(p).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
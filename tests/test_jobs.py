@@ -0,0 +1,138 @@
+# coding: utf-8
+'''
+Tests of the job queue, on a temporary SQLite store.
+'''
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import jobstore
+
+
+class JobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'queue', 'jobs.sqlite')
+        self.conn = jobstore.connect(self.path)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def test_submit_dedup(self):
+        args = {'target': 'a', 'comparisons': ['b', 'c']}
+        job_id = jobstore.submit(self.conn, 'diffindiff', args)
+        # Identical while queued or running, whatever the key order
+        same = jobstore.submit(self.conn, 'diffindiff',
+                               {'comparisons': ['b', 'c'], 'target': 'a'})
+        self.assertEqual(same, job_id)
+        self.assertNotEqual(jobstore.submit(self.conn, 'comparison', args),
+                            job_id)
+        self.assertNotEqual(jobstore.submit(self.conn, 'diffindiff',
+                                            dict(args, target='d')), job_id)
+
+        job = jobstore.claim(self.conn, 'host:1')
+        self.assertEqual(jobstore.submit(self.conn, 'diffindiff', args),
+                         job_id)
+        jobstore.run(self.conn, job, lambda **kwargs: 1)
+        # Once done, the same job is queued again
+        self.assertNotEqual(jobstore.submit(self.conn, 'diffindiff', args),
+                            job_id)
+
+    def test_get(self):
+        job_id = jobstore.submit(self.conn, 'diffindiff', {'target': 'a'})
+        job = jobstore.get(self.conn, job_id)
+        self.assertEqual(job['status'], 'queued')
+        self.assertEqual(job['args'], {'target': 'a'})
+        # Still waiting, so the wait so far and no run time
+        self.assertGreaterEqual(job['wait_seconds'], 0)
+        self.assertIsNone(job['run_seconds'])
+        self.assertNotIn('result', job)
+        self.assertIsNone(jobstore.get(self.conn, 'unknown'))
+
+    def test_claim_in_order(self):
+        first = jobstore.submit(self.conn, 'diffindiff', {'target': 'a'})
+        second = jobstore.submit(self.conn, 'diffindiff', {'target': 'b'})
+        self.assertEqual(jobstore.claim(self.conn, 'host:1')['id'], first)
+        self.assertEqual(jobstore.claim(self.conn, 'host:2')['id'], second)
+        self.assertIsNone(jobstore.claim(self.conn, 'host:1'))
+
+        job = jobstore.get(self.conn, first)
+        self.assertEqual(job['status'], 'running')
+        self.assertGreaterEqual(job['wait_seconds'], 0)
+
+    def test_claim_once(self):
+        # Workers on their own connections never claim the same job
+        ids = set(jobstore.submit(self.conn, 'diffindiff', {'target': i})
+                  for i in range(50))
+        claimed = []
+
+        def worker(name):
+            conn = jobstore.connect(self.path)
+            while True:
+                job = jobstore.claim(conn, name)
+                if job is None:
+                    break
+                claimed.append(job['id'])
+            conn.close()
+
+        threads = [threading.Thread(target=worker, args=('host:{}'.format(i),))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(claimed), sorted(ids))
+
+    def test_run(self):
+        job_id = jobstore.submit(self.conn, 'diffindiff',
+                                 {'target': 'a', 'logged': True})
+        job = jobstore.claim(self.conn, 'host:1')
+        jobstore.run(self.conn, job,
+                     lambda target, logged: {'target': target, 'b': 1.5})
+        job = jobstore.get(self.conn, job_id)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result'], {'target': 'a', 'b': 1.5})
+        self.assertGreaterEqual(job['run_seconds'], 0)
+
+    def test_run_failed(self):
+        job_id = jobstore.submit(self.conn, 'diffindiff', {'target': 'a'})
+
+        def fail(target):
+            raise ValueError('No data for {}'.format(target))
+
+        jobstore.run(self.conn, jobstore.claim(self.conn, 'host:1'), fail)
+        job = jobstore.get(self.conn, job_id)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error'], 'ValueError: No data for a')
+        self.assertNotIn('result', job)
+
+    def test_requeue_running(self):
+        job_id = jobstore.submit(self.conn, 'diffindiff', {'target': 'a'})
+        jobstore.claim(self.conn, 'host:1')
+        self.assertEqual(jobstore.requeue_running(self.conn, 'other'), 0)
+        self.assertEqual(jobstore.requeue_running(self.conn, 'host'), 1)
+        self.assertEqual(jobstore.claim(self.conn, 'host:2')['id'], job_id)
+
+    def test_metrics_and_purge(self):
+        for target in 'a', 'b':
+            jobstore.submit(self.conn, 'diffindiff', {'target': target})
+        jobstore.submit(self.conn, 'comparison', {'target': 'a'})
+        jobstore.run(self.conn, jobstore.claim(self.conn, 'host:1'),
+                     lambda target: None)
+
+        metrics = jobstore.job_metrics(self.conn)
+        self.assertEqual(metrics['diffindiff']['done'], 1)
+        self.assertEqual(metrics['diffindiff']['queued'], 1)
+        self.assertEqual(metrics['comparison'], {'queued': 1})
+        self.assertGreaterEqual(metrics['diffindiff']['run_max'], 0)
+
+        self.assertEqual(jobstore.purge(self.conn, 3600), 0)
+        self.assertEqual(jobstore.purge(self.conn, -1), 1)
+        self.assertNotIn('done', jobstore.job_metrics(self.conn)['diffindiff'])
+
+
+if __name__ == '__main__':
+    unittest.main()
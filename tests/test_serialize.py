@@ -0,0 +1,106 @@
+# coding: utf-8
+'''
+Round trips of the result encoders.
+'''
+import csv
+import datetime
+import decimal
+import json
+import unittest
+import zlib
+import numpy as np
+import serialize
+
+START = datetime.datetime(2014, 1, 1)
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [(START + datetime.timedelta(days=i), v)
+                     for i, v in enumerate([1.5, None, decimal.Decimal('2'),
+                                            3, 4.25])]
+
+    def expected(self):
+        return [[str(dt), None if v is None else float(v)]
+                for dt, v in self.rows]
+
+    def test_json(self):
+        for chunk_size in 1, 2, 1000:
+            text = ''.join(serialize.iter_json(self.rows, 'result',
+                                               chunk_size))
+            self.assertEqual(json.loads(text), {'result': self.expected()})
+        self.assertEqual(json.loads(''.join(serialize.iter_json([]))),
+                         {'result': []})
+
+    def test_ndjson(self):
+        text = ''.join(serialize.iter_ndjson(self.rows, chunk_size=2))
+        self.assertEqual([json.loads(line) for line in text.splitlines()],
+                         self.expected())
+
+    def test_csv(self):
+        text = ''.join(serialize.iter_csv(self.rows, chunk_size=2))
+        rows = list(csv.reader(text.splitlines()))
+        self.assertEqual(rows[0], ['timestamp', 'value'])
+        self.assertEqual([row[0] for row in rows[1:]],
+                         [str(dt) for dt, v in self.rows])
+        self.assertEqual(rows[2][1], '')
+        self.assertEqual(float(rows[-1][1]), 4.25)
+
+    def test_json_default(self):
+        self.assertRaises(TypeError, serialize.json_default, object())
+
+
+class ColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        rows = [(START + datetime.timedelta(hours=i), v)
+                for i, v in enumerate([1.0, None, 2.5])]
+        self.t, self.v = serialize.row_arrays(rows)
+
+    def test_row_arrays(self):
+        self.assertEqual(self.t.tolist(),
+                         [1388534400000, 1388538000000, 1388541600000])
+        self.assertTrue(np.isnan(self.v[1]))
+
+    def test_json(self):
+        self.assertEqual(json.loads(serialize.columns_json(self.t, self.v,
+                                                           group='a')),
+                         {'t': self.t.tolist(), 'v': [1.0, None, 2.5],
+                          'group': 'a'})
+
+    def test_nullable(self):
+        self.assertEqual(serialize.nullable(np.array([1.0, 2.0])),
+                         [1.0, 2.0])
+
+    @unittest.skipIf(serialize.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        payload = serialize.msgpack.unpackb(
+            serialize.columns_msgpack(self.t, self.v, group='a'), raw=False)
+        self.assertEqual(payload, {'t': self.t.tolist(),
+                                   'v': [1.0, None, 2.5], 'group': 'a'})
+
+    @unittest.skipIf(serialize.pyarrow is None, 'pyarrow is not installed')
+    def test_arrow(self):
+        reader = serialize.pyarrow.ipc.open_stream(
+            serialize.columns_arrow(self.t, self.v, group='a'))
+        table = reader.read_all()
+        self.assertEqual(table.column('v').to_pylist(), [1.0, None, 2.5])
+        self.assertEqual(json.loads(table.schema.metadata[b'tempus']),
+                         {'group': 'a'})
+
+    def test_formats(self):
+        formats = serialize.column_formats()
+        self.assertEqual(list(formats)[0], 'application/json')
+
+    def test_compress(self):
+        data = serialize.columns_json(self.t, self.v).encode('utf-8') * 10
+        self.assertEqual(zlib.decompress(serialize.compress(data, 'gzip'),
+                                         31), data)
+        self.assertEqual(zlib.decompress(serialize.compress(data,
+                                                            'deflate')),
+                         data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# coding: utf-8
+'''
+Tests of the HyperLogLog and DDSketch error bounds.
+'''
+from __future__ import division
+import unittest
+import numpy as np
+from util import sketch
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def sketch(self, values, precision=12):
+        hll = sketch.HyperLogLog(precision)
+        hll.add_hashes(sketch.hash64(values))
+        return hll
+
+    def assertWithinError(self, hll, n):
+        # Three standard errors
+        self.assertLess(abs(hll.count() - n) / n, 3 * hll.relative_error())
+
+    def test_error_bound(self):
+        for precision in 10, 12, 14:
+            for n in 1000, 20000, 100000:
+                values = np.arange(n) + 10 ** 7 * precision
+                self.assertWithinError(self.sketch(values, precision), n)
+
+    def test_small(self):
+        self.assertEqual(self.sketch([]).count(), 0)
+        self.assertAlmostEqual(self.sketch(['a', 'b', 'a']).count(), 2,
+                               delta=0.01)
+
+    def test_duplicates(self):
+        values = np.repeat(np.arange(5000), 7)
+        self.assertEqual(self.sketch(values).count(),
+                         self.sketch(np.arange(5000)).count())
+
+    def test_merge(self):
+        a = self.sketch(np.arange(0, 30000))
+        b = self.sketch(np.arange(20000, 50000))
+        a.merge(b)
+        np.testing.assert_array_equal(
+            a.registers, self.sketch(np.arange(50000)).registers)
+        self.assertWithinError(a, 50000)
+
+    def test_bytes(self):
+        hll = self.sketch(np.arange(10000), precision=10)
+        copy = sketch.HyperLogLog.from_bytes(hll.to_bytes())
+        self.assertEqual(copy.precision, 10)
+        np.testing.assert_array_equal(copy.registers, hll.registers)
+
+
+class DDSketchTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(6)
+        self.values = rng.lognormal(mean=4, sigma=1.5, size=50000)
+
+    def assertRelativeAccuracy(self, dd, values):
+        values = np.sort(values)
+        for q in 0, 0.01, 0.25, 0.5, 0.9, 0.99, 1:
+            expected = values[int(np.floor(q * (len(values) - 1)))]
+            self.assertLessEqual(
+                abs(dd.quantile(q) - expected) / expected,
+                dd.accuracy + 1e-9, msg='q={}'.format(q))
+
+    def test_relative_accuracy(self):
+        for accuracy in 0.01, 0.05:
+            dd = sketch.DDSketch(accuracy)
+            dd.add(self.values)
+            self.assertEqual(dd.count(), len(self.values))
+            self.assertRelativeAccuracy(dd, self.values)
+
+    def test_zeros_and_nan(self):
+        dd = sketch.DDSketch()
+        dd.add([0, -5, np.nan, 10, 20])
+        self.assertEqual(dd.count(), 4)
+        self.assertEqual(dd.quantile(0.25), 0)
+        self.assertAlmostEqual(dd.quantile(1), 20, delta=20 * 0.01)
+        self.assertIsNone(sketch.DDSketch().quantile(0.5))
+
+    def test_merge(self):
+        a, b = sketch.DDSketch(), sketch.DDSketch()
+        a.add(self.values[:20000])
+        b.add(self.values[20000:])
+        a.merge(b)
+        whole = sketch.DDSketch()
+        whole.add(self.values)
+        np.testing.assert_array_equal(a.index, whole.index)
+        np.testing.assert_array_equal(a.counts, whole.counts)
+        self.assertRelativeAccuracy(a, self.values)
+
+    def test_bytes(self):
+        dd = sketch.DDSketch(0.02)
+        dd.add(np.r_[self.values[:1000], 0])
+        copy = sketch.DDSketch.from_bytes(dd.to_bytes())
+        self.assertEqual(copy.accuracy, 0.02)
+        self.assertEqual(copy.zeros, 1)
+        np.testing.assert_array_equal(copy.index, dd.index)
+        np.testing.assert_array_equal(copy.counts, dd.counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,26 @@
 from __future__ import print_function
-from initdb import tables, session, engine, conf, Base, Base_geo, Base_lib
+from initdb import tables, session, engine, conf, table_cols, table_conf, \
+    Base, Base_geo, Base_lib
 from geoalchemy2 import Geography
-from sqlalchemy import MetaData, Column, Table
+from sqlalchemy import MetaData, Column, Float, Table
 from sqlalchemy.schema import ForeignKey
+from scipy.spatial import cKDTree
+import csv
+import io
+import logging
+import time
+import numpy as np
+import sqlalchemy
+import rollup
 meta_internal = MetaData(schema='tempus_internal')
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig()
+
+# Mean Earth radius
+EARTH_RADIUS_KM = 6371.0088
+
 def geospatial_name(table):
     ''' Returns corresponding geospatial table name '''
     return '_{}_geo'.format(table)
@@ -18,6 +34,218 @@ def make_geospatial_table(table, pk, pk_type):
     )
     return geo
 
+def linkage_name(table, geo):
+    ''' Returns the name of the table linking `table` rows to `geo` '''
+    return '_{}_{}_link'.format(table, geo)
+
+def make_linkage_table(table, geo):
+    '''
+    Returns the table linking each row of `table` that has coordinates to
+    the nearest point of geography `geo`.
+    '''
+    pk = primary_key(table)
+    link_col = conf['tempus_geography'][geo]['linkage']
+    link = Table(linkage_name(table, geo), meta_internal,
+        Column(pk.name, pk.type, primary_key=True),
+        Column(link_col, getattr(Base_geo.classes[geo], link_col).\
+               property.columns[0].type, index=True),
+        Column('distance_km', Float),
+        Column('coords', Geography(geometry_type='POINT', srid=4326,
+                                   spatial_index=True)),
+        extend_existing=True
+    )
+    return link
+
+def primary_key(table):
+    pk = table_conf[table]['PK']
+    if len(pk) != 1:
+        raise ValueError('Linking {} needs a single column primary key'.format(
+            table))
+    return tables[table].__table__.c[pk[0]]
+
+def unit_vectors(lat, lon):
+    ''' Returns points on the unit sphere, where chords order like arcs '''
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1))
+
+def centroid_tree(geo):
+    ''' Returns (KD-tree over the points of `geo`, their linkage values) '''
+    geo_conf = conf['tempus_geography'][geo]
+    g = Base_geo.classes[geo]
+    lat = getattr(g, geo_conf['coords']['latitude'])
+    lon = getattr(g, geo_conf['coords']['longitude'])
+    rows = session.query(getattr(g, geo_conf['linkage']),
+                         sqlalchemy.cast(lat, Float),
+                         sqlalchemy.cast(lon, Float))\
+            .filter(lat != None).filter(lon != None).all()
+    keys = [row[0] for row in rows]
+    coords = np.array([row[1:] for row in rows], dtype=float)
+    return cKDTree(unit_vectors(coords[:, 0], coords[:, 1])), keys
+
+def _unlinked(table, link):
+    ''' Returns a SELECT of (pk, lat, lon) of rows not yet in `link` '''
+    t = tables[table].__table__
+    coords = table_cols[table]['coords']
+    pk = primary_key(table)
+    lat, lon = t.c[coords['latitude']], t.c[coords['longitude']]
+    return sqlalchemy.select([pk, lat, lon])\
+            .select_from(t.outerjoin(link, link.c[pk.name] == pk))\
+            .where(link.c[pk.name] == None)\
+            .where(lat != None).where(lon != None)
+
+def _copy_rows(conn, link, rows):
+    ''' Bulk-loads (pk, linkage, distance_km, lon, lat) rows with COPY '''
+    buf = io.BytesIO()
+    writer = csv.writer(buf)
+    for pk, key, distance, lon, lat in rows:
+        writer.writerow((pk, key, repr(float(distance)),
+                         'SRID=4326;POINT({!r} {!r})'.format(float(lon),
+                                                             float(lat))))
+    buf.seek(0)
+    cursor = conn.cursor()
+    cursor.copy_expert('COPY {}.{} ({}) FROM STDIN WITH CSV'.format(
+        link.schema, link.name,
+        ', '.join('"{}"'.format(c.name) for c in link.columns)), buf)
+    cursor.close()
+
+def link_kdtree(table, geo, link, chunk_size=100000):
+    '''
+    Links unlinked rows of `table` to their nearest point of `geo` with an
+    in-memory KD-tree, COPYing each chunk of results.
+
+    Returns the number of rows linked.
+    '''
+    tree, keys = centroid_tree(geo)
+    n = 0
+    writer = engine.raw_connection()
+    try:
+        # Stream the unlinked rows over their own transaction's cursor
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True)\
+                    .execute(_unlinked(table, link))
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                coords = np.array([row[1:] for row in rows], dtype=float)
+                chord, nearest = tree.query(
+                    unit_vectors(coords[:, 0], coords[:, 1]))
+                _copy_rows(writer, link,
+                           ((row[0], keys[i], d, lon, lat)
+                            for row, i, d, (lat, lon) in zip(
+                                rows, nearest, chord_to_km(chord), coords)))
+                # Commit per chunk so an interrupted run resumes from here
+                writer.commit()
+                n += len(rows)
+                logger.info('Linked {} rows of {}'.format(n, table))
+    finally:
+        writer.close()
+    return n
+
+def link_postgis(table, geo, link):
+    '''
+    Links unlinked rows of `table` to their nearest point of `geo` inside
+    Postgres, with a KNN (`<->`) search of the GiST index on the points.
+
+    Returns the number of rows linked.
+    '''
+    geo_conf = conf['tempus_geography'][geo]
+    link_col = geo_conf['linkage']
+    points = make_geospatial_table(geo, link_col,
+                                   getattr(Base_geo.classes[geo], link_col).\
+                                           property.columns[0].type)
+    coords = table_cols[table]['coords']
+    pk = primary_key(table)
+
+    fill_points = sqlalchemy.text('''
+        INSERT INTO {points} ("{key}", coords)
+        SELECT g."{key}", ST_SetSRID(ST_MakePoint(g."{lon}"::float,
+                                                  g."{lat}"::float),
+                                     4326)::geography
+        FROM tempus_geography."{geo}" g
+        WHERE g."{lat}" IS NOT NULL AND g."{lon}" IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM {points} p
+                          WHERE p."{key}" = g."{key}")'''.format(
+        points='tempus_geography.' + points.name, key=link_col, geo=geo,
+        lat=geo_conf['coords']['latitude'],
+        lon=geo_conf['coords']['longitude']))
+    knn = sqlalchemy.text('''
+        INSERT INTO {link} ("{pk}", "{key}", distance_km, coords)
+        SELECT t."{pk}", c."{key}", ST_Distance(c.coords, p.coords) / 1000,
+               p.coords
+        FROM {table} t
+        CROSS JOIN LATERAL (
+            SELECT ST_SetSRID(ST_MakePoint(t."{lon}", t."{lat}"),
+                              4326)::geography AS coords) p
+        CROSS JOIN LATERAL (
+            SELECT g."{key}", g.coords FROM {points} g
+            ORDER BY g.coords <-> p.coords LIMIT 1) c
+        WHERE t."{lat}" IS NOT NULL AND t."{lon}" IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM {link} l WHERE l."{pk}" = t."{pk}")'''
+        .format(link='{}.{}'.format(link.schema, link.name), pk=pk.name,
+                key=link_col, table=table,
+                points='tempus_geography.' + points.name,
+                lat=coords['latitude'], lon=coords['longitude']))
+
+    with engine.begin() as conn:
+        points.create(conn, checkfirst=True)
+        conn.execute(fill_points)
+        return conn.execute(knn).rowcount
+
+def link(table, method='kdtree', full=False, chunk_size=100000):
+    '''
+    Links each row of `table` with coordinates to the nearest point of its
+    configured `geo_linkages` geography, e.g. streetrx rows to CBSA centroids.
+
+    Parameters
+    ----------
+    table : str
+        Tempus table name, configured with `coords` and `geo_linkages`.
+    method : {'kdtree', 'postgis'}, optional
+        Search a KD-tree of the geography's points in this process (the
+        default), or run a KNN query against a GiST index in Postgres.
+    full : bool, optional
+        Relink every row instead of only the rows not linked yet.
+    chunk_size : int, optional
+        Rows read and COPYed at a time by the 'kdtree' method.
+
+    Returns
+    -------
+    int
+        Number of rows linked.
+
+    '''
+    geo = table_cols[table].get('geo_linkages')
+    if not geo or 'coords' not in table_cols[table]:
+        raise ValueError('{} has no coords or geo_linkages'.format(table))
+    link_table = make_linkage_table(table, geo)
+
+    with engine.begin() as conn:
+        conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(
+            meta_internal.schema))
+        if full:
+            link_table.drop(conn, checkfirst=True)
+        link_table.create(conn, checkfirst=True)
+
+    start = time.time()
+    if method == 'kdtree':
+        n = link_kdtree(table, geo, link_table, chunk_size)
+    elif method == 'postgis':
+        n = link_postgis(table, geo, link_table)
+    else:
+        raise ValueError('Unknown linkage method {}'.format(method))
+
+    with engine.begin() as conn:
+        conn.execute('ANALYZE {}.{}'.format(link_table.schema,
+                                            link_table.name))
+    logger.info('Linked {} rows of {} to {} in {:.1f}s'.format(
+        n, table, geo, time.time() - start))
+    return n
+
 def _init_once(args):
     geo_conf = conf['tempus_geography']
     # Create geospatial tables that link back to geographies
@@ -29,3 +257,65 @@ def _init_once(args):
         print(geo_table.create(engine))
     return
 
+
+def _rollup(args):
+    # Build or incrementally refresh the daily rollups
+    rollup.refresh_all(args.tables, full=args.full)
+    return
+
+
+def _dictionary(args):
+    # Build or incrementally refresh the group dictionaries
+    import dictionary
+    dictionary.refresh_all(args.tables, full=args.full)
+    return
+
+
+def _sketches(args):
+    # Build or incrementally refresh the daily sketches
+    import sketches
+    sketches.refresh_all(args.tables, full=args.full)
+    return
+
+
+def _snapshot(args):
+    # Export new months of each table to its on-disk snapshot
+    import snapshot
+    snapshot.export_all(args.tables, full=args.full)
+    return
+
+
+def _link(args):
+    # Link rows with coordinates to their nearest configured geography
+    names = args.tables or [t for t in table_cols
+                            if table_cols[t].get('geo_linkages')]
+    for table in names:
+        link(table, method=args.method, full=args.full,
+             chunk_size=args.chunk_size)
+    return
+
+
+def _indexes(args):
+    # Propose (or create) the indexes the hot queries need
+    import indexes
+    for table in args.tables or table_cols:
+        present = indexes.existing(table)
+        for advice in indexes.advise(table):
+            if indexes.covered(advice.columns, present):
+                status = 'present'
+            elif args.create:
+                indexes.create(advice, concurrently=args.concurrently)
+                status = 'created'
+            else:
+                status = 'missing'
+            print('{:<8} {} {:<11} {:<5} ({})'.format(
+                status, table, advice.kind, advice.method,
+                ', '.join(advice.columns)))
+    return
+
+
+def _worker(args):
+    # Imported here so other commands do not import the analyses
+    import jobs
+    jobs.serve(args.workers)
+    return
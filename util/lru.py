@@ -0,0 +1,40 @@
+# coding: utf-8
+'''
+In-process least-recently-used cache, shared by the result cache and the
+fitted model caches.
+'''
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    ''' Thread-safe least-recently-used mapping with a time to live '''
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Returns (found, value) '''
+        with self._lock:
+            if key not in self._data:
+                return False, None
+            expires, value = self._data.pop(key)
+            if expires < time.time():
+                return False, None
+            self._data[key] = (expires, value)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
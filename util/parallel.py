@@ -0,0 +1,40 @@
+# coding: utf-8
+'''
+Thread pool shared by the analyses that fit one model per group.
+
+Threads rather than processes: the API process holds pooled database
+connections and runs background threads, which a forked pool would inherit
+mid-use, and the fits spend their time in NumPy and LAPACK calls that
+release the GIL.
+'''
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import threading
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(threads=None):
+    ''' Returns the thread pool, creating it on first use '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(threads)
+    return _pool
+
+
+def parallel_map(f, items, threads=None, chunksize=None):
+    '''
+    Maps `f` over `items` in the thread pool.
+
+    With `threads=1`, or a single item, runs in the calling thread instead.
+    '''
+    items = list(items)
+    if threads == 1 or len(items) < 2:
+        return [f(item) for item in items]
+    pool = get_pool(threads)
+    if chunksize is None:
+        chunksize = max(1, len(items) // (4 * (threads or
+                                               multiprocessing.cpu_count())))
+    return pool.map(f, items, chunksize)
@@ -0,0 +1,158 @@
+# coding: utf-8
+'''
+Mergeable sketches, in pure NumPy.
+
+    HyperLogLog     distinct count of 64 bit hashes in 2 ** precision
+                    registers; relative standard error
+                    1.04 / sqrt(2 ** precision)
+    DDSketch        quantiles from logarithmic buckets; every quantile is
+                    within `accuracy` of the true value, relatively
+
+Sketches of the same parameters merge without loss of accuracy, and
+serialize to compact bytes.
+'''
+from __future__ import division
+import hashlib
+import math
+import struct
+import zlib
+import numpy as np
+
+
+def hash64(values):
+    '''
+    Returns stable 64 bit hashes of `values`, hashing each distinct value
+    once.
+    '''
+    values = np.asarray(values, dtype=object)
+    if not len(values):
+        return np.zeros(0, dtype=np.uint64)
+    uniques, inverse = np.unique(values, return_inverse=True)
+    hashes = np.array(
+        [struct.unpack('<Q', hashlib.md5(
+            v.encode('utf-8') if isinstance(v, unicode) else str(v))
+            .digest()[:8])[0] for v in uniques], dtype=np.uint64)
+    return hashes[inverse]
+
+
+class HyperLogLog(object):
+    ''' Distinct count sketch '''
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = np.zeros(self.m, dtype=np.uint8) \
+            if registers is None else registers
+
+    def add_hashes(self, hashes):
+        index, rank = self.positions(hashes, self.precision)
+        np.maximum.at(self.registers, index, rank)
+
+    @staticmethod
+    def positions(hashes, precision):
+        '''
+        Returns the register and rank (position of the first set bit) of
+        64 bit hashes.
+        '''
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        index = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+        # The low 32 bits convert to float exactly
+        w = (hashes & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        rank = np.full(len(w), 33, dtype=np.uint8)
+        nonzero = w > 0
+        rank[nonzero] = 32 - np.floor(np.log2(w[nonzero])).astype(np.uint8)
+        return index, rank
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def to_bytes(self):
+        return zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        registers = np.frombuffer(zlib.decompress(data), dtype=np.uint8)\
+            .copy()
+        return cls(int(math.log(len(registers), 2)), registers)
+
+
+class DDSketch(object):
+    '''
+    Quantile sketch with relative accuracy. Values of 0 or below are kept
+    in a single bucket at 0.
+    '''
+
+    def __init__(self, accuracy=0.01, index=None, counts=None, zeros=0):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.index = np.zeros(0, dtype=np.int32) if index is None else index
+        self.counts = np.zeros(0, dtype=np.int64) if counts is None \
+            else counts
+        self.zeros = zeros
+
+    def _fold(self, index, counts):
+        ''' Adds counts to buckets, keeping buckets unique and sorted '''
+        index = np.concatenate([self.index, index])
+        counts = np.concatenate([self.counts, counts])
+        self.index, inverse = np.unique(index, return_inverse=True)
+        self.index = self.index.astype(np.int32)
+        self.counts = np.bincount(inverse, weights=counts,
+                                  minlength=len(self.index)).astype(np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        positive = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        if len(positive):
+            index = np.ceil(np.log(positive) / math.log(self.gamma))
+            self._fold(index.astype(np.int32),
+                       np.ones(len(positive), dtype=np.int64))
+
+    def merge(self, other):
+        self.zeros += other.zeros
+        self._fold(other.index, other.counts)
+
+    def count(self):
+        return int(self.zeros + self.counts.sum())
+
+    def quantile(self, q):
+        n = self.count()
+        if not n:
+            return None
+        rank = q * (n - 1)
+        if rank < self.zeros:
+            return 0.0
+        cumulative = self.zeros + np.cumsum(self.counts)
+        i = min(np.searchsorted(cumulative, rank, side='right'),
+                len(cumulative) - 1)
+        return 2 * self.gamma ** float(self.index[i]) / (self.gamma + 1)
+
+    def to_bytes(self):
+        return zlib.compress(
+            struct.pack('<dqi', self.accuracy, self.zeros, len(self.index)) +
+            self.index.astype('<i4').tobytes() +
+            self.counts.astype('<i8').tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = zlib.decompress(data)
+        accuracy, zeros, n = struct.unpack('<dqi', data[:20])
+        index = np.frombuffer(data[20:20 + 4 * n], dtype='<i4')\
+            .astype(np.int32)
+        counts = np.frombuffer(data[20 + 4 * n:], dtype='<i8')\
+            .astype(np.int64)
+        return cls(accuracy, index, counts, zeros)